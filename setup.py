@@ -93,6 +93,7 @@ if __name__ == "__main__":
     INSTALL_ALL = get_reqs(lookup,'INSTALL_ALL')
     INSTALL_BUILD_GOOGLE = get_reqs(lookup,'INSTALL_BUILD_GOOGLE')
     INSTALL_METRICS = get_reqs(lookup,'INSTALL_METRICS')
+    INSTALL_ASYNC = get_reqs(lookup,'INSTALL_ASYNC')
 
     setup(name=NAME,
           version=VERSION,
@@ -109,10 +110,16 @@ if __name__ == "__main__":
           long_description=LONG_DESCRIPTION,
           keywords=KEYWORDS,
           install_requires = INSTALL_REQUIRES,
+          entry_points={
+              'console_scripts': [
+                  'singularity-hash=singularity.analysis.reproduce.batch:main'
+              ]
+          },
           extras_require={
 
               'metrics': [INSTALL_METRICS],
               'google': [INSTALL_BUILD_GOOGLE],
+              'async': [INSTALL_ASYNC],
               'all': [INSTALL_ALL]
 
           },
@@ -125,6 +132,5 @@ if __name__ == "__main__":
               'Topic :: Software Development',
               'Topic :: Scientific/Engineering',
               'Operating System :: Unix',
-              'Programming Language :: Python :: 2.7',
               'Programming Language :: Python :: 3',
           ])
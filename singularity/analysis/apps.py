@@ -17,22 +17,35 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
 
-from spython.main import Client
 from singularity.logger import bot
 import sys
 import os
 import re
 import json
+import shlex
+import uuid
 
 
+# Files in /scif/apps/<app>/scif for each inspect attribute
+SCIF_FILES = {'labels': 'labels.json',
+              'environment': 'env/90-environment.sh',
+              'runscript': 'runscript',
+              'test': 'test.sh',
+              'helpfile': 'runscript.help'}
 
-def extract_apps(image, app_names):
+
+def extract_apps(image, app_names, batch=True, workers=None):
     ''' extract app will extract metadata for one or more apps
         Parameters
         ==========
-        image: the absolute path to the image
-        app_name: the name of the app under /scif/apps
+        image: the absolute path to the image (or a sandbox)
+        app_names: the name of the app under /scif/apps
+        batch: read all apps' metadata from /scif/apps in one read of the
+               image (default True). Apps that can't be read this way are
+               inspected one at a time.
+        workers: if defined, the number of inspect calls to run at once
 
+        Apps that fail to inspect have an "error" instead of "inspect".
     '''
     apps = dict()
 
@@ -43,17 +56,115 @@ def extract_apps(image, app_names):
     if len(app_names) == 0:
         return apps
 
+    # Inspect: labels, env, runscript, tests, help
+    if batch:
+        try:
+            for app_name, attributes in read_apps(image, app_names).items():
+                apps[app_name] = {'inspect': {'data': {'attributes': attributes}}}
+        except Exception as e:
+            bot.warning('Cannot read apps from %s, will inspect: %s' %(image, e))
+
+    remaining = [x for x in app_names if x not in apps]
+    if workers is not None and len(remaining) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(lambda x: inspect_app(image, x), remaining)
+            apps.update(zip(remaining, results))
+    else:
+        for app_name in remaining:
+            apps[app_name] = inspect_app(image, app_name)
+    return apps
+
+
+def inspect_app(image, app_name):
+    '''inspect_app will inspect a single app with the Singularity client,
+       returning metadata with the inspection, or the error if it failed
+    '''
+    from spython.main import Client
+    metadata = dict()
+    try:
+        inspection = Client.inspect(image, app=app_name)
+        if not isinstance(inspection, dict):
+            inspection = json.loads(inspection)
+        if 'data' not in inspection:
+            inspection = {'data': inspection}
+        inspection['data']['attributes'].pop('deffile', None)
+        metadata['inspect'] = inspection
+
+    # If illegal characters prevent load, not much we can do
+    except Exception as e:
+        bot.warning('Error inspecting app %s: %s' %(app_name, e))
+        metadata['error'] = str(e)
+    return metadata
+
+
+def read_apps(image, app_names):
+    '''read_apps will read the labels, environment, runscript, test and help
+       for each app from /scif/apps. A sandbox is read directly, and an image
+       with a single exec. Returns attributes for each app found.
+    '''
+    if os.path.isdir(image):
+        return read_sandbox_apps(image, app_names)
+
+    marker = 'SCIF-%s' % uuid.uuid4()
+    script = ('for app in %s; do for f in %s; do p=/scif/apps/$app/scif/$f; '
+              'if [ -f "$p" ]; then echo "%s $app $f"; cat "$p"; echo; fi; '
+              'done; done' %(' '.join(shlex.quote(x) for x in app_names),
+                             ' '.join(SCIF_FILES.values()), marker))
+
+    from spython.main import Client
+    result = Client.execute(image, ['/bin/sh', '-c', script], return_result=True)
+    if result['return_code'] != 0:
+        raise RuntimeError('return code %s' % result['return_code'])
+
+    output = result['message']
+    if isinstance(output, list):
+        output = ''.join(output)
+    return parse_apps_listing(output, marker)
+
+
+def read_sandbox_apps(sandbox, app_names):
+    '''read_sandbox_apps reads app metadata from /scif/apps of a sandbox
+    '''
+    apps = dict()
     for app_name in app_names:
-        metadata = dict()
+        base = os.path.join(sandbox, 'scif', 'apps', app_name, 'scif')
+        contents = dict()
+        for attribute, filename in SCIF_FILES.items():
+            filename = os.path.join(base, filename)
+            if os.path.isfile(filename):
+                with open(filename, 'r', errors='replace') as filey:
+                    contents[attribute] = filey.read()
+        if contents:
+            apps[app_name] = parse_app_attributes(contents)
+    return apps
+
+
+def parse_apps_listing(output, marker):
+    '''parse the output of read_apps, sections of files for each app that
+       start with a line "<marker> <app> <file>"
+    '''
+    attributes = dict((v, k) for k, v in SCIF_FILES.items())
+    parts = re.split('(?:^|\n)%s (\\S+) (\\S+)\n' % re.escape(marker), output)
+
+    # The newline echoed after each file is taken with the next marker
+    if len(parts) > 1 and parts[-1].endswith('\n'):
+        parts[-1] = parts[-1][:-1]
+
+    contents = dict()
+    for i in range(1, len(parts) - 2, 3):
+        app_name, filename, content = parts[i:i + 3]
+        contents.setdefault(app_name, dict())[attributes[filename]] = content
+
+    return dict((k, parse_app_attributes(v)) for k, v in contents.items())
 
-        # Inspect: labels, env, runscript, tests, help
+
+def parse_app_attributes(contents):
+    '''parse the labels (json) of app file contents, if they can be loaded
+    '''
+    if 'labels' in contents:
         try:
-            inspection = json.loads(Client.inspect(image, app=app_name))
-            del inspection['data']['attributes']['deffile']
-            metadata['inspect'] = inspection
-
-        # If illegal characters prevent load, not much we can do
-        except:
-            pass
-        apps[app_name] = metadata
-    return apps
+            contents['labels'] = json.loads(contents['labels'])
+        except ValueError:
+            bot.warning('Cannot load labels as json.')
+    return contents
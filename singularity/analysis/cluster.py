@@ -0,0 +1,150 @@
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+from singularity.logger import bot
+
+
+###################################################################################
+# CLUSTERING ######################################################################
+###################################################################################
+
+
+def get_linkage(matrix=None, distances=None, neighbors=None, method='ward'):
+    '''get_linkage returns a linkage matrix (as from scipy linkage) from one of:
+
+       Parameters
+       ==========
+       matrix: a pandas DataFrame or array, each row an observation
+       distances: a condensed distance vector (as returned by pdist)
+       neighbors: a sparse graph of distances between nearest neighbors (see
+                  knn_graph), clustered with single linkage (see knn_linkage)
+       method: the linkage method for a matrix or distances (default is ward)
+    '''
+    from scipy.cluster.hierarchy import linkage
+
+    if neighbors is not None:
+        return knn_linkage(neighbors)
+    if distances is not None:
+        return linkage(distances, method)
+    if matrix is not None:
+        return linkage(matrix, method)
+    bot.warning('Please provide a matrix, distances, or neighbors graph.')
+
+
+def knn_graph(matrix, k=10, similarity=True, block_size=1000):
+    '''knn_graph will return a sparse graph of distances from each row of a
+    square matrix to its k nearest neighbors. The matrix is read in blocks
+    of rows, so only the graph (n x k) is held in memory.
+
+       Parameters
+       ==========
+       matrix: a square pandas DataFrame or array of similarities (or distances)
+       k: the number of neighbors to keep for each row
+       similarity: if True (default) values are similarities, and the
+                   distance is 1 - similarity
+       block_size: the number of rows to process at once
+    '''
+    from scipy.sparse import csr_matrix
+    import numpy
+
+    values = getattr(matrix, 'values', matrix)
+    n = values.shape[0]
+    k = max(min(k, n - 1), 1)
+
+    rows = []
+    cols = []
+    data = []
+    for start in range(0, n, block_size):
+        block = numpy.array(values[start:start + block_size], dtype=float)
+        if similarity:
+            block = 1.0 - block
+        index = numpy.arange(block.shape[0])
+        block[index, index + start] = numpy.inf   # not your own neighbor
+        block[numpy.isnan(block)] = numpy.inf
+        nearest = numpy.argpartition(block, k - 1, axis=1)[:, :k]
+        rows.append(numpy.repeat(index + start, k))
+        cols.append(nearest.ravel())
+        data.append(block[index[:, None], nearest].ravel())
+
+    rows = numpy.concatenate(rows)
+    cols = numpy.concatenate(cols)
+    data = numpy.concatenate(data)
+    keep = numpy.isfinite(data)
+    return csr_matrix((data[keep], (rows[keep], cols[keep])), shape=(n, n))
+
+
+def knn_linkage(graph):
+    '''knn_linkage will return an (approximate) single linkage matrix from a
+    sparse graph of distances, by way of its minimum spanning tree. With a
+    complete graph this is exactly single linkage. Components that are not
+    connected in the graph are joined at the largest distance.
+
+       Parameters
+       ==========
+       graph: a sparse (n x n) matrix of distances between neighbors
+    '''
+    from scipy.sparse.csgraph import minimum_spanning_tree
+    from scipy.sparse import csr_matrix
+    import numpy
+
+    graph = csr_matrix(graph, dtype=float)
+    n = graph.shape[0]
+
+    # Sparse graphs drop zero distances, so shift all edges up (this
+    # doesn't change the spanning tree) and make the graph symmetric
+    offset = 1.0 - min(graph.data.min(), 0.0) if graph.nnz else 1.0
+    graph.data = graph.data + offset
+    graph = graph.maximum(graph.T)
+    tree = minimum_spanning_tree(graph).tocoo()
+
+    order = numpy.argsort(tree.data, kind='mergesort')
+    edges = zip(tree.row[order], tree.col[order], tree.data[order] - offset)
+    height = float(tree.data.max() - offset) if tree.nnz else 0.0
+
+    # Union find, each root points to its current cluster id and size
+    parents = list(range(n))
+    clusters = list(range(n))
+    sizes = [1] * n
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    Z = []
+    for a, b, distance in edges:
+        a, b = find(a), find(b)
+        if a == b:
+            continue
+        Z.append([clusters[a], clusters[b], max(distance, 0.0), sizes[a] + sizes[b]])
+        parents[b] = a
+        sizes[a] += sizes[b]
+        clusters[a] = n + len(Z) - 1
+
+    # Join any disconnected components at the largest distance
+    roots = sorted(set(find(i) for i in range(n)))
+    a = roots[0]
+    for b in roots[1:]:
+        Z.append([clusters[a], clusters[b], height, sizes[a] + sizes[b]])
+        parents[b] = a
+        sizes[a] += sizes[b]
+        clusters[a] = n + len(Z) - 1
+
+    return numpy.array(Z, dtype=float)
@@ -29,8 +29,6 @@ from singularity.analysis.reproduce import (
 
 from .metrics import information_coefficient
 
-import pandas
-
 
 ###################################################################################
 # CONTAINER COMPARISONS ###########################################################
@@ -47,6 +45,8 @@ def container_similarity_vector(container1=None,packages_set=None,by=None):
     :by: metrics to compare by (files.txt and or folders.txt)
     '''
 
+    import pandas
+
     if by == None:
         by = ['files.txt']
 
@@ -58,7 +58,7 @@ def container_similarity_vector(container1=None,packages_set=None,by=None):
     comparisons = dict()
 
     for b in by:
-        bot.debug("Starting comparisons for %s" %b)
+        bot.debug("Starting comparisons for %s", b)
         df = pandas.DataFrame(columns=packages_set)
         for package2 in packages_set:
             sim = calculate_similarity(container1=container1,
@@ -66,7 +66,7 @@ def container_similarity_vector(container1=None,packages_set=None,by=None):
                                        by=b)[b]
            
             name1 = os.path.basename(package2).replace('.img.zip','')
-            bot.debug("container vs. %s: %s" %(name1,sim))
+            bot.debug("container vs. %s: %s", name1, sim)
             df.loc["container",package2] = sim
         df.columns = [os.path.basename(x).replace('.img.zip','') for x in df.columns.tolist()]
         comparisons[b] = df
@@ -78,6 +78,8 @@ def compare_singularity_images(image_paths1, image_paths2=None):
     singularity containers. If image_paths2 is not defined, pairwise comparison is done
     with image_paths1
     '''
+    import pandas
+
     repeat = False
     if image_paths2 is None:
         image_paths2 = image_paths1
@@ -145,9 +147,11 @@ def compare_lists(list1,list2):
     :param list1: the list for container1
     :param list2: the list for container2
     '''
-    intersect = list(set(list1).intersection(list2))
-    unique1 = list(set(list1).difference(list2))
-    unique2 = list(set(list2).difference(list1))
+    set1 = set(list1)
+    set2 = set(list2)
+    intersect = list(set1 & set2)
+    unique1 = list(set1 - set2)
+    unique2 = list(set2 - set1)
 
     # Return data structure
     comparison = {"intersect":intersect,
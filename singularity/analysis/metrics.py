@@ -38,18 +38,83 @@ def information_coefficient(total1,total2,intersect):
 
 
 def RSA(m1,m2):
-    '''RSA analysis will compare the similarity of two matrices
+    '''RSA analysis will compare the similarity of two matrices, meaning the
+    pearson correlation of their lower triangles (without the diagonal),
+    ignoring pairs where either value is undefined
+    '''
+    return RSA_batch(m1, [m2])[0]
+
+
+def RSA_batch(reference,candidates,indices=None):
+    '''RSA_batch compares one reference matrix to many candidate matrices
+    (of the same shape) in a single vectorized correlation, returning an
+    array with a correlation for each candidate
+    :param reference: the reference matrix (pandas DataFrame or array)
+    :param candidates: a list of matrices, or an array (candidates x n x n)
+    :param indices: the triangle indices from get_triangle_indices, if
+    comparing many batches of the same size
     '''
-    from scipy.stats import pearsonr
-    import scipy.linalg
     import numpy
+    reference = numpy.asarray(reference, dtype=float)
+    if indices is None:
+        indices = get_triangle_indices(reference.shape[0])
+    vectors = numpy.array([numpy.asarray(c, dtype=float)[indices] for c in candidates])
+    return correlate_vectors(reference[indices], vectors)
+
+
+def RSA_permutation(m1,m2,permutations=1000,block_size=100,seed=None):
+    '''RSA_permutation returns the RSA correlation of two matrices, and a
+    (two sided) p-value from a permutation (Mantel) test, shuffling the rows
+    and columns of m2 together. Permutations are scored in blocks.
+    :param m1: the first matrix (pandas DataFrame or array)
+    :param m2: the second matrix, shuffled for the null distribution
+    :param permutations: the number of permutations (default 1000)
+    :param block_size: the number of permutations to score at once
+    :param seed: a seed for the random number generator
+    '''
+    import numpy
+    m1 = numpy.asarray(m1, dtype=float)
+    m2 = numpy.asarray(m2, dtype=float)
+    n = m1.shape[0]
+    rows, cols = get_triangle_indices(n)
+    reference = m1[rows, cols]
+
+    r = correlate_vectors(reference, m2[rows, cols][None, :])[0]
+    random = numpy.random.RandomState(seed)
+
+    extreme = 0
+    done = 0
+    while done < permutations:
+        size = min(block_size, permutations - done)
+        orders = numpy.array([random.permutation(n) for _ in range(size)])
+        null = correlate_vectors(reference, m2[orders[:, rows], orders[:, cols]])
+        extreme += numpy.sum(numpy.abs(null) >= abs(r))
+        done += size
 
-    # This will take the diagonal of each matrix (and the other half is changed to nan) and flatten to vector
-    vectorm1 = m1.mask(numpy.triu(numpy.ones(m1.shape)).astype(numpy.bool)).values.flatten()
-    vectorm2 = m2.mask(numpy.triu(numpy.ones(m2.shape)).astype(numpy.bool)).values.flatten()
-    # Now remove the nans
-    m1defined = numpy.argwhere(~numpy.isnan(numpy.array(vectorm1,dtype=float)))
-    m2defined = numpy.argwhere(~numpy.isnan(numpy.array(vectorm2,dtype=float)))
-    idx = numpy.intersect1d(m1defined,m2defined)
-    return pearsonr(vectorm1[idx],vectorm2[idx])[0]
+    return r, (extreme + 1.0) / (permutations + 1.0)
+
+
+def get_triangle_indices(n):
+    '''get the indices of the lower triangle (without the diagonal) of an
+    n x n matrix, the values compared by RSA
+    '''
+    import numpy
+    return numpy.tril_indices(n, k=-1)
+
+
+def correlate_vectors(reference,vectors):
+    '''correlate_vectors returns the pearson correlation of a reference vector
+    with each row of a 2D array of vectors, for each using only the entries
+    defined (not nan) in both
+    '''
+    import numpy
+    vectors = numpy.asarray(vectors, dtype=float)
+    defined = ~numpy.isnan(vectors) & ~numpy.isnan(reference)
+    count = defined.sum(axis=1)
 
+    x = numpy.where(defined, vectors, 0.0)
+    y = numpy.where(defined, reference, 0.0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        x = (x - (x.sum(axis=1) / count)[:, None]) * defined
+        y = (y - (y.sum(axis=1) / count)[:, None]) * defined
+        return (x * y).sum(axis=1) / numpy.sqrt((x * x).sum(axis=1) * (y * y).sum(axis=1))
@@ -1,22 +1,26 @@
-from .levels import (
-    get_custom_level,
-    get_level,
-    get_levels,
-    make_levels_set,
-    modify_level,
-)
+from singularity.utils import lazy_attributes
 
-from .hash import (
-    get_image_hash,
-    get_image_hashes,
-    get_image_file_hash,
-    get_content_hashes
-)
+# Functions are imported from their modules when first used
+imports = {
+    'get_custom_level': ('.levels', 'get_custom_level'),
+    'get_level': ('.levels', 'get_level'),
+    'get_levels': ('.levels', 'get_levels'),
+    'make_levels_set': ('.levels', 'make_levels_set'),
+    'modify_level': ('.levels', 'modify_level'),
+    'get_image_hash': ('.hash', 'get_image_hash'),
+    'get_image_hashes': ('.hash', 'get_image_hashes'),
+    'get_image_file_hash': ('.hash', 'get_image_file_hash'),
+    'get_content_hashes': ('.hash', 'get_content_hashes'),
+    'extract_content': ('.utils', 'extract_content'),
+    'delete_image_tar': ('.utils', 'delete_image_tar'),
+    'get_image_tar': ('.utils', 'get_image_tar'),
+    'assess_differences': ('.metrics', 'assess_differences'),
+    'hash_images': ('.batch', 'hash_images'),
+    'get_scratch': ('.scratch', 'get_scratch'),
+    'ScratchSpace': ('.scratch', 'ScratchSpace'),
+    'get_export_cache': ('.exports', 'get_export_cache'),
+    'ExportCache': ('.exports', 'ExportCache')
+}
 
-from .utils import (
-    extract_content,
-    delete_image_tar,
-    get_image_tar
-)
-
-from .metrics import assess_differences
+__all__ = list(imports)
+__getattr__, __dir__ = lazy_attributes(__name__, imports)
@@ -0,0 +1,245 @@
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+from singularity.logger import bot
+from .levels import get_levels
+from .hash import get_image_hashes
+from .utils import can_stream
+
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    as_completed
+)
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tarfile
+import time
+
+
+################################################################################
+# Batch Hashing
+################################################################################
+
+# A worker process holds an export slot while an exported image is on disk.
+# Each worker has its own scratch space (see get_scratch), so with a scratch
+# quota the disk used can be the number of workers times the quota.
+export_slots = None
+
+
+def read_manifest(manifest):
+    '''read_manifest returns the image paths of a manifest, a file with one
+    path per line (blank lines and # comments are skipped) or a json list.
+    '''
+    with open(manifest, 'r') as filey:
+        content = filey.read()
+
+    if content.lstrip().startswith('['):
+        return json.loads(content)
+
+    images = []
+    for line in content.split('\n'):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            images.append(line)
+    return images
+
+
+def load_checkpoint(checkpoint):
+    '''load_checkpoint returns the records (by image) of a checkpoint, a file
+    with one json record per line. A partial last line (from a run that was
+    killed while writing) is ignored.
+    '''
+    records = dict()
+    if checkpoint is None or not os.path.exists(checkpoint):
+        return records
+
+    with open(checkpoint, 'r') as filey:
+        for line in filey:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['image']] = record
+    return records
+
+
+def needs_export(image_path):
+    '''an image needs an export (disk) to be hashed, unlike a sandbox, a tar
+    or an image read as a stream (see can_stream)'''
+    if os.path.isdir(image_path) or tarfile.is_tarfile(image_path):
+        return False
+    return not can_stream(image_path)
+
+
+def init_worker(slots):
+    global export_slots
+    export_slots = slots
+
+
+def hash_image(image_path, version=None, level_names=None):
+    '''hash_image returns the record of one image: its hashes for each level
+    and the seconds taken, or the error. An image that needs an export waits
+    for an export slot first (see hash_images).
+    '''
+    start = time.time()
+    record = {'image': image_path}
+    try:
+        levels = get_levels(version=version)
+        if level_names is not None:
+            levels = dict((k, v) for k, v in levels.items() if k in level_names)
+
+        if export_slots is not None and needs_export(image_path):
+            with export_slots:
+                record['hashes'] = get_image_hashes(image_path, levels=levels)
+        else:
+            record['hashes'] = get_image_hashes(image_path, levels=levels)
+
+    # A bad image shouldn't end the batch (SystemExit after bot.error)
+    except (Exception, SystemExit) as e:
+        record['error'] = "%s: %s" %(e.__class__.__name__, e)
+
+    record['seconds'] = round(time.time() - start, 3)
+    return record
+
+
+def hash_images(images, checkpoint=None, workers=None, exports=None,
+                version=None, level_names=None, retry_errors=False):
+    '''hash_images is a generator of the records (see hash_image) of many
+    images, yielded as each finishes. Images are hashed in a pool of
+    processes, with a bounded number of exports at once to cap the disk
+    used. Each record is appended to the checkpoint, so a run that stopped
+    continues with the images that weren't done. A scratch quota
+    (SINGULARITY_SCRATCH_QUOTA) is for each worker process, so exports can
+    use up to the quota for each worker holding an export slot.
+
+    Parameters
+    ==========
+    images: the image paths (e.g., from read_manifest)
+    checkpoint: a file to append records to (one json record per line)
+    workers: the number of processes (default is the number of cpus). With
+             one worker, images are hashed in this process.
+    exports: the most images exported to disk at once (default 2). Images
+             read as a stream don't need a slot.
+    version: the version of the levels (see get_levels)
+    level_names: only hash these levels (default is all)
+    retry_errors: hash images that failed in the checkpoint again
+    '''
+    workers = workers or os.cpu_count() or 1
+    exports = exports or 2
+
+    done = load_checkpoint(checkpoint)
+    if retry_errors:
+        done = dict((k, v) for k, v in done.items() if 'error' not in v)
+
+    images = list(dict.fromkeys(images))
+    remaining = [x for x in images if x not in done]
+    if len(remaining) < len(images):
+        bot.info("Found %s images in checkpoint, %s to hash." %(len(images) - len(remaining),
+                                                                len(remaining)))
+
+    filey = None
+    if checkpoint is not None:
+        filey = open(checkpoint, 'a+')
+
+        # Records start on a new line, after any partial one
+        if filey.tell() > 0:
+            filey.seek(filey.tell() - 1)
+            if filey.read(1) != '\n':
+                filey.write('\n')
+
+    def save(record):
+        if filey is not None:
+            filey.write(json.dumps(record) + '\n')
+            filey.flush()
+
+    try:
+        if workers == 1:
+            for image_path in remaining:
+                record = hash_image(image_path, version, level_names)
+                save(record)
+                yield record
+            return
+
+        slots = multiprocessing.BoundedSemaphore(exports)
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=init_worker,
+                                 initargs=(slots,)) as executor:
+            futures = [executor.submit(hash_image, x, version, level_names)
+                       for x in remaining]
+            try:
+                for future in as_completed(futures):
+                    record = future.result()
+                    save(record)
+                    yield record
+            finally:
+                for future in futures:
+                    future.cancel()
+    finally:
+        if filey is not None:
+            filey.close()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description="hash singularity images (of a manifest) at each level")
+    parser.add_argument('manifest',
+                        help="a file with one image path per line (or a json list)")
+    parser.add_argument('--checkpoint', default=None,
+                        help="append results (json lines) to this file, and skip images in it")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="processes to hash with (default is the number of cpus)")
+    parser.add_argument('--exports', type=int, default=2,
+                        help="the most images exported at once")
+    parser.add_argument('--levels', nargs='+', default=None,
+                        help="only hash these levels")
+    parser.add_argument('--version', default=None,
+                        help="the version of the levels (2.2 or 2.3)")
+    parser.add_argument('--retry-errors', action='store_true', dest='retry_errors',
+                        help="hash images that failed in the checkpoint again")
+    return parser
+
+
+def main():
+    '''main is the entrypoint of singularity-hash, results are printed as
+    json lines as they finish'''
+    args = get_parser().parse_args()
+    images = read_manifest(args.manifest)
+    errors = 0
+    for record in hash_images(images,
+                              checkpoint=args.checkpoint,
+                              workers=args.workers,
+                              exports=args.exports,
+                              version=args.version,
+                              level_names=args.levels,
+                              retry_errors=args.retry_errors):
+        if 'error' in record:
+            errors += 1
+        sys.stdout.write(json.dumps(record) + '\n')
+        sys.stdout.flush()
+
+    if errors:
+        bot.warning("%s images could not be hashed." %errors)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
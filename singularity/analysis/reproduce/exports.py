@@ -0,0 +1,219 @@
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+from singularity.logger import bot
+from singularity.logger.stats import get_stats
+from .scratch import (
+    get_export_size,
+    get_scratch,
+    parse_size
+)
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import os
+import threading
+
+
+################################################################################
+# Export Cache
+################################################################################
+
+# An image analyzed more than once (e.g., compared, then classified) is
+# exported once. The sandbox is shared, so it must not be changed.
+
+
+def get_export_key(image_path):
+    '''get_export_key identifies the content of an image by its path, size
+    and modification time, without reading it'''
+    stat = os.stat(image_path)
+    return (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns)
+
+
+class ExportEntry(object):
+    '''an exported sandbox, in a folder of the scratch space, with the number
+    of contexts using it'''
+    def __init__(self, sandbox, folder, size):
+        self.sandbox = sandbox
+        self.folder = folder
+        self.size = size
+        self.refs = 0
+
+
+class ExportCache(object):
+    '''ExportCache keeps exported sandboxes of images for reuse. Sandboxes
+    not in use are removed, least recently used first, to stay under the
+    budget, or to make room in the scratch space for another export.
+
+    Parameters
+    ==========
+    budget: the most bytes of sandboxes to keep (see get_export_size)
+    scratch: the ScratchSpace to export to (default get_scratch)
+    '''
+    def __init__(self, budget, scratch=None):
+        self.budget = parse_size(budget)
+        self.scratch = scratch or get_scratch()
+        self.entries = OrderedDict()
+        self.pending = dict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+
+    def __str__(self):
+        return "ExportCache:%s" %len(self.entries)
+
+
+    def holding(self):
+        '''holding returns True if the current thread uses a sandbox'''
+        return getattr(self.local, 'refs', 0) > 0
+
+
+    @property
+    def size(self):
+        '''the bytes of the sandboxes kept'''
+        return sum(x.size for x in self.entries.values())
+
+
+    @contextmanager
+    def sandbox(self, image_path, export, stats=None):
+        '''sandbox is the exported sandbox of an image for a context, reused
+        if the image was exported before. An image is only exported once at
+        a time, other contexts for it wait and share the result.
+        :param export: exports an image to a folder, returns the sandbox
+        :param stats: a Stats to count export_cache_hits and misses
+        '''
+        stats = get_stats(stats)
+        key = get_export_key(image_path)
+
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    entry.refs += 1
+                    self.entries.move_to_end(key)
+                    stats.count('export_cache_hits')
+                    break
+                exporting = self.pending.get(key)
+                if exporting is None:
+                    exporting = self.pending[key] = threading.Event()
+                    break
+            exporting.wait()
+
+        if entry is None:
+            stats.count('export_cache_misses')
+            try:
+                entry = self.export(image_path, export)
+                with self.lock:
+                    entry.refs += 1
+                    self.entries[key] = entry
+            finally:
+                with self.lock:
+                    self.pending.pop(key).set()
+
+        self.local.refs = getattr(self.local, 'refs', 0) + 1
+        try:
+            yield entry.sandbox
+        finally:
+            self.local.refs -= 1
+            with self.lock:
+                entry.refs -= 1
+            self.make_room()
+
+
+    def export(self, image_path, export):
+        '''export an image to a new folder of the scratch space. While
+        waiting for space, sandboxes that are no longer in use are removed
+        to make room. A thread that uses a sandbox doesn't wait (see
+        ScratchSpace.reserve), it would wait on itself.
+        '''
+        size = get_export_size(image_path)
+        wait = not self.holding() and not self.scratch.holding()
+        while True:
+            self.make_room(size)
+            try:
+                folder = self.scratch.reserve(size, prefix='cache-',
+                                              timeout=1 if wait else None,
+                                              wait=wait,
+                                              owned=False)
+                break
+            except TimeoutError:
+                pass
+        try:
+            sandbox = export(image_path, folder)
+        except BaseException:
+            self.scratch.release(folder)
+            raise
+        bot.debug("Exported %s to cache", image_path)
+        return ExportEntry(sandbox, folder, size)
+
+
+    def make_room(self, size=0):
+        '''remove sandboxes not in use, least recently used first, until size
+        bytes more fit in the budget and the scratch quota'''
+        removed = []
+        with self.lock:
+            quota = self.scratch.quota
+
+            # Removed sandboxes are released after, count them as free
+            freed = 0
+            for key, entry in list(self.entries.items()):
+                over_budget = self.size + size > self.budget
+                over_quota = (quota is not None and
+                              self.scratch.reserved - freed + size > quota)
+                if not over_budget and not over_quota:
+                    break
+                if entry.refs == 0:
+                    removed.append(self.entries.pop(key))
+                    freed += entry.size
+
+        for entry in removed:
+            self.scratch.release(entry.folder)
+
+
+    def clear(self):
+        '''remove all sandboxes not in use'''
+        with self.lock:
+            removed = [self.entries.pop(k) for k, v in list(self.entries.items())
+                       if v.refs == 0]
+        for entry in removed:
+            self.scratch.release(entry.folder)
+
+
+export_cache = None
+
+
+def get_export_cache(refresh=False):
+    '''get_export_cache returns the export cache of the process, or None if
+    it's not enabled. It's enabled with a budget for the sandboxes kept in
+    SINGULARITY_EXPORT_CACHE_SIZE (e.g., 20G) and exports to the scratch
+    space (see get_scratch).
+    '''
+    global export_cache
+    budget = parse_size(os.environ.get('SINGULARITY_EXPORT_CACHE_SIZE') or 0)
+    if (export_cache is not None and not refresh and
+            export_cache.budget == budget and
+            export_cache.scratch is get_scratch()):
+        return export_cache
+
+    if export_cache is not None:
+        export_cache.clear()
+    export_cache = None
+    if budget:
+        export_cache = ExportCache(budget)
+    return export_cache
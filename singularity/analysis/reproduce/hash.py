@@ -17,52 +17,42 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
 
-from spython.main import Client
 from singularity.logger import bot
+from singularity.logger.stats import get_stats
 from singularity.analysis.reproduce.criteria import *
 from singularity.analysis.reproduce.levels import *
 from singularity.analysis.reproduce.utils import (
+    can_stream,
     get_image_tar,
     extract_content,
     delete_image_tar,
-    extract_guts
+    extract_guts,
+    stream_image_tar
 )
+from contextlib import contextmanager
 import datetime
 import hashlib
 import sys
 import os
 import io
 import re
+import time
 
 
-Client.quiet = True
-
-def get_image_hashes(image_path, version=None, levels=None):
+def get_image_hashes(image_path, version=None, levels=None, stats=None,
+                     stream=None):
     '''get_image_hashes returns the hash for an image across all levels. This is the quickest,
-    easiest way to define a container's reproducibility on each level.
+    easiest way to define a container's reproducibility on each level. The
+    tar of the image is read once, for all levels.
+    :param stats: a Stats to record stages and counters (see get_image_hash)
+    :param stream: read the export as a stream, without a tar on disk (see
+    stream_image_tar). The default is to stream when possible (can_stream)
     '''
     if levels is None:
         levels = get_levels(version=version)
-    hashes = dict()
-
-    # use a cached object for all
-    file_obj, tar = get_image_tar(image_path)
-
-    for level_name, level_filter in levels.items():
-        hashes[level_name] = get_image_hash(image_path,
-                                            level_filter=level_filter,
-                                            file_obj=file_obj,
-                                            tar=tar)
-
-    try:
-        file_obj.close()
-    except:
-        tar.close()
- 
-    if os.path.exists(file_obj):
-        os.remove(file_obj)
 
-    return hashes
+    with image_tar(image_path, stream=stream, stats=stats) as tar:
+        return hash_members(tar, levels, stats=stats)
 
 
 
@@ -73,7 +63,9 @@ def get_image_hash(image_path,
                    skip_files=None,
                    version=None,
                    file_obj=None,
-                   tar=None):
+                   tar=None,
+                   stats=None,
+                   stream=None):
 
     '''get_image_hash will generate a sha1 hash of an image, depending on a level
     of reproducibility specified by the user. (see function get_levels for descriptions)
@@ -83,6 +75,9 @@ def get_image_hash(image_path,
     :param skip_files: an optional list of files to skip
     :param include_files: an optional list of files to keep (only if level not defined)
     :param version: the version to use. If not defined, default is 2.3
+    :param stats: a Stats to record the export, tar and hash stages, and
+    files visited, hashed and skipped, and bytes read
+    :param stream: read the export as a stream (see get_image_hashes)
 
     ::notes
 
@@ -107,12 +102,47 @@ def get_image_hash(image_path,
                                 skip_files=skip_files,
                                 include_files=include_files)
 
-    close = False
-    if file_obj is None and tar is None:               
-        file_obj, tar = get_image_tar(image_path)
-        close = True
+    levels = {'level': file_filter}
+    if tar is not None:
+        return hash_members(tar, levels, stats=stats)['level']
 
-    hasher = hashlib.md5()
+    with image_tar(image_path, stream=stream, stats=stats) as tar:
+        return hash_members(tar, levels, stats=stats)['level']
+
+
+@contextmanager
+def image_tar(image_path, stream=None, stats=None):
+    '''image_tar is the tar of an image for a context, either streamed from
+    the export (see stream_image_tar) or from get_image_tar, and deleted at
+    the end.
+    '''
+    if stream is None:
+        stream = can_stream(image_path)
+
+    if stream:
+        with stream_image_tar(image_path) as tar:
+            yield tar
+        return
+
+    file_obj, tar = get_image_tar(image_path, stats=stats)
+    try:
+        yield tar
+    finally:
+        delete_image_tar(file_obj, tar)
+
+
+def hash_members(tar, levels, stats=None):
+    '''hash_members returns the md5 hash of the members of a tar for each
+    level, in one pass through the tar (so it can be a stream). A file of a
+    level is hashed by content ("assess_content") or by its header.
+    :param levels: a lookup of level names to level filters
+    :param stats: a Stats to record the hash stage, and files visited, hashed
+    (for any level) and skipped, and bytes read
+    '''
+    stats = get_stats(stats)
+    hashers = dict((name, hashlib.md5()) for name in levels)
+    hash_start = time.perf_counter()
+    visited = hashed = bytes_read = 0
 
     for member in tar:
         member_name = member.name.replace('.','',1)
@@ -120,26 +150,30 @@ def get_image_hash(image_path,
         # For files, we either assess content, or include the file
         if member.isdir() or member.issym():
             continue
-        elif assess_content(member, file_filter):
-            content = extract_content(image_path, member.name)
-            hasher.update(content)
-        elif include_file(member.name, file_filter):
-            buf = member.tobuf()
-            hasher.update(buf)
-
-    digest = hasher.hexdigest()
-
-    # Close up / remove files
-    if close is True:
-        try:
-            file_obj.close()
-        except:
-            tar.close()
- 
-        if os.path.exists(file_obj):
-            os.remove(file_obj)
-
-    return digest
+        visited += 1
+        content = buf = None
+        for level_name, file_filter in levels.items():
+            if assess_content(member_name, file_filter):
+                if content is None:
+                    content = tar.extractfile(member)
+                    content = b'' if content is None else content.read()
+                    bytes_read += len(content)
+                hashers[level_name].update(content)
+            elif include_file(member_name, file_filter):
+                if buf is None:
+                    buf = member.tobuf()
+                hashers[level_name].update(buf)
+        if content is not None or buf is not None:
+            hashed += 1
+
+    if stats:
+        stats.add_time('hash', time.perf_counter() - hash_start)
+        stats.count('files_visited', visited)
+        stats.count('files_hashed', hashed)
+        stats.count('files_skipped', visited - hashed)
+        stats.count('bytes_read', bytes_read)
+
+    return dict((name, hasher.hexdigest()) for name, hasher in hashers.items())
 
 
 def get_content_hashes(image_path,
@@ -150,12 +184,14 @@ def get_content_hashes(image_path,
                        level_filter=None,
                        skip_files=None,
                        version=None,
-                       include_sizes=True):
+                       include_sizes=True,
+                       stats=None):
 
     '''get_content_hashes is like get_image_hash, but it returns a complete dictionary 
     of file names (keys) and their respective hashes (values). This function is intended
     for more research purposes and was used to generate the levels in the first place.
     If include_sizes is True, we include a second data structure with sizes
+    With stats (a Stats), stages and counters are recorded (see extract_guts)
     '''    
 
     if level_filter is not None:
@@ -174,7 +210,8 @@ def get_content_hashes(image_path,
     results = extract_guts(image_path=image_path,
                            file_filter=file_filter,
                            tag_root=tag_root,
-                           include_sizes=include_sizes)
+                           include_sizes=include_sizes,
+                           stats=stats)
 
     return results
 
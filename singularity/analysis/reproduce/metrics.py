@@ -17,14 +17,18 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
 
-from spython.utils import get_singularity_version
-from spython.main import Client
 from singularity.logger import bot
+from singularity.logger.stats import get_stats
 from .levels import get_levels
-from .utils import extract_content
+from .utils import (
+    exported_images,
+    extract_content
+)
 from .hash import get_content_hashes
+from contextlib import ExitStack
 import os
 import re
+import time
 
 def assess_differences(image_file1,
                        image_file2,
@@ -32,25 +36,52 @@ def assess_differences(image_file1,
                        version=None,
                        size_heuristic=False,
                        guts1=None,
-                       guts2=None):
+                       guts2=None,
+                       stats=None):
 
     '''assess_differences will compare two images on each level of 
     reproducibility, returning for each level a dictionary with files
     that are the same, different, and an overall score.
     :param size_heuristic: if True, assess root owned files based on size
     :param guts1,guts2: the result (dict with sizes,roots,etc) from get_content_hashes
+    :param stats: a Stats to record the export, walk, hash and compare stages,
+    file counters, and levels compared with guts passed in (cache_hits). The
+    stats are also added to the reports.
     '''
+    stats = get_stats(stats)
     if levels is None:
         levels = get_levels(version=version)
 
+    # Images are exported once (unless sandboxes), together, and removed after
+    with ExitStack() as stack:
+        with stats.timer('export'):
+            image_file1, image_file2 = stack.enter_context(
+                exported_images([image_file1, image_file2], stats))
+        reports = compare_levels(image_file1, image_file2, levels,
+                                 size_heuristic=size_heuristic,
+                                 guts1=guts1,
+                                 guts2=guts2,
+                                 stats=stats)
+
+    if stats:
+        reports['stats'] = stats.to_dict()
+    return reports
+
+
+def compare_levels(sandbox1, sandbox2, levels, size_heuristic=False,
+                   guts1=None, guts2=None, stats=None):
+    '''compare_levels compares two sandboxes on each level for
+    assess_differences, returning the reports and scores. Guts are hashed
+    for each level, unless passed in.
+    '''
+    stats = get_stats(stats)
+    image_file1 = sandbox1
+    image_file2 = sandbox2
+    given1 = guts1
+    given2 = guts2
     reports = dict()
     scores = dict()
 
-    # For version 3, export sandboxes
-    if 'version 3' in get_singularity_version():
-        image_file1 = Client.export(image_file1)
-        image_file2 = Client.export(image_file2)
-
     for level_name, level_filter in levels.items():
         contenders = []
         different = []
@@ -58,15 +89,25 @@ def assess_differences(image_file1,
         same = 0
 
         # Compare the dictionary of file:hash between two images, and get root owned lookup
-        if guts1 is None:
+        if given1 is None:
             guts1 = get_content_hashes(image_path=image_file1,
-                                       level_filter=level_filter)
+                                       level_filter=level_filter,
+                                       stats=stats)
                                        # tag_root=True
                                        # include_sizes=True
+        else:
+            guts1 = given1
+            stats.count('cache_hits')
         
-        if guts2 is None:
+        if given2 is None:
             guts2 = get_content_hashes(image_path=image_file2,
-                                       level_filter=level_filter)
+                                       level_filter=level_filter,
+                                       stats=stats)
+        else:
+            guts2 = given2
+            stats.count('cache_hits')
+
+        compare_start = time.perf_counter()
       
         files = list(set(list(guts1['hashes'].keys()) + list(guts2['hashes'].keys())))
 
@@ -110,12 +151,8 @@ def assess_differences(image_file1,
 
                 for rogue in contenders:
 
-                    if 'version 3' in get_singularity_version():
-                        hashy1 = extract_content(image_file1 + rogue, return_hash=True)
-                        hashy2 = extract_content(image_file2 + rogue, return_hash=True)
-                    else:
-                        hashy1 = extract_content(rogue, return_hash=True)
-                        hashy2 = extract_content(rogue, return_hash=True)        
+                    hashy1 = extract_content(image_file1 + rogue, return_hash=True)
+                    hashy2 = extract_content(image_file2 + rogue, return_hash=True)
 
                     # If we can't compare, we use size as a heuristic
                     if hashy1 is None or hashy2 is None: # if one is symlink, could be None
@@ -147,6 +184,9 @@ def assess_differences(image_file1,
         else:
             scores[level_name] = 2*(same) / union
         reports[level_name] = report
+        if stats:
+            stats.add_time('compare', time.perf_counter() - compare_start)
+            stats.count('contenders', len(contenders))
 
     reports['scores'] = scores
     return reports
@@ -0,0 +1,201 @@
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+from singularity.logger import bot
+from singularity.utils import parse_size
+from contextlib import contextmanager
+
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+
+
+################################################################################
+# Scratch Space
+################################################################################
+
+# Exports (sandboxes and tars) go in folders reserved from the scratch space,
+# with the disk they are expected to use. When the reservations would go over
+# the quota, the next export waits for one to be released. A reservation is
+# removed when it's released, at the latest when the process exits.
+
+
+def get_size(path):
+    '''get_size returns the bytes of the files under a path (or of a file)'''
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                total += os.lstat(os.path.join(root, filename)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class ScratchSpace(object):
+    '''ScratchSpace reserves folders for exports under a root, within a quota.
+
+    Parameters
+    ==========
+    root: the folder for reservations (default SINGULARITY_SCRATCH, or the
+          temporary folder)
+    quota: the most bytes reserved at once (default SINGULARITY_SCRATCH_QUOTA,
+           e.g., 20G, or no quota)
+    '''
+    def __init__(self, root=None, quota=None):
+        if root is None:
+            root = os.environ.get('SINGULARITY_SCRATCH', tempfile.gettempdir())
+        if quota is None:
+            quota = os.environ.get('SINGULARITY_SCRATCH_QUOTA')
+
+        self.root = os.path.abspath(root)
+        self.quota = parse_size(quota)
+        self.reservations = dict()
+        self.owners = dict()
+        self.condition = threading.Condition()
+
+
+    def __str__(self):
+        return "ScratchSpace:%s" %self.root
+
+
+    @property
+    def reserved(self):
+        '''the bytes reserved now'''
+        return sum(self.reservations.values())
+
+
+    def holding(self):
+        '''holding returns True if the current thread holds a reservation'''
+        return threading.get_ident() in self.owners.values()
+
+
+    def reserve(self, size=0, prefix='export-', timeout=None, wait=None,
+                owned=True):
+        '''reserve returns a new folder for size bytes, waiting while the
+        reservations would go over the quota. A reservation bigger than the
+        quota waits until it's the only one. A thread that holds a
+        reservation doesn't wait (it would wait on itself), and may go over
+        the quota: reserve what's needed at once to stay under it.
+        :param size: the bytes the folder is expected to use
+        :param timeout: the most seconds to wait (default forever)
+        :param wait: wait for space (default, unless the thread holds some)
+        :param owned: the reservation is held by the current thread until
+        it's released. Otherwise (e.g., for a cache) the owner tracks its use.
+        '''
+        size = max(int(size or 0), 0)
+        with self.condition:
+            if wait is None:
+                wait = not self.holding()
+            if self.quota is not None:
+                if size > self.quota:
+                    bot.warning("%s bytes are more than the scratch quota %s."
+                                %(size, self.quota))
+                def free():
+                    return (not self.reservations or
+                            self.reserved + size <= self.quota)
+                if not free():
+                    if wait:
+                        bot.debug("Waiting for %s bytes of scratch space...", size)
+                    else:
+                        bot.debug("Going over the scratch quota for %s bytes, "
+                                  "the space held isn't released yet.", size)
+                if wait and not self.condition.wait_for(free, timeout=timeout):
+                    raise TimeoutError("No scratch space for %s bytes after %s seconds"
+                                       %(size, timeout))
+
+            if not os.path.exists(self.root):
+                os.makedirs(self.root)
+            path = tempfile.mkdtemp(prefix=prefix, dir=self.root)
+            self.reservations[path] = size
+            if owned:
+                self.owners[path] = threading.get_ident()
+        return path
+
+
+    def release(self, path):
+        '''release removes a reserved folder (or the one a path is in), and
+        frees its space. Returns True if a reservation was released.
+        '''
+        reservation = self.find(path)
+        if reservation is None:
+            return False
+        shutil.rmtree(reservation, ignore_errors=True)
+        with self.condition:
+            self.reservations.pop(reservation, None)
+            self.owners.pop(reservation, None)
+            self.condition.notify_all()
+        return True
+
+
+    def find(self, path):
+        '''find returns the reservation a path is in, or None'''
+        if not isinstance(path, str):
+            return None
+        path = os.path.abspath(path)
+        with self.condition:
+            for reservation in self.reservations:
+                if path == reservation or path.startswith(reservation + os.sep):
+                    return reservation
+        return None
+
+
+    @contextmanager
+    def space(self, size=0, prefix='export-', timeout=None):
+        '''space is a reserved folder, removed at the end of the context even
+        if there is an error (see reserve)'''
+        path = self.reserve(size, prefix=prefix, timeout=timeout)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+
+    def cleanup(self):
+        '''release all reservations'''
+        for path in list(self.reservations):
+            self.release(path)
+
+
+scratch = None
+
+
+def get_scratch(refresh=False):
+    '''get_scratch returns the scratch space of the process, created when
+    first needed (or again, with refresh) from the environment'''
+    global scratch
+    if scratch is None or refresh:
+        if scratch is None:
+            atexit.register(lambda: scratch.cleanup())
+        else:
+            scratch.cleanup()
+        scratch = ScratchSpace()
+    return scratch
+
+
+def get_export_size(image_path):
+    '''get_export_size estimates the bytes an export of an image uses, the
+    size of the image times SINGULARITY_SCRATCH_EXPANSION (default 3, for a
+    compressed image)'''
+    expansion = float(os.environ.get('SINGULARITY_SCRATCH_EXPANSION', 3))
+    return int(get_size(image_path) * expansion)
@@ -17,29 +17,51 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
 
-from spython.main import Client
-from spython.utils import get_singularity_version
+from singularity.utils import get_runtime
 from .criteria import (
     assess_content, 
     include_file,
     is_root_owned
 )
 from .levels import get_level
+from .exports import get_export_cache
+from .scratch import (
+    get_export_size,
+    get_scratch,
+    get_size
+)
 from singularity.logger import bot
+from singularity.logger.stats import get_stats
+from contextlib import (
+    ExitStack,
+    contextmanager
+)
 import hashlib
+import shutil
+import subprocess
 import tarfile
 import tempfile
+import time
 import sys
 import os
 import re
 import io
 
-Client.quiet = True
+
+def get_client():
+    '''get_client returns the (quiet) spython Client. It's imported when
+    first needed instead of with the module, to keep imports fast.
+    '''
+    from spython.main import Client
+    Client.quiet = True
+    return Client
+
 
 def extract_guts(image_path,
                  file_filter=None,
                  tag_root=True,
-                 include_sizes=True):
+                 include_sizes=True,
+                 stats=None):
 
     '''extract the file guts from an image. 
 
@@ -49,7 +71,11 @@ def extract_guts(image_path,
        file_filter: the file filter to extract guts for.
        tag_root: if True (default) include if root owned or not.
        include_sizes: include content sizes (defaults to True)
+       stats: a Stats to record the export and walk (including hash) stages,
+              and files visited, hashed and skipped, and bytes read. The
+              stats are also added to the results.
     '''
+    stats = get_stats(stats)
     if file_filter is None:
         file_filter = get_level('IDENTICAL')
 
@@ -63,29 +89,46 @@ def extract_guts(image_path,
     if include_sizes: 
         sizes = dict()
 
-    # Option 1: We are given a sandbox
-    if os.path.isdir(image_path):
-        sandbox = image_path
+    # A sandbox is walked as is, anything else is exported to scratch space
+    with ExitStack() as stack:
+        with stats.timer('export'):
+            sandbox = stack.enter_context(exported_image(image_path, stats))
+        walk_guts(sandbox, file_filter, allfiles, digest,
+                  roots if tag_root else None,
+                  sizes if include_sizes else None,
+                  stats)
 
-    # Option 2: it's not a sandbox, and we need to export.
-    elif 'version 3' in get_singularity_version():
-        sandbox = Client.export(image_path)
-    else:
-        sandbox = Client.image.export(image_path)
+    if stats:
+        results['stats'] = stats.to_dict()
+
+    results['all'] = allfiles
+    results['hashes'] = digest
+    if include_sizes:
+        results['sizes'] = sizes
+    if tag_root:
+        results['root_owned'] = roots
+    return results
 
-    # If it's tar, extract
-    if os.path.isfile(sandbox) and sandbox.endswith('tar'):
-        with tarfile.open(sandbox) as tar:
-            sandbox = os.path.join(os.path.dirname(sandbox), 'sandbox') 
-            tar.extractall(path=sandbox)
 
-    # Recursively walk through sandbox
+def walk_guts(sandbox, file_filter, allfiles, digest, roots=None, sizes=None,
+              stats=None):
+    '''walk_guts walks through a sandbox for extract_guts, adding to the
+    list of all files, and the lookups of hashes, and (if not None) roots and
+    sizes of included files. Members are named from the base of the sandbox (/)
+    '''
+    stats = get_stats(stats)
+    tag_root = roots is not None
+    include_sizes = sizes is not None
+    walk_start = time.perf_counter()
+    visited = hashed = bytes_read = 0
+    sandbox = sandbox.rstrip(os.sep)
     for root, dirnames, filenames in os.walk(sandbox):
+        visited += len(filenames)
         for filename in filenames:
             sandbox_name = os.path.join(root, filename)
 
             # Remove the sandbox base
-            member_name = sandbox_name.lstrip(sandbox)
+            member_name = sandbox_name[len(sandbox):]
 
             allfiles.append(member_name)
             included = False
@@ -95,10 +138,10 @@ def extract_guts(image_path,
                 continue
 
             # If we have flagged to include, and not flagged to skip
-            elif assess_content(sandbox_name, file_filter):
+            elif assess_content(member_name, file_filter):
                 digest[member_name] = extract_content(sandbox_name, return_hash=True)
                 included = True
-            elif include_file(sandbox_name, file_filter):
+            elif include_file(member_name, file_filter):
                 hasher = hashlib.md5()
                 with open(sandbox_name, 'rb') as filey:
                     buf = filey.read()
@@ -108,59 +151,242 @@ def extract_guts(image_path,
 
             # Derive size, and if root owned
             if included:
-                if include_sizes:
-                    sizes[member_name] = os.stat(sandbox_name).st_size
+                hashed += 1
+                if include_sizes or stats:
+                    size = os.stat(sandbox_name).st_size
+                    bytes_read += size
+                    if include_sizes:
+                        sizes[member_name] = size
                 if tag_root:
                     roots[member_name] = is_root_owned(sandbox_name)
 
-    results['all'] = allfiles
-    results['hashes'] = digest
-    if include_sizes:
-        results['sizes'] = sizes
-    if tag_root:
-        results['root_owned'] = roots
-    return results
+    if stats:
+        stats.add_time('walk', time.perf_counter() - walk_start)
+        stats.count('files_visited', visited)
+        stats.count('files_hashed', hashed)
+        stats.count('files_skipped', visited - hashed)
+        stats.count('bytes_read', bytes_read)
+
+
+@contextmanager
+def exported_image(image_path, stats=None):
+    '''exported_image is the sandbox (folder) of an image for a context. A
+    sandbox is used as is. A tar is extracted, and an image is exported
+    (see export_sandbox) in a folder of the scratch space that is removed at
+    the end, even if there is an error. If the export cache is enabled (see
+    get_export_cache), the sandbox is kept for the next context instead.
+    :param stats: a Stats to count export cache hits and misses
+    '''
+    if os.path.isdir(image_path):
+        yield image_path
+        return
+
+    cache = get_export_cache()
+    if cache is not None:
+        with cache.sandbox(image_path, export_sandbox, stats=stats) as sandbox:
+            yield sandbox
+        return
+
+    with get_scratch().space(get_export_size(image_path)) as folder:
+        yield export_sandbox(image_path, folder)
+
+
+@contextmanager
+def exported_images(image_paths, stats=None):
+    '''exported_images is the list of sandboxes of images for a context
+    (see exported_image). Without the export cache, the images that need an
+    export share one reservation of the scratch space, for all of them, so
+    a thread doesn't hold the space of one while it waits for the next.
+    :param stats: a Stats to count export cache hits and misses
+    '''
+    with ExitStack() as stack:
+        if get_export_cache() is not None:
+            yield [stack.enter_context(exported_image(x, stats))
+                   for x in image_paths]
+            return
+
+        exports = [x for x in image_paths if not os.path.isdir(x)]
+        folder = None
+        if exports:
+            size = sum(get_export_size(x) for x in exports)
+            folder = stack.enter_context(get_scratch().space(size))
+
+        sandboxes = []
+        for number, image_path in enumerate(image_paths):
+            if os.path.isdir(image_path):
+                sandboxes.append(image_path)
+                continue
+            subfolder = os.path.join(folder, str(number))
+            os.mkdir(subfolder)
+            sandboxes.append(export_sandbox(image_path, subfolder))
+        yield sandboxes
+
+
+def export_sandbox(image_path, folder):
+    '''export_sandbox exports an image (or extracts a tar) to a sandbox in
+    a folder, and returns the sandbox. For Singularity 2, the image is
+    exported to a tar first, then extracted.
+    '''
+    sandbox = os.path.join(folder, 'sandbox')
+
+    if tarfile.is_tarfile(image_path):
+        with tarfile.open(image_path) as tar:
+            tar.extractall(path=sandbox)
+
+    elif get_runtime().sandbox:
+        sandbox = get_client().export(image_path, output_file=sandbox)
+
+    else:
+        tar_file = get_client().image.export(image_path=image_path,
+                                             output_file=os.path.join(folder, 'image.tar'))
+        if tar_file is None:
+            bot.error("Error generating tar, exiting.")
+            sys.exit(1)
+        with tarfile.open(tar_file) as tar:
+            tar.extractall(path=sandbox)
+        os.remove(tar_file)
+
+    return sandbox
 
 
-def create_tarfile(source_dir, output_filename=None):
-    ''' create a tarfile from a source directory'''
+def create_tarfile(source_dir, output_filename=None, arcname=None, mode="w:gz"):
+    ''' create a tarfile from a source directory, with members named from
+    arcname (default is the basename of the source directory)'''
     if output_filename == None:
         output_filename = "%s/tmptar.tar" %(tempfile.mkdtemp())
-    with tarfile.open(output_filename, "w:gz") as tar:
-        tar.add(source_dir, arcname=os.path.basename(source_dir))
+    if arcname is None:
+        arcname = os.path.basename(source_dir)
+    with tarfile.open(output_filename, mode) as tar:
+        tar.add(source_dir, arcname=arcname)
     return output_filename
 
 
-def get_image_tar(image_path):
+def get_image_tar(image_path, stats=None):
     '''get an image tar, either written in memory or to
     the file system. file_obj will either be the file object,
-    or the file itself.
+    or the file itself. A sandbox or a tar doesn't need singularity, and
+    a tar is opened where it is (file_obj is the open file). Otherwise the
+    tar is written to scratch space (see get_scratch) until delete_image_tar.
+    For Singularity 3, the export is in the same reservation as the tar.
+    :param stats: a Stats to record the export and tar stages
     '''
     bot.debug('Generate file system tar...')
+    stats = get_stats(stats)
 
-    if 'version 3' in get_singularity_version():
-        sandbox = Client.export(image_path)
-        file_obj = create_tarfile(sandbox)
+    if not os.path.isdir(image_path) and tarfile.is_tarfile(image_path):
+        file_obj = open(image_path, 'rb')
+        return file_obj, tarfile.open(fileobj=file_obj)
+
+    # The tar is written to scratch space, released by delete_image_tar
+    scratch = get_scratch()
+    cache = get_export_cache()
+    if os.path.isdir(image_path):
+        folder = scratch.reserve(get_size(image_path))
+    elif get_runtime().sandbox and cache is None:
+        folder = scratch.reserve(2 * get_export_size(image_path))
     else:
-        file_obj = Client.image.export(image_path=image_path)
-        if file_obj is None:
-            bot.exit("Error generating tar, exiting.")
-            
-    tar = tarfile.open(file_obj)
+        folder = scratch.reserve(get_export_size(image_path))
+    file_obj = os.path.join(folder, 'image.tar')
+
+    try:
+
+        # Members are named like an exported image, ./bin, ./etc
+        if os.path.isdir(image_path):
+            with stats.timer('tar'):
+                create_tarfile(image_path, file_obj, arcname='.', mode="w")
+
+        elif cache is not None:
+            with cache.sandbox(image_path, export_sandbox, stats=stats) as sandbox:
+                with stats.timer('tar'):
+                    create_tarfile(sandbox, file_obj, arcname='.', mode="w")
+
+        elif get_runtime().sandbox:
+            with stats.timer('export'):
+                sandbox = export_sandbox(image_path, folder)
+            with stats.timer('tar'):
+                create_tarfile(sandbox, file_obj, arcname='.', mode="w")
+            shutil.rmtree(sandbox, ignore_errors=True)
+
+        else:
+            with stats.timer('export'):
+                file_obj = get_client().image.export(image_path=image_path,
+                                                     output_file=file_obj)
+            if file_obj is None:
+                bot.error("Error generating tar, exiting.")
+                sys.exit(1)
+
+        tar = tarfile.open(file_obj)
+
+    except BaseException:
+        scratch.release(folder)
+        raise
+
     return file_obj, tar
 
 
+def can_stream(image_path):
+    '''can_stream returns True if an image can be read as a stream of its
+    export (see stream_image_tar), meaning Singularity 2 and an image file
+    (not a sandbox or tar) that isn't in the export cache
+    '''
+    if os.path.isdir(image_path) or tarfile.is_tarfile(image_path):
+        return False
+    return not get_runtime().sandbox and get_export_cache() is None
+
+
+@contextmanager
+def stream_image_tar(image_path, command=None):
+    '''stream_image_tar is a tar (in stream mode, "r|") of the export of an
+    image read from the output of singularity image.export, so the tar is
+    never written to disk. Members can only be read once, in order.
+    :param command: the command to write the tar to stdout (default is
+    singularity image.export <image_path>)
+    '''
+    if command is None:
+        command = ['singularity', 'image.export', image_path]
+
+    # Errors go to a file, a full pipe would block the export
+    errors = tempfile.TemporaryFile()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=errors)
+    stopped = False
+    try:
+        try:
+            tar = tarfile.open(fileobj=process.stdout, mode='r|')
+        except tarfile.ReadError:
+            tar = None
+        if tar is not None:
+            with tar:
+                yield tar
+
+    finally:
+        if process.poll() is None:
+            stopped = True
+            process.kill()
+        process.stdout.close()
+        process.wait()
+        errors.seek(0)
+        message = errors.read().decode('utf-8', errors='replace').strip()
+        errors.close()
+
+    if tar is None or (process.returncode != 0 and not stopped):
+        bot.error("Error exporting %s: %s" %(image_path, message))
+        sys.exit(1)
+
+
 def delete_image_tar(file_obj, tar):
     '''delete image tar will close a file object (if extracted into
     memory) or delete from the file system (if saved to disk)'''
-    try:
+    deleted = False
+    tar.close()
+    if not isinstance(file_obj, str):
         file_obj.close()
-    except:
-        tar.close()
-    if os.path.exists(file_obj):
+    elif os.path.exists(file_obj):
         os.remove(file_obj)
         deleted = True
         bot.debug('Deleted temporary tar.')   
+
+    # Free the scratch space of the tar
+    get_scratch().release(file_obj)
     return deleted
 
 
@@ -20,7 +20,6 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from glob import glob
 import os
 import re
-import requests
 
 import shutil
 from singularity.logger import bot
@@ -30,7 +30,6 @@ import hmac
 import json
 import os
 import pwd
-import requests
 import sys
 
 
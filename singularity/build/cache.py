@@ -0,0 +1,185 @@
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+from singularity.logger import bot
+from singularity.utils import (
+    mkdir_p,
+    read_file,
+    read_json,
+    write_json
+)
+
+import hashlib
+import os
+import re
+import shlex
+import shutil
+
+
+######################################################################################
+# Build Cache
+######################################################################################
+
+# A build is identified by its recipe and the files it references, so the
+# same recipe built from a moving base (e.g., docker://ubuntu:latest) is
+# considered the same build.
+
+
+def get_build_cache(cache_dir=None):
+    '''get_build_cache returns the build cache folder, either provided or
+    from the environment variable SINGULARITY_BUILD_CACHE, or None if the
+    build cache is not enabled.
+    '''
+    if cache_dir is None:
+        cache_dir = os.environ.get('SINGULARITY_BUILD_CACHE')
+    return cache_dir
+
+
+def get_recipe_files(spec_file, build_dir=None):
+    '''get_recipe_files returns the files in the build context referenced by
+    a recipe, meaning sources in %files, and paths in %setup that exist.
+    :param spec_file: the recipe (Singularity file)
+    :param build_dir: the build context, paths are relative to it. Defaults
+    to the folder of the recipe.
+    '''
+    if build_dir is None:
+        build_dir = os.path.dirname(os.path.abspath(spec_file))
+
+    context = os.path.realpath(build_dir)
+    files = []
+    section = None
+    for line in read_file(spec_file):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+
+        # %files, %files from <stage>, %setup
+        match = re.match('^%([a-zA-Z]+)', line)
+        if match:
+            section = match.group(1).lower()
+            continue
+
+        try:
+            tokens = shlex.split(line, comments=True)
+        except ValueError:
+            tokens = line.split()
+
+        if section == 'files':
+            tokens = tokens[:1]
+        elif section != 'setup':
+            continue
+
+        # Only paths in the build context (e.g., not / or $SINGULARITY_ROOTFS)
+        for token in tokens:
+            path = os.path.realpath(os.path.join(build_dir, token))
+            if path != context and not path.startswith(context + os.sep):
+                continue
+            if os.path.exists(path) and path not in files:
+                files.append(path)
+    return files
+
+
+def get_build_key(spec_file, build_dir=None):
+    '''get_build_key returns a hash of a recipe and the content of the files
+    it references (see get_recipe_files), folders included recursively.
+    '''
+    if build_dir is None:
+        build_dir = os.path.dirname(os.path.abspath(spec_file))
+    build_dir = os.path.realpath(build_dir)
+
+    hasher = hashlib.sha256()
+    with open(spec_file, 'rb') as filey:
+        hasher.update(filey.read())
+
+    def update(path):
+        hasher.update(os.path.relpath(path, build_dir).encode('utf-8'))
+        if os.path.isfile(path):
+            with open(path, 'rb') as filey:
+                for chunk in iter(lambda: filey.read(1024 * 1024), b""):
+                    hasher.update(chunk)
+
+    for path in get_recipe_files(spec_file, build_dir):
+        update(path)
+        for root, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(x for x in dirnames if x != '.git')
+            for filename in sorted(filenames):
+                update(os.path.join(root, filename))
+
+    return hasher.hexdigest()
+
+
+def load_cached_build(key, cache_dir=None):
+    '''load_cached_build returns the cache entry (a dictionary with the
+    image, metadata and any storage files) for a build key, or None if
+    it's not found, or the image no longer exists.
+    '''
+    cache_dir = get_build_cache(cache_dir)
+    if cache_dir is None:
+        return None
+
+    entry_file = os.path.join(cache_dir, "%s.json" % key)
+    if not os.path.exists(entry_file):
+        return None
+
+    entry = read_json(entry_file)
+    if not os.path.exists(entry.get('image') or ''):
+        bot.warning("Cached image for %s is missing." % key)
+        return None
+    return entry
+
+
+def save_cached_build(key, image=None, metadata=None, files=None, cache_dir=None):
+    '''save_cached_build will save (or update) the cache entry for a build key.
+    A new image is linked (or copied) into the cache, so it outlives the build
+    folder. Returns the entry, or None if the build cache is not enabled.
+    :param key: the build key, from get_build_key
+    :param image: the path to the built image
+    :param metadata: the build metadata
+    :param files: the storage objects (or urls) the image was uploaded to
+    '''
+    cache_dir = get_build_cache(cache_dir)
+    if cache_dir is None:
+        return None
+
+    mkdir_p(cache_dir)
+    entry_file = os.path.join(cache_dir, "%s.json" % key)
+    entry = dict()
+    if os.path.exists(entry_file):
+        entry = read_json(entry_file)
+
+    if image is not None:
+        cached_image = os.path.join(cache_dir, "%s-%s" %(key, os.path.basename(image)))
+        if os.path.abspath(image) != os.path.abspath(cached_image):
+            if os.path.exists(cached_image):
+                os.remove(cached_image)
+            try:
+                os.link(image, cached_image)
+            except OSError:
+                shutil.copyfile(image, cached_image)
+        entry['image'] = cached_image
+
+    if metadata is not None:
+        entry['metadata'] = metadata
+    if files is not None:
+        entry['files'] = files
+
+    # Write to a temporary file first, so readers never see a partial entry
+    write_json(entry, "%s.tmp" % entry_file)
+    os.rename("%s.tmp" % entry_file, entry_file)
+    return entry
@@ -17,15 +17,18 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
 
-from .instances import (
-    run_build,
-    finish_build
-)
-
-from .storage import (
-    get_bucket,
-    delete_object,
-    upload_file,
-    list_bucket,
-    get_image_path
-)
+from singularity.utils import lazy_attributes
+
+# Functions are imported from their modules when first used
+imports = {
+    'run_build': ('.instances', 'run_build'),
+    'finish_build': ('.instances', 'finish_build'),
+    'get_bucket': ('.storage', 'get_bucket'),
+    'delete_object': ('.storage', 'delete_object'),
+    'upload_file': ('.storage', 'upload_file'),
+    'list_bucket': ('.storage', 'list_bucket'),
+    'get_image_path': ('.storage', 'get_image_path')
+}
+
+__all__ = list(imports)
+__getattr__, __dir__ = lazy_attributes(__name__, imports)
@@ -22,12 +22,15 @@ from singularity.build.main import (
     send_build_data,
     send_build_close
 )
+from singularity.build.cache import save_cached_build
+from singularity.http_client import request
+from singularity.utils import read_json
 
 import json
 import uuid
 import os
 import pickle
-import requests
+import sys
 import tempfile
 
 # Log everything to stdout
@@ -35,8 +38,10 @@ from singularity.logger import bot
 
 from .utils import get_google_service
 from .storage import (
+    get_bucket,
     get_image_path,
-    upload_file
+    upload_file,
+    UploadManager
 )
 
 def run_build(logfile='/tmp/.shub-log'):
@@ -90,6 +95,9 @@ def run_build(logfile='/tmp/.shub-log'):
                 {'key': 'branch', 'value': None },
                 {'key': 'spec_file', 'value': None},
                 {'key': 'logging_url', 'value': None },
+                {'key': 'upload_chunk_size', 'value': None },
+                {'key': 'upload_workers', 'value': None },
+                {'key': 'build_cache', 'value': None },
                 {'key': 'logfile', 'value': logfile }]
 
     # Obtain values from build
@@ -115,8 +123,13 @@ def run_build(logfile='/tmp/.shub-log'):
     metadata = output['metadata']
     params = output['params']  
 
+    # A cached build was already uploaded, its files are sent again
+    if output.get('files') is not None:
+        bot.info("%s was uploaded before, skipping upload." %finished_image)
+        files = output['files']
+
     # Upload image package files to Google Storage
-    if os.path.exists(finished_image):
+    elif os.path.exists(finished_image):
         bot.info("%s successfully built" %finished_image)
         dest_dir = tempfile.mkdtemp(prefix='build')
 
@@ -134,43 +147,54 @@ def run_build(logfile='/tmp/.shub-log'):
         storage_service = get_google_service() # default is "storage" "v1"
         bucket = get_bucket(storage_service,params["bucket_name"])
 
-        # For each file, upload to storage
-        files = []
-        for build_file in build_files:
-            bot.info("Uploading %s to storage..." %build_file)
-            storage_file = upload_file(storage_service,
-                                       bucket=bucket,
-                                       bucket_path=image_path,
-                                       file_name=build_file)  
-            files.append(storage_file)
+        # Upload files at once, sessions are kept to resume after a failure
+        uploader = UploadManager(bucket,
+                                 chunk_size=params.get('upload_chunk_size'),
+                                 workers=params.get('upload_workers'),
+                                 state_file='/tmp/.shub-uploads')
+        files = uploader.upload_files(build_files, bucket_path=image_path)
+
+        # Remember where the build was stored, with the cached image
+        if metadata.get('build_cache_key') is not None:
+            save_cached_build(metadata['build_cache_key'],
+                              files=files,
+                              cache_dir=params.get('build_cache'))
+
+    else:
+        return
                 
-        # Finally, package everything to send back to shub
-        response = {"files": json.dumps(files),
-                    "repo_url": params['repo_url'],
-                    "commit": params['commit'],
-                    "repo_id": params['repo_id'],
-                    "branch": params['branch'],
-                    "tag": params['tag'],
-                    "container_id": params['container_id'],
-                    "spec_file":params['spec_file'],
-                    "token": params['token'],
-                    "metadata": json.dumps(metadata)}
-
-        # Did the user specify a specific log file?
-        custom_logfile = get_build_metadata('logfile')
-        if custom_logfile is not None:
-            logfile = custom_logfile    
-        response['logfile'] = logfile
-
-        # Send final build data to instance
-        send_build_data(build_dir=build_dir,
-                        response_url=params['response_url'],
-                        secret=params['token'],
-                        data=response)
-
-        # Dump final params, for logger to retrieve
-        passing_params = "/tmp/params.pkl"
-        pickle.dump(params,open(passing_params,'wb'))
+    # Finally, package everything to send back to shub
+    response = {"files": json.dumps(files),
+                "repo_url": params['repo_url'],
+                "commit": params['commit'],
+                "repo_id": params['repo_id'],
+                "branch": params['branch'],
+                "tag": params['tag'],
+                "container_id": params['container_id'],
+                "spec_file":params['spec_file'],
+                "token": params['token'],
+                "metadata": json.dumps(metadata)}
+
+    # Did the user specify a specific log file?
+    custom_logfile = get_build_metadata('logfile')
+    if custom_logfile is not None:
+        logfile = custom_logfile    
+    response['logfile'] = logfile
+
+    # Send final build data to instance
+    received = send_build_data(build_dir=build_dir,
+                               response_url=params['response_url'],
+                               secret=params['token'],
+                               data=response)
+
+    # Dump final params, for logger to retrieve
+    params['received'] = received
+    passing_params = "/tmp/params.pkl"
+    pickle.dump(params,open(passing_params,'wb'))
+
+    if not received:
+        bot.error("Build was not received, cancelling.")
+        sys.exit(1)
 
 
 def finish_build(verbose=True):
@@ -197,6 +221,9 @@ def finish_build(verbose=True):
     version = 'error-%s' % str(uuid.uuid4())
     if 'version' in params:
         version = params['version']
+    if params.get('received') is False:
+        version = 'error-%s' % str(uuid.uuid4())
+        bot.error("Build was not received, sending the log only.")
     trailing_path = "%s/%s" %(params['commit'], version)
     image_path = get_image_path(params['repo_url'], trailing_path) 
 
@@ -216,20 +243,53 @@ def finish_build(verbose=True):
 ################################################################################
 
 
+# All attributes of the instance, fetched once
+instance_metadata = None
+
+
+def get_instance_metadata(refresh=False):
+    '''get_instance_metadata returns all (custom) metadata attributes of the
+    instance as a dictionary, with one request to the metadata api. The result
+    is kept for the process, unless refresh is True (a failed request is not
+    kept, and returns an empty dictionary). To run outside of Google
+    Compute Engine, the attributes can be provided as json in a file
+    (SINGULARITY_METADATA_FILE) or in the environment (SINGULARITY_METADATA).
+    '''
+    global instance_metadata
+    if instance_metadata is not None and not refresh:
+        return instance_metadata
+
+    metadata_file = os.environ.get('SINGULARITY_METADATA_FILE')
+    if metadata_file is not None:
+        metadata = read_json(metadata_file)
+    elif os.environ.get('SINGULARITY_METADATA') is not None:
+        metadata = json.loads(os.environ['SINGULARITY_METADATA'])
+    else:
+        headers = {"Metadata-Flavor":"Google"}
+        url = "http://metadata.google.internal/computeMetadata/v1/instance/attributes/"
+        response = request('GET', url, headers=headers, params={'recursive': 'true'})
+
+        # A failed fetch isn't kept, the next call tries again
+        if response.status_code != 200:
+            bot.warning("Cannot get instance metadata: %s %s" %(response.status_code,
+                                                               response.reason))
+            return dict()
+        metadata = response.json()
+
+    instance_metadata = metadata
+    return instance_metadata
+
+
 def get_build_metadata(key):
     '''get_build_metadata will return metadata about an instance from within it.
     :param key: the key to look up
     '''
-    headers = {"Metadata-Flavor":"Google"}
-    url = "http://metadata.google.internal/computeMetadata/v1/instance/attributes/%s" % key  
-    response = requests.get(url=url,headers=headers)
-    if response.status_code == 200:
-        return response.text
-    return None
+    return get_instance_metadata().get(key)
 
 
 def get_build_params(metadata):
-    '''get_build_params uses get_build_metadata to retrieve corresponding meta data values for a build
+    '''get_build_params uses get_build_metadata to retrieve corresponding meta data values for a build,
+    all from one request (see get_instance_metadata)
     :param metadata: a list, each item a dictionary of metadata, in format:
     metadata = [{'key': 'repo_url', 'value': repo_url },
                 {'key': 'repo_id', 'value': repo_id },
@@ -18,11 +18,28 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 '''
 
 from singularity.build.utils import sniff_extension
+from singularity.utils import (
+    parse_size,
+    read_json,
+    write_json
+)
 from googleapiclient.errors import HttpError
 from googleapiclient import http
+from .utils import (
+    get_google_service,
+    google_cache
+)
 
+from concurrent.futures import ThreadPoolExecutor
+from queue import (
+    Full,
+    Queue
+)
+import json
+import os
 import pickle
 import re
+import threading
 from retrying import retry
 
 # Log everything to stdout
@@ -33,10 +50,18 @@ from singularity.logger import bot
 # GOOGLE STORAGE API ###########################################################
 ################################################################################
     
-@retry(wait_exponential_multiplier=1000, wait_exponential_max=10000)
-def get_bucket(storage_service,bucket_name):
-    req = storage_service.buckets().get(bucket=bucket_name)
-    return req.execute()
+def get_bucket(storage_service,bucket_name,cache=True):
+    '''get_bucket returns the metadata of a bucket, which is cached for the
+    process (see TimedCache) unless cache is False.
+    '''
+    bucket = None
+    if cache:
+        bucket = google_cache.get(('bucket', bucket_name))
+    if bucket is None:
+        bucket = execute_request(storage_service.buckets().get(bucket=bucket_name))
+        if cache:
+            google_cache.set(('bucket', bucket_name), bucket)
+    return bucket
 
 
 @retry(wait_exponential_multiplier=1000, wait_exponential_max=10000,stop_max_attempt_number=10)
@@ -55,47 +80,304 @@ def delete_object(storage_service, bucket_name, object_name):
     return operation
 
 
-@retry(wait_exponential_multiplier=1000, wait_exponential_max=10000)
+def get_upload_path(bucket, bucket_path, file_name):
+    '''get_upload_path returns the name of an uploaded file in the bucket,
+    the bucket id, then the bucket path, then the file basename.
+    '''
+    upload_path = "%s/%s" %(bucket['id'],bucket_path)
+    if upload_path[-1] != '/':
+        upload_path = "%s/" %(upload_path)
+    return "%s%s" %(upload_path,os.path.basename(file_name))
+
+
 def upload_file(storage_service,bucket,bucket_path,file_name,verbose=True):
-    '''get_folder will return the folder with folder_name, and if create=True,
-    will create it if not found. If folder is found or created, the metadata is
-    returned, otherwise None is returned
+    '''upload_file will upload a file to a bucket, at the bucket path, and
+    return the storage object, or None if the file doesn't exist. The upload
+    is resumable, so a retry continues from the last uploaded chunk.
     :param storage_service: the drive_service created from get_storage_service
     :param bucket: the bucket object from get_bucket
     :param file_name: the name of the file to upload
     :param bucket_path: the path to upload to
     '''
-    # Set up path on bucket
-    upload_path = "%s/%s" %(bucket['id'],bucket_path)
-    if upload_path[-1] != '/':
-        upload_path = "%s/" %(upload_path)
-    upload_path = "%s%s" %(upload_path,os.path.basename(file_name))
-    body = {'name': upload_path }
-    # Create media object with correct mimetype
-    if os.path.exists(file_name):
-        mimetype = sniff_extension(file_name,verbose=verbose)
+    manager = UploadManager(bucket,
+                            get_service=lambda: storage_service,
+                            verbose=verbose)
+    return manager.upload(file_name, bucket_path)
+
+
+# Resumable uploads are sent in chunks of a multiple of this size
+CHUNK_UNIT = 256 * 1024
+
+
+class UploadManager(object):
+    '''UploadManager uploads files to a bucket with resumable uploads, in
+    chunks, and several files at once. The session uri of each upload is
+    kept (in the state file, if defined) so that a retry, or the next
+    manager with the same state file, continues from the last byte the
+    server acknowledged instead of sending the file again.
+
+    Parameters
+    ==========
+    bucket: the bucket object from get_bucket
+    get_service: returns a storage service, called once per thread (the
+                 service isn't thread safe). Default is get_google_service
+    chunk_size: bytes per request (e.g., 8M), rounded down to a multiple
+                of 256KB (default 8MB)
+    workers: the number of files to upload at once (default 4)
+    state_file: a json file to persist upload sessions to
+    '''
+
+    chunk_size = 8 * 1024 * 1024
+    workers = 4
+
+    def __init__(self, bucket, get_service=None, chunk_size=None,
+                       workers=None, state_file=None, verbose=True):
+
+        self.bucket = bucket
+        self.get_service = get_service or (lambda: get_google_service(cache=False))
+        self.chunk_size = parse_size(chunk_size or self.chunk_size)
+        self.workers = int(workers or self.workers)
+
+        # Chunks (but the last) must be a multiple of 256KB
+        chunk_size = max(int(self.chunk_size) // CHUNK_UNIT, 1) * CHUNK_UNIT
+        if chunk_size != self.chunk_size:
+            bot.warning("Chunk size %s isn't a multiple of 256KB, using %s"
+                        %(self.chunk_size, chunk_size))
+            self.chunk_size = chunk_size
+        self.state_file = state_file
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        self.sessions = dict()
+        if state_file is not None and os.path.exists(state_file):
+            self.sessions = read_json(state_file)
+
+
+    def __str__(self):
+        return "UploadManager:%s" %self.bucket['id']
+
+
+    def service(self):
+        '''return the storage service for the current thread'''
+        if not hasattr(self.local, 'service'):
+            self.local.service = self.get_service()
+        return self.local.service
+
+
+    def save_session(self, key, uri=None):
+        '''save (or with uri None, remove) the session uri of an upload'''
+        with self.lock:
+            if uri is None:
+                self.sessions.pop(key, None)
+            else:
+                self.sessions[key] = uri
+            if self.state_file is not None:
+                write_json(self.sessions, "%s.tmp" %self.state_file)
+                os.rename("%s.tmp" %self.state_file, self.state_file)
+
+
+    def upload_files(self, file_names, bucket_path):
+        '''upload_files uploads files to the same bucket path, up to workers
+        at once, and returns the storage objects in the same order.
+        '''
+        if self.workers == 1 or len(file_names) < 2:
+            return [self.upload(f, bucket_path) for f in file_names]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(lambda f: self.upload(f, bucket_path),
+                                     file_names))
+
+
+    @retry(wait_exponential_multiplier=1000, wait_exponential_max=10000,
+           stop_max_attempt_number=10)
+    def upload(self, file_name, bucket_path):
+        '''upload a file to the bucket path, continuing a previous session
+        for the same file if there is one. Returns the storage object, or
+        None if the file doesn't exist.
+        '''
+        if not os.path.exists(file_name):
+            bot.warning('%s requested for upload does not exist, skipping' %file_name)
+            return None
+
+        upload_path = get_upload_path(self.bucket, bucket_path, file_name)
+        mimetype = sniff_extension(file_name, verbose=self.verbose)
         media = http.MediaFileUpload(file_name,
                                      mimetype=mimetype,
+                                     chunksize=self.chunk_size,
                                      resumable=True)
-        request = storage_service.objects().insert(bucket=bucket['id'], 
-                                                   body=body,
-                                                   predefinedAcl="publicRead",
-                                                   media_body=media)
-        result = request.execute()
-        return result
-    bot.warning('%s requested for upload does not exist, skipping' %file_name)
-
-@retry(wait_exponential_multiplier=1000, wait_exponential_max=10000)
-def list_bucket(bucket,storage_service):
-    # Create a request to objects.list to retrieve a list of objects.        
-    request = storage_service.objects().list(bucket=bucket['id'], 
-                                             fields='nextPageToken,items(name,size,contentType)')
-    # Go through the request and look for the folder
-    objects = []
-    while request:
-        response = request.execute()
-        objects = objects + response['items']
-    return objects
+        request = self.service().objects().insert(bucket=self.bucket['id'],
+                                                  body={'name': upload_path},
+                                                  predefinedAcl="publicRead",
+                                                  media_body=media)
+
+        # A session is only valid for the same content
+        stat = os.stat(file_name)
+        key = "%s|%s|%s|%s" %(upload_path, os.path.abspath(file_name),
+                              stat.st_size, stat.st_mtime)
+
+        response = None
+        if key in self.sessions:
+            response = self.resume(request, key, media.size())
+
+        while response is None:
+            try:
+                status, response = request.next_chunk()
+            finally:
+                uri = request.resumable_uri
+                if uri is not None and self.sessions.get(key) != uri:
+                    self.save_session(key, uri)
+            if status is not None:
+                bot.debug("%s: %s of %s bytes", upload_path,
+                          status.resumable_progress, status.total_size)
+
+        self.save_session(key)
+        return response
+
+
+    def resume(self, request, key, size):
+        '''resume asks the server how much of an upload it has, and moves
+        the request to continue from there. If the upload was finished, the
+        storage object is returned. If the session expired, it's removed and
+        the request starts over.
+        '''
+        uri = self.sessions[key]
+        headers = {"Content-Range": "bytes */%s" %size, "Content-Length": "0"}
+        response, content = request.http.request(uri, "PUT", headers=headers)
+
+        if response.status in [200, 201]:
+            return json.loads(content.decode('utf-8'))
+
+        if response.status == 308:
+            progress = 0
+            if 'range' in response:
+                progress = int(response['range'].split('-')[-1]) + 1
+            bot.info("Resuming upload at %s of %s bytes" %(progress, size))
+            request.resumable_uri = uri
+            request.resumable_progress = progress
+        else:
+            bot.warning("Upload session expired (%s), starting over" %response.status)
+            self.save_session(key)
+        return None
+
+
+@retry(wait_exponential_multiplier=1000, wait_exponential_max=10000,
+       stop_max_attempt_number=10)
+def execute_request(request):
+    '''execute a request (e.g., a page of a listing) with retries'''
+    return request.execute()
+
+
+def list_pages(storage_service, bucket_name, **kwargs):
+    '''list_pages yields pages (responses) of objects.list, following the
+    nextPageToken until the listing is done. Each page is retried on its own.
+    '''
+    objects = storage_service.objects()
+    request = objects.list(bucket=bucket_name, **kwargs)
+    while request is not None:
+        response = execute_request(request)
+        yield response
+        request = objects.list_next(request, response)
+
+
+def list_bucket(bucket, storage_service, prefix=None, fields=None,
+                page_size=None, shard=False, workers=4, get_service=None):
+    '''list_bucket is a generator of the objects in a bucket, yielded as each
+    page arrives, so a bucket of any size is listed in constant memory.
+
+    Parameters
+    ==========
+    bucket: the bucket object from get_bucket
+    storage_service: the service obtained with get_google_service
+    prefix: only list objects with names starting with prefix
+    fields: the object fields to return (default name,size,contentType)
+    page_size: the number of objects per page (the server default is 1000)
+    shard: list the top level "folders" under prefix at the same time,
+           with workers threads. Objects are then not in order.
+    get_service: returns a storage service for each thread when sharding
+                 (the service isn't thread safe). Default get_google_service
+    '''
+    if fields is None:
+        fields = "name,size,contentType"
+
+    kwargs = {'fields': 'nextPageToken,prefixes,items(%s)' %fields}
+    if prefix is not None:
+        kwargs['prefix'] = prefix
+    if page_size is not None:
+        kwargs['maxResults'] = page_size
+
+    if not shard:
+        for response in list_pages(storage_service, bucket['id'], **kwargs):
+            for item in response.get('items', []):
+                yield item
+        return
+
+    # Objects at the top level come first, and then each folder at once
+    prefixes = []
+    for response in list_pages(storage_service, bucket['id'],
+                               delimiter='/', **kwargs):
+        prefixes += response.get('prefixes', [])
+        for item in response.get('items', []):
+            yield item
+
+    for item in list_shards(bucket, prefixes, kwargs, workers, get_service):
+        yield item
+
+
+def list_shards(bucket, prefixes, kwargs, workers=4, get_service=None):
+    '''list_shards lists each prefix (a shard) of a bucket in a thread, and
+    yields objects as pages arrive. At most a few pages per worker are held,
+    and the threads stop if the generator is closed.
+    '''
+    get_service = get_service or (lambda: get_google_service(cache=False))
+    pages = Queue(maxsize=workers * 2)
+    stop = threading.Event()
+    done = object()
+    prefixes = list(prefixes)
+    lock = threading.Lock()
+
+    def put(value):
+        while not stop.is_set():
+            try:
+                return pages.put(value, timeout=0.1)
+            except Full:
+                pass
+
+    def worker():
+        service = get_service()
+        try:
+            while not stop.is_set():
+                with lock:
+                    if not prefixes:
+                        break
+                    prefix = prefixes.pop()
+                shard = dict(kwargs, prefix=prefix)
+                for response in list_pages(service, bucket['id'], **shard):
+                    if stop.is_set():
+                        break
+                    put(response.get('items', []))
+        except Exception as error:
+            put(error)
+        put(done)
+
+    threads = [threading.Thread(target=worker, daemon=True)
+               for _ in range(min(workers, len(prefixes)))]
+    for thread in threads:
+        thread.start()
+
+    try:
+        finished = 0
+        while finished < len(threads):
+            page = pages.get()
+            if page is done:
+                finished += 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                for item in page:
+                    yield item
+    finally:
+        stop.set()
 
 
 def get_image_path(repo_url, trailing_path):
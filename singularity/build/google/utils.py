@@ -17,27 +17,109 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
 
-from googleapiclient.discovery import build
+from googleapiclient.discovery import (
+    build,
+    build_from_document
+)
 from oauth2client.client import GoogleCredentials
 
+import os
 import re
-import requests
+import threading
+import time
+
+
+################################################################################
+# CACHE ########################################################################
+################################################################################
+
+class TimedCache(object):
+    '''TimedCache is a (thread safe) dictionary of values that expire ttl
+    seconds after they are set. The default ttl is from the environment
+    variable SINGULARITY_GOOGLE_CACHE_TTL, or one hour.
+    '''
+    def __init__(self, ttl=None):
+        if ttl is None:
+            ttl = os.environ.get('SINGULARITY_GOOGLE_CACHE_TTL', 3600)
+        self.ttl = float(ttl)
+        self.values = dict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.values:
+                expires, value = self.values[key]
+                if time.time() < expires:
+                    return value
+                del self.values[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = (time.time() + self.ttl, value)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.values = dict()
+
+
+# Services and buckets, shared by the steps of a build
+google_cache = TimedCache()
 
 
 ################################################################################
 # GOOGLE GENERAL API ###########################################################
 ################################################################################
 
-def get_google_service(service_type=None, version=None):
+def get_google_service(service_type=None, version=None, discovery_file=None,
+                       http=None, cache=True):
     '''
-    get a google service using the discovery client.
+    get a google service using the discovery client. The service is cached for
+    the process (see TimedCache), but isn't thread safe, so a thread should
+    ask for its own with cache=False.
     :param service_type: the service to get (default is storage)
     :param version: version to use (default is v1)
+    :param discovery_file: a discovery document to build the service from,
+    (default from SINGULARITY_DISCOVERY_FILE) otherwise the document bundled
+    with the client is used, without fetching it.
+    :param http: an http object to use instead of default credentials
+    :param cache: use (and save to) the cache
     '''
     if service_type == None:
         service_type = "storage"
     if version == None:
         version = "v1"
+    if discovery_file == None:
+        discovery_file = os.environ.get('SINGULARITY_DISCOVERY_FILE')
+
+    key = (service_type, version, discovery_file, http)
+    if cache:
+        service = google_cache.get(key)
+        if service is not None:
+            return service
+
+    credentials = None
+    if http is None:
+        credentials = GoogleCredentials.get_application_default()
+
+    if discovery_file is not None:
+        with open(discovery_file, 'r') as filey:
+            service = build_from_document(filey.read(),
+                                          credentials=credentials,
+                                          http=http)
+    else:
+        try:
+            service = build(service_type, version,
+                            credentials=credentials,
+                            http=http,
+                            static_discovery=True)
+
+        # Older clients always fetch the document
+        except TypeError:
+            service = build(service_type, version,
+                            credentials=credentials,
+                            http=http)
 
-    credentials = GoogleCredentials.get_application_default()
-    return build(service_type, version, credentials=credentials)
+    if cache:
+        google_cache.set(key, service)
+    return service
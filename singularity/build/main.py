@@ -16,30 +16,37 @@ from singularity.version import (
     __version__ as singularity_python_version
 )
 
-from spython.main import Client
-
 from singularity.analysis.apps import extract_apps
+from singularity.build.cache import (
+    get_build_cache,
+    get_build_key,
+    load_cached_build,
+    save_cached_build
+)
 from singularity.build.utils import (
-    stop_if_result_none,
     get_singularity_version,
+    run_tasks,
     test_container
 )
 
 from singularity.analysis.reproduce import get_image_file_hash
-from singularity.utils import download_repo
+from singularity.http_client import (
+    get_client,
+    run
+)
+from singularity.utils import fetch_repo
 
 from datetime import datetime
 from glob import glob
+from urllib.parse import urljoin
+import asyncio
 import io
 import json
 import os
 import pickle
 import re
-import requests
 
 from singularity.build.auth import generate_header_signature
-from retrying import retry
-# https://cloud.google.com/storage/docs/exponential-backoff
 
 import shutil
 import sys
@@ -50,9 +57,10 @@ from singularity.logger import bot
 
 def run_build(build_dir, params, verbose=True):
     '''run_build takes a build directory and params dictionary, and does the following:
-      - downloads repo to a temporary directory
-      - changes branch or commit, if needed
-      - creates and bootstraps singularity image from Singularity file
+      - fetches the commit (or branch) of the repo to a temporary directory
+      - creates and bootstraps singularity image from Singularity file, or
+        reuses a cached image if the recipe and its files were built before
+        (params build_cache, or SINGULARITY_BUILD_CACHE)
       - returns a dictionary with: 
           image (path), metadata (dict)
 
@@ -61,17 +69,26 @@ def run_build(build_dir, params, verbose=True):
 
     '''
 
-    # Download the repository
+    # spython is imported when a build runs, to keep imports fast
+    from spython.main import Client
 
-    download_repo(repo_url=params['repo_url'],
-                  destination=build_dir)
+    # Fetch only the commit (or head of the branch) to build, without history
+
+    commit = fetch_repo(repo_url=params['repo_url'],
+                        destination=build_dir,
+                        commit=params['commit'] or None,
+                        branch=params['branch'],
+                        sparse_paths=params.get('sparse_paths'),
+                        cache_dir=params.get('repo_cache',
+                                             os.environ.get('SINGULARITY_REPO_CACHE')))
+
+    if commit is None:
+        bot.error("Cannot fetch %s, cancelling." %params['repo_url'])
+        sys.exit(1)
 
     os.chdir(build_dir)
 
-    if params['branch'] != None:
-        bot.info('Checking out branch %s' %params['branch'])
-        os.system('git checkout %s' %(params['branch']))
-    else:
+    if params['branch'] == None:
         params['branch'] = "master"
 
 
@@ -79,15 +96,10 @@ def run_build(build_dir, params, verbose=True):
 
     Client.debug = params['debug']
 
-    # Commit
-
-    if params['commit'] not in [None,'']:
-        bot.info('Checking out commit %s' %params['commit'])
-        os.system('git checkout %s .' %(params['commit']))
-
     # From here on out commit is used as a unique id, if we don't have one, we use current
-    else:
-        params['commit'] = os.popen('git log -n 1 --pretty=format:"%H"').read()
+
+    if params['commit'] in [None,'']:
+        params['commit'] = commit
         bot.warning("commit not specified, setting to current %s" %params['commit'])
 
     # Dump some params for the builder, in case it fails after this
@@ -103,6 +115,25 @@ def run_build(build_dir, params, verbose=True):
             bot.info("%s is a symbolic link." %params['spec_file'])
             params['spec_file'] = os.path.realpath(params['spec_file'])
 
+        # Identical recipe and files were already built? Reuse the image
+        cache_dir = get_build_cache(params.get('build_cache'))
+        build_key = None
+        cached = None
+        if cache_dir is not None:
+            build_key = get_build_key(params['spec_file'], build_dir)
+            cached = load_cached_build(build_key, cache_dir)
+        if cached is not None:
+            bot.info("Found cached build %s, skipping build." %build_key)
+            metrics = cached['metadata']
+            metrics['build_cache'] = 'hit'
+            metrics['build_cache_key'] = build_key
+            params['version'] = metrics['version']
+            pickle.dump(params, open(passing_params,'wb'))
+            return {'image': cached['image'],
+                    'metadata': metrics,
+                    'params': params,
+                    'files': cached.get('files')}
+
         # START TIMING
         start_time = datetime.now()
 
@@ -111,8 +142,24 @@ def run_build(build_dir, params, verbose=True):
                              build_folder=build_dir,
                              isolated=True)
 
+        final_time = (datetime.now() - start_time).seconds
+        bot.info("Final time of build %s seconds." %final_time)  
+
+        # Post build stages run at the same time, so inspect, apps and
+        # the test overlap with hashing the image (the slowest)
+        Client.debug = False
+        tasks = {'version': (lambda: get_image_file_hash(image), []),
+                 'test': (lambda: test_container(image), []),
+                 'singularity_version': (get_singularity_version, []),
+                 'inspect': (lambda: Client.inspect(image), []), # this is a string
+                 'app_names': (lambda: Client.apps(image), []),
+                 'apps': (lambda app_names: extract_apps(image, app_names),
+                          ['app_names'])}
+        results, durations = run_tasks(tasks)
+        Client.debug = params['debug']
+
         # Save has for metadata (also is image name)
-        version = get_image_file_hash(image)
+        version = results['version']
         params['version'] = version
         pickle.dump(params, open(passing_params,'wb'))
 
@@ -120,33 +167,26 @@ def run_build(build_dir, params, verbose=True):
         finished_image = "%s/%s.simg" %(os.path.dirname(image), version)
         image = shutil.move(image, finished_image)
 
-        final_time = (datetime.now() - start_time).seconds
-        bot.info("Final time of build %s seconds." %final_time)  
-
         # Did the container build successfully?
-        test_result = test_container(image)
+        test_result = results['test']
         if test_result['return_code'] != 0:
             bot.error("Image failed to build, cancelling.")
             sys.exit(1)
 
-        # Get singularity version
-        singularity_version = Client.version()
-        Client.debug = False
-        inspect = Client.inspect(image) # this is a string
-        Client.debug = params['debug']
-
-        # Get information on apps
-        Client.debug = False
-        app_names = Client.apps(image)
-        Client.debug = params['debug']
-        apps = extract_apps(image, app_names)
-        
         metrics = {'build_time_seconds': final_time,
-                   'singularity_version': singularity_version,
+                   'stage_time_seconds': durations,
+                   'singularity_version': results['singularity_version'],
                    'singularity_python_version': singularity_python_version, 
-                   'inspect': inspect,
+                   'inspect': results['inspect'],
                    'version': version,
-                   'apps': apps}
+                   'apps': results['apps'],
+                   'build_cache': 'disabled'}
+
+        # The cache keeps its own link to the image, with the metadata
+        if build_key is not None:
+            metrics['build_cache'] = 'miss'
+            metrics['build_cache_key'] = build_key
+            save_cached_build(build_key, image, metrics, cache_dir=cache_dir)
   
         output = {'image':image,
                   'metadata':metrics,
@@ -164,15 +204,35 @@ def run_build(build_dir, params, verbose=True):
         sys.exit(1)
 
 
-@retry(wait_exponential_multiplier=1000, wait_exponential_max=10000, stop_max_attempt_number=5)
 def send_build_data(build_dir, data, secret, 
-                    response_url=None,clean_up=True):
-    '''finish build sends the build and data (response) to a response url
+                    response_url=None,clean_up=True,timeout=60):
+    '''finish build sends the build and data (response) to a response url,
+    and waits until the server acknowledges receipt (see wait_for_ack).
+    The post is retried on connection errors and transient statuses (see
+    AsyncClient). Returns True if the build was acknowledged (or there is
+    no response url), False otherwise.
     :param build_dir: the directory of the build
     :response_url: where to send the response. If None, won't send
     :param data: the data object to send as a post
-    :param clean_up: If true (default) removes build directory
+    :param clean_up: If true (default) removes build directory, once the
+    build is acknowledged
+    :param timeout: seconds to wait for the server to acknowledge the build
     '''
+    return run(send_build_data_async(build_dir, data, secret,
+                                     response_url=response_url,
+                                     clean_up=clean_up,
+                                     timeout=timeout))
+
+
+async def send_build_data_async(build_dir, data, secret,
+                                response_url=None, clean_up=True,
+                                timeout=60, client=None):
+    '''send_build_data_async is send_build_data for an event loop, so
+    several builds can be sent at once.
+    :param client: the AsyncClient to send with (default get_client)
+    '''
+    client = client or get_client()
+
     # Send with Authentication header
     body = '%s|%s|%s|%s|%s' %(data['container_id'],
                               data['commit'],
@@ -187,28 +247,92 @@ def send_build_data(build_dir, data, secret,
     headers = {'Authorization': signature }
 
     if response_url is not None:
-        finish = requests.post(response_url,data=data, headers=headers)
+        finish = await client.post(response_url, data=data, headers=headers)
         bot.debug("RECEIVE POST TO SINGULARITY HUB ---------------------")
         bot.debug(finish.status_code)
         bot.debug(finish.reason)
+        received = await wait_for_ack_async(finish, headers=headers,
+                                            timeout=timeout, client=client)
+        if not received:
+            bot.error("%s did not receive the build." %response_url)
+            return False
     else:
         bot.warning("response_url set to None, skipping sending of build.")
 
     if clean_up == True:
         shutil.rmtree(build_dir)
+    return True
+
+
+def wait_for_ack(response, headers=None, timeout=60, max_interval=5):
+    '''wait_for_ack waits until the server has received a build, before the
+    instance can be brought down. A 200 (or other success) response means the
+    build was received. A 202 (accepted) response means it's being processed,
+    and the acknowledgement url (the Location header) is polled until it
+    returns 200, with exponential backoff (or the server's Retry-After).
+    Returns True if the build was acknowledged, False otherwise.
+    :param response: the response to the post of the build
+    :param headers: headers (authorization) for polling
+    :param timeout: seconds to wait for the acknowledgement
+    :param max_interval: the most seconds to wait between polls
+    '''
+    return run(wait_for_ack_async(response, headers=headers, timeout=timeout,
+                                  max_interval=max_interval))
 
-    # Delay a bit, to give buffer between bringing instance down
-    time.sleep(20)
 
+async def wait_for_ack_async(response, headers=None, timeout=60,
+                             max_interval=5, client=None):
+    '''wait_for_ack_async is wait_for_ack for an event loop, polls wait
+    without blocking other requests.
+    :param client: the AsyncClient to poll with (default get_client)
+    '''
+    client = client or get_client()
+    start = time.time()
+    interval = 0.25
+    while response.status_code == 202:
+
+        ack_url = response.headers.get('Location')
+        if ack_url is None:
+            bot.warning("Build accepted without an acknowledgement url.")
+            return False
+        ack_url = urljoin(response.url, ack_url)
+
+        try:
+            wait = float(response.headers.get('Retry-After', interval))
+        except ValueError:
+            wait = interval
+        if time.time() - start + wait > timeout:
+            bot.warning("Build was not acknowledged after %s seconds." %timeout)
+            return False
+
+        await asyncio.sleep(wait)
+        interval = min(interval * 2, max_interval)
+        remaining = max(timeout - (time.time() - start), 0.1)
+        response = await client.get(ack_url, headers=headers, timeout=remaining)
+        bot.debug("ACKNOWLEDGEMENT %s", response.status_code)
+
+    if response.status_code >= 300:
+        bot.warning("Build was not received: %s %s" %(response.status_code,
+                                                     response.reason))
+        return False
+    return True
 
 
-@retry(wait_exponential_multiplier=1000, wait_exponential_max=10000,retry_on_result=stop_if_result_none)
 def send_build_close(params,response_url):
     '''send build close sends a final response (post) to the server to bring down
     the instance. The following must be included in params:
 
     repo_url, logfile, repo_id, secret, log_file, token
     '''
+    return run(send_build_close_async(params, response_url))
+
+
+async def send_build_close_async(params, response_url, client=None):
+    '''send_build_close_async is send_build_close for an event loop.
+    :param client: the AsyncClient to send with (default get_client)
+    '''
+    client = client or get_client()
+
     # Finally, package everything to send back to shub
     response = {"log": json.dumps(params['log_file']),
                 "repo_url": params['repo_url'],
@@ -228,7 +352,7 @@ def send_build_close(params,response_url):
 
     headers = {'Authorization': signature }
 
-    finish = requests.post(response_url,data=response, headers=headers)
+    finish = await client.post(response_url, data=response, headers=headers)
     bot.debug("FINISH POST TO SINGULARITY HUB ---------------------")
     bot.debug(finish.status_code)
     bot.debug(finish.reason)
@@ -25,6 +25,7 @@ from singularity.logger import bot
 
 from singularity.utils import (
     get_installdir,
+    get_runtime,
     read_file,
     run_command
 )
@@ -38,6 +39,7 @@ from subprocess import (
 )
 
 import tempfile
+import time
 import zipfile
 
 ######################################################################################
@@ -63,6 +65,66 @@ def test_container(image_path):
     return run_command(testing_command)
     
 
+######################################################################################
+# Task Graph
+######################################################################################
+
+def run_tasks(tasks, workers=None):
+    '''run_tasks will run a set of tasks in a thread pool, each as soon as the
+    tasks it depends on are done. Results of dependencies are passed to a task
+    as keyword arguments (by name). Returns a dictionary of results and one
+    with the duration (seconds) of each task. If a task raises an exception,
+    it is raised after running tasks finish, and tasks not started are skipped.
+    :param tasks: a dictionary, task name --> (function, list of dependencies)
+    :param workers: the number of threads, defaults to the number of tasks
+    '''
+    from concurrent.futures import (
+        ThreadPoolExecutor,
+        FIRST_COMPLETED,
+        wait
+    )
+
+    for name, (func, depends) in tasks.items():
+        missing = [d for d in depends if d not in tasks]
+        if missing:
+            bot.error("Task %s depends on unknown tasks %s" %(name, ','.join(missing)))
+            sys.exit(1)
+
+    results = dict()
+    durations = dict()
+
+    def run_task(name):
+        func, depends = tasks[name]
+        start = time.time()
+        result = func(**{d: results[d] for d in depends})
+        durations[name] = time.time() - start
+        return result
+
+    pending = dict(tasks)
+    running = dict()
+    with ThreadPoolExecutor(max_workers=workers or max(len(tasks), 1)) as pool:
+        while pending or running:
+
+            # Submit every task with all dependencies done
+            for name, (func, depends) in list(pending.items()):
+                if all(d in results for d in depends):
+                    running[pool.submit(run_task, name)] = name
+                    del pending[name]
+
+            if not running:
+                bot.error("Tasks %s have circular dependencies" % ','.join(pending))
+                sys.exit(1)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    raise future.exception()
+                results[name] = future.result()
+
+    return results, durations
+
+
 ######################################################################################
 # Build Templates
 ######################################################################################
@@ -106,24 +168,13 @@ def get_build_template(template_name,params=None,to_file=None):
 def get_singularity_version(singularity_version=None):
     '''get_singularity_version will determine the singularity version for a build
     first, an environmental variable is looked at, followed by using the system
-    version.
+    version (detected once, see get_runtime).
     '''
 
     if singularity_version is None:        
-        singularity_version = os.environ.get("SINGULARITY_VERSION")
-        
-    if singularity_version is None:
-        try:
-            cmd = ['singularity','--version']
-            output = run_command(cmd)
-
-            if isinstance(output['message'],bytes):
-                output['message'] = output['message'].decode('utf-8')
-            singularity_version = output['message'].strip('\n')
-            bot.info("Singularity %s being used." % singularity_version)
-            
-        except:
-            singularity_version = None
+        runtime = get_runtime()
+        singularity_version = runtime.version
+        if singularity_version is None:
             bot.warning("Singularity version not found, so it's likely not installed.")
 
     return singularity_version
@@ -0,0 +1,284 @@
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+from singularity.logger import bot
+
+import asyncio
+import atexit
+import functools
+import json
+import os
+import threading
+import weakref
+
+# aiohttp is optional (pip install singularity[async]), without it requests
+# are sent with requests, in threads. It's imported when a client first
+# sends a request, not with the module.
+_aiohttp = False
+
+
+def get_aiohttp():
+    '''get_aiohttp returns the aiohttp module, or None if it's not installed'''
+    global _aiohttp
+    if _aiohttp is False:
+        try:
+            import aiohttp
+            _aiohttp = aiohttp
+        except ImportError:
+            _aiohttp = None
+    return _aiohttp
+
+
+################################################################################
+# Asynchronous HTTP
+################################################################################
+
+
+class Response(object):
+    '''Response is what the client keeps of a response, read in full before
+    the connection goes back to the pool. It has the attributes of a
+    requests response that are used here (status_code, reason, headers, url).
+    '''
+    def __init__(self, status_code, reason, headers, url, content):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.url = url
+        self.content = content
+
+    def __str__(self):
+        return "<Response [%s]>" %self.status_code
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class AsyncClient(object):
+    '''AsyncClient sends requests from one pool of connections. Failed
+    requests (connection errors, timeouts and transient statuses) are retried
+    with exponential backoff, waiting with asyncio.sleep so other requests
+    go on. A client belongs to the event loop it's first used in.
+
+    Parameters
+    ==========
+    timeout: seconds for each request (default SINGULARITY_HTTP_TIMEOUT, 30)
+    limit: the most connections open at once (default 10)
+    retries: the most attempts of a request (default SINGULARITY_HTTP_RETRIES, 5)
+    backoff: seconds to wait after the first failure, doubled after each
+    max_backoff: the most seconds to wait between attempts
+    '''
+
+    retry_statuses = (429, 502, 503, 504)
+
+    def __init__(self, timeout=None, limit=10, retries=None,
+                       backoff=1, max_backoff=10):
+
+        if timeout is None:
+            timeout = float(os.environ.get('SINGULARITY_HTTP_TIMEOUT', 30))
+        if retries is None:
+            retries = int(os.environ.get('SINGULARITY_HTTP_RETRIES', 5))
+
+        self.timeout = timeout
+        self.limit = limit
+        self.retries = max(retries, 1)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._session = None
+
+
+    def __str__(self):
+        return "AsyncClient:%s" %('aiohttp' if get_aiohttp() else 'requests')
+
+
+    def session(self):
+        '''return the session (the pool of connections), created when first
+        needed, in the running event loop'''
+        aiohttp = get_aiohttp()
+        if self._session is None:
+            if aiohttp is not None:
+                connector = aiohttp.TCPConnector(limit=self.limit)
+                self._session = aiohttp.ClientSession(connector=connector)
+            else:
+                import requests
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.limit)
+                self._session = requests.Session()
+                self._session.mount('http://', adapter)
+                self._session.mount('https://', adapter)
+        return self._session
+
+
+    def errors(self):
+        '''the exceptions of a request that are worth another attempt'''
+        aiohttp = get_aiohttp()
+        if aiohttp is not None:
+            return (aiohttp.ClientError, asyncio.TimeoutError)
+        import requests
+        return (requests.RequestException,)
+
+
+    async def send(self, method, url, timeout, **kwargs):
+        '''send a request once, and read the response'''
+        aiohttp = get_aiohttp()
+        if aiohttp is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+            async with self.session().request(method, url, **kwargs) as response:
+                content = await response.read()
+                return Response(response.status,
+                                response.reason,
+                                response.headers.copy(),
+                                str(response.url),
+                                content)
+
+        request = functools.partial(self.session().request, method, url,
+                                    timeout=timeout, **kwargs)
+        response = await asyncio.get_running_loop().run_in_executor(None, request)
+        return Response(response.status_code,
+                        response.reason,
+                        response.headers,
+                        response.url,
+                        response.content)
+
+
+    async def request(self, method, url, timeout=None, retries=None, **kwargs):
+        '''request sends a request, with retries. The response of the last
+        attempt is returned, even with an error status, and the error of the
+        last attempt is raised if there is no response.
+        :param method: the http method (e.g., GET, POST)
+        :param url: the url to send the request to
+        :param timeout: seconds for each attempt (default self.timeout)
+        :param retries: the most attempts (default self.retries)
+        :param kwargs: headers, params, data (a dictionary is form encoded)
+        '''
+        timeout = timeout or self.timeout
+        retries = retries or self.retries
+        wait = self.backoff
+
+        for attempt in range(1, retries + 1):
+            try:
+                response = await self.send(method, url, timeout, **kwargs)
+                if response.status_code not in self.retry_statuses or attempt == retries:
+                    return response
+                reason = response.status_code
+            except self.errors() as e:
+                if attempt == retries:
+                    raise
+                reason = e.__class__.__name__
+
+            bot.debug("%s %s failed (%s), retrying in %s seconds",
+                      method, url, reason, wait)
+            await asyncio.sleep(wait)
+            wait = min(wait * 2, self.max_backoff)
+
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+
+    async def close(self):
+        '''close the session, and its connections'''
+        if self._session is not None:
+            if get_aiohttp() is not None:
+                await self._session.close()
+            else:
+                self._session.close()
+            self._session = None
+
+
+# A client for each event loop
+clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    '''get_client returns the client shared by the running event loop'''
+    loop = asyncio.get_running_loop()
+    if loop not in clients:
+        clients[loop] = AsyncClient()
+    return clients[loop]
+
+
+################################################################################
+# Synchronous API
+################################################################################
+
+# Coroutines of sync calls run in one event loop, in a thread, so that the
+# connections of its client are kept between calls.
+background_loop = None
+background_lock = threading.Lock()
+
+
+def get_loop():
+    '''get_loop returns the event loop for sync calls, started when first
+    needed in a daemon thread'''
+    global background_loop
+    with background_lock:
+        if background_loop is None:
+            background_loop = asyncio.new_event_loop()
+            threading.Thread(target=background_loop.run_forever,
+                             name='singularity-http',
+                             daemon=True).start()
+            atexit.register(close_loop)
+    return background_loop
+
+
+def close_loop():
+    '''close the client of the event loop for sync calls (at exit)'''
+    client = clients.get(background_loop)
+    if client is not None:
+        try:
+            asyncio.run_coroutine_threadsafe(client.close(), background_loop).result(5)
+        except Exception:
+            pass
+
+
+def run(coroutine):
+    '''run a coroutine in the event loop for sync calls, and return its
+    result (or raise its exception)'''
+    loop = get_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        coroutine.close()
+        raise RuntimeError('a sync call was made from a coroutine, await it instead.')
+    return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+
+def request(method, url, **kwargs):
+    '''request sends a request with the shared client (see AsyncClient.request)
+    and waits for the response'''
+    async def send():
+        return await get_client().request(method, url, **kwargs)
+    return run(send())
+
+
+def get_all(urls, **kwargs):
+    '''get_all gets urls at once, and returns the responses in order'''
+    async def send():
+        client = get_client()
+        return await asyncio.gather(*[client.get(url, **kwargs) for url in urls])
+    return run(send())
@@ -1,2 +1,3 @@
 from .message import bot
 from .progress import ProgressBar
+from .stats import Stats
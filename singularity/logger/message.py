@@ -17,8 +17,13 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
 
+from collections import (
+    deque,
+    namedtuple
+)
 import os
 import sys
+import time
 from .spinner import Spinner
 
 ABORT = -5
@@ -40,11 +45,15 @@ RED = "\033[91m"
 DARKRED = "\033[31m"
 CYAN = "\033[36m"
 
+# A message kept in the history
+LogRecord = namedtuple('LogRecord', ['level', 'timestamp', 'prefix', 'message'])
+
 class SingularityMessage:
 
     def __init__(self, MESSAGELEVEL=None):
         self.level = get_logging_level()
-        self.history = []
+        self.history_level = get_history_level()
+        self.history = deque(maxlen=get_history_size())
         self.errorStream = sys.stderr
         self.outputStream = sys.stdout
         self.colorize = self.useColor()
@@ -119,13 +128,31 @@ class SingularityMessage:
             return True
         return False
 
-    def emit(self, level, message, prefix=None, color=None):
+    def emit(self, level, message, prefix=None, color=None, args=None):
         '''emit is the main function to print the message
         optionally with a prefix
         :param level: the level of the message
         :param message: the message to print
         :param prefix: a prefix for the message
+        :param args: arguments to format the message with (%), only done if
+        the message is printed or kept in the history
         '''
+        # Skip messages (e.g., debug) that won't be printed or kept
+        if level > self.level and level > self.history_level:
+            return
+
+        if args:
+            message = message % args
+        if isinstance(message, bytes):
+            message = message.decode('utf-8')
+
+        # Add log messages to history, without color
+        self.history.append(LogRecord(level, time.time(), prefix, message))
+
+        # If the level is quiet, only print to error
+        if self.level == QUIET or not self.isEnabledFor(level):
+            return
+
         if color is None:
             color = level
 
@@ -141,19 +168,11 @@ class SingularityMessage:
         if not message.endswith('\n'):
             message = "%s\n" % message
 
-        # If the level is quiet, only print to error
-        if self.level == QUIET:
-            pass
-
         # Otherwise if in range print to stdout and stderr
-        elif self.isEnabledFor(level):
-            if self.emitError(level):
-                self.write(self.errorStream, message)
-            else:
-                self.write(self.outputStream, message)
-
-        # Add all log messages to history
-        self.history.append(message)
+        if self.emitError(level):
+            self.write(self.errorStream, message)
+        else:
+            self.write(self.outputStream, message)
 
     def write(self, stream, message):
         '''write will write a message to a stream,
@@ -163,13 +182,29 @@ class SingularityMessage:
             message = message.decode('utf-8')
         stream.write(message)
 
+    def iter_logs(self, level=None, records=False):
+        '''iter_logs yields the messages in the history (the most recent,
+        see get_history_size), oldest first, as lines or (if records is True)
+        records with level, timestamp, prefix and message.
+        :param level: only messages at this level (or more important)
+        '''
+        for record in list(self.history):
+            if level is not None and record.level > level:
+                continue
+            if records:
+                yield record
+            elif record.prefix is not None:
+                yield "%s %s" % (record.prefix, record.message.rstrip('\n'))
+            else:
+                yield record.message.rstrip('\n')
+
     def get_logs(self, join_newline=True):
         ''''get_logs will return the complete history, joined by newline
         (default) or as is.
         '''
         if join_newline:
-            return '\n'.join(self.history)
-        return self.history
+            return '\n'.join(self.iter_logs())
+        return list(self.iter_logs())
 
 
     def show_progress(
@@ -223,44 +258,44 @@ class SingularityMessage:
     # Logging ------------------------------------------
 
 
-    def abort(self, message):
-        self.emit(ABORT, message, 'ABORT')
+    def abort(self, message, *args):
+        self.emit(ABORT, message, 'ABORT', args=args)
 
-    def critical(self, message):
-        self.emit(CRITICAL, message, 'CRITICAL')
+    def critical(self, message, *args):
+        self.emit(CRITICAL, message, 'CRITICAL', args=args)
 
-    def error(self, message):
-        self.emit(ERROR, message, 'ERROR')
+    def error(self, message, *args):
+        self.emit(ERROR, message, 'ERROR', args=args)
 
-    def warning(self, message):
-        self.emit(WARNING, message, 'WARNING')
+    def warning(self, message, *args):
+        self.emit(WARNING, message, 'WARNING', args=args)
 
-    def log(self, message):
-        self.emit(LOG, message, 'LOG')
+    def log(self, message, *args):
+        self.emit(LOG, message, 'LOG', args=args)
 
     def custom(self, prefix, message, color=PURPLE):
         self.emit(CUSTOM, message, prefix, color)
 
-    def info(self, message):
-        self.emit(INFO, message)
+    def info(self, message, *args):
+        self.emit(INFO, message, args=args)
 
     def newline(self):
         return self.info("")
 
-    def verbose(self, message):
-        self.emit(VERBOSE, message, "VERBOSE")
+    def verbose(self, message, *args):
+        self.emit(VERBOSE, message, "VERBOSE", args=args)
 
-    def verbose1(self, message):
-        self.emit(VERBOSE, message, "VERBOSE1")
+    def verbose1(self, message, *args):
+        self.emit(VERBOSE, message, "VERBOSE1", args=args)
 
-    def verbose2(self, message):
-        self.emit(VERBOSE2, message, 'VERBOSE2')
+    def verbose2(self, message, *args):
+        self.emit(VERBOSE2, message, 'VERBOSE2', args=args)
 
-    def verbose3(self, message):
-        self.emit(VERBOSE3, message, 'VERBOSE3')
+    def verbose3(self, message, *args):
+        self.emit(VERBOSE3, message, 'VERBOSE3', args=args)
 
-    def debug(self, message):
-        self.emit(DEBUG, message, 'DEBUG')
+    def debug(self, message, *args):
+        self.emit(DEBUG, message, 'DEBUG', args=args)
 
     def is_quiet(self):
         '''is_quiet returns true if the level is under 1
@@ -328,6 +363,28 @@ def get_logging_level():
     return level
 
 
+def get_history_size():
+    '''get_history_size returns the number of messages to keep in the
+    history, from SINGULARITY_LOG_HISTORY (default 10000)
+    '''
+    try:
+        return int(os.environ.get('SINGULARITY_LOG_HISTORY', 10000))
+    except ValueError:
+        return 10000
+
+
+def get_history_level():
+    '''get_history_level returns the least important level of messages to
+    keep in the history even when not printed, from
+    SINGULARITY_LOG_HISTORY_LEVEL (default INFO). Messages that are printed
+    are always kept.
+    '''
+    try:
+        return int(os.environ.get('SINGULARITY_LOG_HISTORY_LEVEL', INFO))
+    except ValueError:
+        return INFO
+
+
 def get_user_color_preference():
     COLORIZE = os.environ.get('SINGULARITY_COLORIZE', None)
     if COLORIZE is not None:
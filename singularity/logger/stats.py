@@ -0,0 +1,117 @@
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+from collections import defaultdict
+from contextlib import contextmanager
+import time
+
+
+class Stats(object):
+    '''Stats records the wall time of stages (e.g., export, walk, hash) and
+    counters (e.g., files_hashed, bytes_read) of a job. Pass it as stats to
+    the functions that support it, and read or log it after.
+
+    Parameters
+    ==========
+    name: a name for the job, used when logging
+    '''
+    def __init__(self, name=None):
+        self.name = name or "stats"
+        self.timers = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    def __str__(self):
+        return "Stats:%s" %self.name
+
+    def __bool__(self):
+        return True
+
+    @contextmanager
+    def timer(self, stage):
+        '''time a stage, adding to its total if it's timed more than once'''
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.timers[stage] += time.perf_counter() - start
+
+    def add_time(self, stage, seconds):
+        self.timers[stage] += seconds
+
+    def count(self, counter, value=1):
+        self.counters[counter] += value
+
+    def to_dict(self):
+        return {'seconds': dict(self.timers),
+                'counts': dict(self.counters)}
+
+    def log(self, bot=None):
+        '''log the stats with the bot (at info), one line for timers and one
+        for counters'''
+        if bot is None:
+            from singularity.logger import bot
+        timers = ', '.join("%s %.3fs" %(k, v) for k, v in self.timers.items())
+        counters = ', '.join("%s %s" %(k, v) for k, v in self.counters.items())
+        bot.info("%s: %s" %(self.name, timers or "no stages"))
+        if counters:
+            bot.info("%s: %s" %(self.name, counters))
+
+
+class NoStats(object):
+    '''NoStats is used when stats are disabled, and does nothing. It's false,
+    so a function can skip work that is only for stats with "if stats:"
+    '''
+    name = "nostats"
+
+    def __bool__(self):
+        return False
+
+    def timer(self, stage):
+        return null_timer
+
+    def add_time(self, stage, seconds):
+        pass
+
+    def count(self, counter, value=1):
+        pass
+
+    def to_dict(self):
+        return {}
+
+    def log(self, bot=None):
+        pass
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+null_timer = NullTimer()
+no_stats = NoStats()
+
+
+def get_stats(stats=None):
+    '''return stats, or (if None) the shared no-op stats'''
+    if stats is None:
+        return no_stats
+    return stats
@@ -1,8 +1,11 @@
-from .utils import (
-    get_container_contents
-)
+from singularity.utils import lazy_attributes
 
-from .clone import (
-    package_node,
-    unpack_node
-)
+# Functions are imported from their modules when first used
+imports = {
+    'get_container_contents': ('.utils', 'get_container_contents'),
+    'package_node': ('.clone', 'package_node'),
+    'unpack_node': ('.clone', 'unpack_node')
+}
+
+__all__ = list(imports)
+__getattr__, __dir__ = lazy_attributes(__name__, imports)
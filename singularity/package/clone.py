@@ -17,7 +17,6 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
 
-from spython.main import Client
 import tempfile
 from singularity.logger import bot
 from singularity.utils import run_command
@@ -20,7 +20,6 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import collections
 import os
 import re
-import requests
 
 import shutil
 import json
@@ -63,7 +62,7 @@ def zip_up(file_list,zip_name,output_folder=None):
     # Write files to zip, depending on type
     for filename,content in file_list.items():
 
-        bot.debug("Adding %s to package..." %filename)
+        bot.debug("Adding %s to package...", filename)
 
         # If it's the files list, move files into the archive
         if filename.lower() == "files":
@@ -114,12 +113,13 @@ def zip_up(file_list,zip_name,output_folder=None):
 ############################################################################
 
 
-def get_container_contents(container, split_delim=None):
+def get_container_contents(container, split_delim=None, gets=None):
     '''get_container_contents will return a list of folders and or files
     for a container. The environmental variable SINGULARITY_HUB being set
     means that container objects are referenced instead of packages
     :param container: the container to get content for
-    :param gets: a list of file names to return, without parent folders
+    :param gets: a list of file names to return, without parent folders (by
+    default, all files of a container object)
     :param split_delim: if defined, will split text by split delimiter
     '''
 
@@ -141,12 +141,18 @@ def get_container_contents(container, split_delim=None):
 
         # user has provided a container, but not a package
         else:
+            from singularity.http_client import get_all
+            links = dict()
             for sfile in container.files:
-                for gut_key in gets:        
-                    if os.path.basename(sfile['name']) == gut_key:
-                        if split_delim == None:
-                            guts[gut_key] = requests.get(sfile['mediaLink']).text
-                        else:
-                            guts[gut_key] = requests.get(sfile['mediaLink']).text.split(split_delim)
+                gut_key = os.path.basename(sfile['name'])
+                if gets is None or gut_key in gets:
+                    links[gut_key] = sfile['mediaLink']
+
+            # The files are downloaded at once
+            for gut_key, response in zip(links, get_all(list(links.values()))):
+                if split_delim == None:
+                    guts[gut_key] = response.text
+                else:
+                    guts[gut_key] = response.text.split(split_delim)
 
     return guts
@@ -0,0 +1,349 @@
+#!/usr/bin/python
+
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+# Benchmark the reproduce and compare hot paths on synthetic sandboxes, so
+# no singularity is needed, and optionally make_container_tree over trees of
+# increasing size, and the import time of modules. This is not collected as
+# a test, run it directly (as a file or a module) from the repository. The
+# results are compared to the baseline (benchmark.json, made with the default
+# settings and --imports), or to other saved results:
+#
+#    python singularity/tests/benchmark.py --imports
+#    python -m singularity.tests.benchmark --imports
+#    python singularity/tests/benchmark.py --files 5000 --output results.json
+#    python singularity/tests/benchmark.py --files 5000 --baseline results.json
+#    python singularity/tests/benchmark.py --trees 1000 10000 100000
+#    python singularity/tests/benchmark.py --imports --only none
+#
+# To update the baseline after an intended change (on the same machine):
+#
+#    python singularity/tests/benchmark.py --imports --output singularity/tests/benchmark.json
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# The folder with the package, and the results of the default settings,
+# compared to unless --baseline is given
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+BASELINE = os.path.join(ROOT, 'singularity', 'tests', 'benchmark.json')
+
+# Top level folders of a sandbox, so the reproducibility levels match files
+TOP_LEVEL = ['bin', 'etc', 'lib', 'usr', 'opt', 'home', 'var']
+
+# Modules timed by the import benchmark
+MODULES = ['singularity',
+           'singularity.analysis.compare',
+           'singularity.analysis.reproduce',
+           'singularity.build.google',
+           'singularity.build.main',
+           'singularity.build.utils',
+           'singularity.package',
+           'singularity.views']
+
+# Dependencies that are slow to import, and should be loaded when needed
+HEAVY = ['aiohttp', 'googleapiclient', 'pandas', 'requests', 'scipy',
+         'spython.main']
+
+
+def generate_tree(n_folders, depth=8, width=10, files_per_folder=3, seed=0):
+    '''generate a synthetic listing of n_folders folders (and files in them),
+    with folders nested up to depth levels, each with up to width children.
+    '''
+    rand = random.Random(seed)
+    folders = set()
+    while len(folders) < n_folders:
+        levels = rand.randint(1, depth)
+        path = "/".join(["d%s" % rand.randint(0, width) for _ in range(levels)])
+        folders.add(path)
+    folders = list(folders)
+    files = ["%s/file%s" % (folder, i) for folder in folders
+                                       for i in range(files_per_folder)]
+    return folders, files
+
+
+def generate_sandbox(root, n_files=1000, depth=4, width=5, mean_size=4096,
+                     seed=0, changed=0.0):
+    '''generate a synthetic sandbox at root with n_files files, in folders
+    nested up to depth under the usual top level folders, and the metadata
+    folder .singularity.d. File sizes are exponentially distributed with
+    mean_size bytes. With the same seed, the same sandbox is generated,
+    except for a proportion of files (changed) with different content.
+    '''
+    rand = random.Random(seed)
+    change = random.Random(seed + 1)
+    n_folders = max(1, n_files // 10)
+    folders, _ = generate_tree(n_folders, depth=depth, width=width,
+                               files_per_folder=0, seed=seed)
+    folders = ["%s/%s" % (rand.choice(TOP_LEVEL), x) for x in folders]
+    folders += ['.singularity.d/env', '.singularity.d/libs']
+
+    for folder in folders:
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    files = ['.singularity.d/runscript', '.singularity.d/labels.json',
+             '.singularity.d/env/90-environment.sh', 'environment']
+    files += ["%s/file%s%s" % (rand.choice(folders), i,
+                               rand.choice(['', '.py', '.so', '.txt']))
+              for i in range(n_files - len(files))]
+
+    for filename in files:
+        size = int(rand.expovariate(1.0 / mean_size))
+        content = bytes(rand.getrandbits(8) for _ in range(min(size, 64)))
+        content = (content * (size // 64 + 1))[:size]
+        if changed and change.random() < changed:
+            content += b'changed'
+        with open(os.path.join(root, filename), 'wb') as filey:
+            filey.write(content)
+    return root
+
+
+def get_benchmarks(sandbox1, sandbox2):
+    '''return a lookup of benchmark names to functions, to compare two
+    sandboxes (and tars of them)
+    '''
+    from singularity.analysis.classify import (
+        extension_counts,
+        file_counts,
+        get_tags
+    )
+    from singularity.analysis.compare import compare_lists
+    from singularity.analysis.reproduce import (
+        assess_differences,
+        get_image_hash,
+        get_image_hashes
+    )
+    from singularity.analysis.reproduce.utils import extract_guts
+    from singularity.views.trees import make_container_tree
+
+    guts1 = extract_guts(sandbox1)
+    guts2 = extract_guts(sandbox2)
+
+    return {'get_image_hash': lambda: get_image_hash(sandbox1, level='REPLICATE'),
+            'get_image_hashes': lambda: get_image_hashes(sandbox1),
+            'extract_guts': lambda: extract_guts(sandbox1),
+            'assess_differences': lambda: assess_differences(sandbox1, sandbox2),
+            'compare_lists': lambda: compare_lists(guts1['all'], guts2['all']),
+            'make_container_tree': lambda: make_container_tree(files=guts1['all']),
+            'get_tags': lambda: get_tags(file_list=guts1['all']),
+            'file_counts': lambda: file_counts(file_list=guts1['all'],
+                                               patterns=['readme', 'license']),
+            'extension_counts': lambda: extension_counts(file_list=guts1['all'])}
+
+
+def run_benchmark(n_files=1000, depth=4, mean_size=4096, repeat=3,
+                  names=None, tmpdir=None):
+    '''run the benchmarks on two generated sandboxes (10% of files changed),
+    returning a dictionary with the settings, and for each benchmark the
+    best and median seconds of repeat runs.
+    '''
+    from singularity.logger import bot
+    from singularity.logger.message import QUIET
+    tmpdir = tmpdir or tempfile.mkdtemp()
+    sandbox1 = generate_sandbox(os.path.join(tmpdir, 'sandbox1'), n_files,
+                                depth=depth, mean_size=mean_size)
+    sandbox2 = generate_sandbox(os.path.join(tmpdir, 'sandbox2'), n_files,
+                                depth=depth, mean_size=mean_size, changed=0.1)
+    benchmarks = get_benchmarks(sandbox1, sandbox2)
+
+    # The functions are chatty at info
+    level = bot.level
+    bot.level = QUIET
+    results = dict()
+    try:
+        for name, func in benchmarks.items():
+            if names and name not in names:
+                continue
+            times = []
+            for _ in range(repeat):
+                start = time.time()
+                func()
+                times.append(time.time() - start)
+            times.sort()
+            results[name] = {'best': times[0], 'median': times[len(times) // 2]}
+    finally:
+        bot.level = level
+        shutil.rmtree(tmpdir)
+
+    return {'settings': {'files': n_files, 'depth': depth,
+                         'mean_size': mean_size, 'repeat': repeat,
+                         'python': platform.python_version()},
+            'results': results}
+
+
+def run_tree_benchmark(sizes):
+    '''time make_container_tree for each size (number of folders), returning
+    a list of (n_folders, n_files, seconds)
+    '''
+    from singularity.views.trees import make_container_tree
+    results = []
+    for size in sizes:
+        folders, files = generate_tree(size)
+        start = time.time()
+        make_container_tree(folders=folders, files=files)
+        results.append((size, len(files), time.time() - start))
+    return results
+
+
+def import_time(module):
+    '''import a module in a new interpreter (from the repository), returning
+    the (cumulative) import time in milliseconds, and the heavy dependencies
+    it imported.
+    '''
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import %s' % module],
+                            stderr=subprocess.PIPE, check=True, cwd=ROOT)
+    seconds = None
+    imported = set()
+    for line in output.stderr.decode('utf-8').split('\n'):
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = [x.strip() for x in line.split('|')]
+        if name in HEAVY:
+            imported.add(name)
+        if name == module:
+            seconds = int(cumulative) / 1000.0
+    return seconds, sorted(imported)
+
+
+def run_import_benchmark(modules=None, repeat=5):
+    '''time the import of each module (the best of repeat), returning a
+    dictionary with milliseconds and heavy dependencies imported
+    '''
+    results = dict()
+    for module in modules or MODULES:
+        times = []
+        for _ in range(repeat):
+            milliseconds, imported = import_time(module)
+            times.append(milliseconds)
+        results[module] = {'milliseconds': min(times), 'imported': imported}
+    return results
+
+
+def compare_baseline(results, baseline, tolerance=1.5, minimum=0.01):
+    '''return a lookup of benchmarks slower than tolerance times the baseline
+    (best of runs) to their ratio to the baseline. Being slower by less than
+    minimum seconds is noise, not a regression. Modules (of imports) that
+    import a heavy dependency they didn't before are included too.
+    '''
+    regressions = dict()
+    for name, result in results['results'].items():
+        before = baseline['results'].get(name)
+        if before is None or before['best'] == 0:
+            continue
+        ratio = result['best'] / before['best']
+        if ratio > tolerance and result['best'] - before['best'] > minimum:
+            regressions[name] = ratio
+
+    for module, result in results.get('imports', {}).items():
+        before = baseline.get('imports', {}).get(module)
+        if before is None or not before['milliseconds']:
+            continue
+        ratio = result['milliseconds'] / before['milliseconds']
+        slower = result['milliseconds'] - before['milliseconds'] > minimum * 1000
+        if (ratio > tolerance and slower or
+            set(result['imported']) - set(before['imported'])):
+            regressions['import %s' % module] = ratio
+    return regressions
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="singularity python benchmarks")
+    parser.add_argument('--files', type=int, default=1000,
+                        help="number of files in each sandbox")
+    parser.add_argument('--depth', type=int, default=4,
+                        help="the deepest nesting of folders")
+    parser.add_argument('--mean-size', type=int, default=4096, dest='mean_size',
+                        help="the mean file size, in bytes")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs of each benchmark")
+    parser.add_argument('--only', nargs='+', default=None,
+                        help="only run these benchmarks")
+    parser.add_argument('--trees', type=int, nargs='+', default=None,
+                        help="time make_container_tree for these numbers of folders")
+    parser.add_argument('--imports', action='store_true',
+                        help="time the import of modules")
+    parser.add_argument('--output', default=None,
+                        help="write results (json) to this file")
+    parser.add_argument('--baseline', default=BASELINE,
+                        help="compare to results (json) in this file, or none")
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help="slowdown from the baseline that is a regression")
+    return parser
+
+
+if __name__ == '__main__':
+
+    # Run as a file, the package is found from the repository
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    args = get_parser().parse_args()
+    results = run_benchmark(n_files=args.files,
+                            depth=args.depth,
+                            mean_size=args.mean_size,
+                            repeat=args.repeat,
+                            names=args.only)
+
+    print("%24s %12s %12s" % ('benchmark', 'best', 'median'))
+    for name, result in results['results'].items():
+        print("%24s %12.4f %12.4f" % (name, result['best'], result['median']))
+
+    if args.trees is not None:
+        results['trees'] = run_tree_benchmark(args.trees)
+        print("\n%12s %12s %12s" % ('folders', 'files', 'seconds'))
+        for folders, files, seconds in results['trees']:
+            print("%12s %12s %12.4f" % (folders, files, seconds))
+
+    if args.imports:
+        results['imports'] = run_import_benchmark()
+        print("\n%32s %12s  %s" % ('module', 'ms', 'imports'))
+        for module, result in results['imports'].items():
+            print("%32s %12.1f  %s" % (module, result['milliseconds'],
+                                        ', '.join(result['imported'])))
+
+    if args.output is not None:
+        with open(args.output, 'w') as filey:
+            filey.write(json.dumps(results, indent=4))
+
+    if args.baseline != 'none':
+        with open(args.baseline, 'r') as filey:
+            baseline = json.loads(filey.read())
+
+        # Timings of other settings can't be compared
+        settings = ['files', 'depth', 'mean_size']
+        if [baseline['settings'].get(x) for x in settings] != \
+           [results['settings'][x] for x in settings]:
+            print("\nThe baseline %s has other settings, not compared" % args.baseline)
+            sys.exit(0)
+
+        regressions = compare_baseline(results, baseline, tolerance=args.tolerance)
+        for name, ratio in regressions.items():
+            print("Regression: %s is %.2fx slower than the baseline" % (name, ratio))
+        if regressions:
+            sys.exit(1)
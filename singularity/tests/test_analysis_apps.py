@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+from singularity.utils import write_file
+import unittest
+import tempfile
+import shutil
+import os
+
+print("##################################################### test_analysis_apps")
+
+class TestAnalysisApps(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        files = {'foo/scif/labels.json': '{"MAINTAINER": "dinosaur"}',
+                 'foo/scif/env/90-environment.sh': 'export FOO=1\n',
+                 'bar/scif/runscript': '#!/bin/sh\necho bar\n\n',
+                 'bar/scif/runscript.help': 'bar does bar things'}
+        for filename, content in files.items():
+            filename = os.path.join(self.tmpdir, 'scif', 'apps', filename)
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            write_file(filename, content)
+
+        self.expected = {'foo': {'labels': {'MAINTAINER': 'dinosaur'},
+                                 'environment': 'export FOO=1\n'},
+                         'bar': {'runscript': '#!/bin/sh\necho bar\n\n',
+                                 'helpfile': 'bar does bar things'}}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_extract_apps(self):
+        from singularity.analysis.apps import extract_apps
+        print("Testing singularity.analysis.apps.extract_apps with a sandbox")
+        apps = extract_apps(self.tmpdir, ['foo', 'bar'])
+        for app_name, attributes in self.expected.items():
+            self.assertEqual(apps[app_name]['inspect']['data']['attributes'],
+                             attributes)
+        self.assertEqual(extract_apps(self.tmpdir, []), {})
+
+    def test_parse_apps_listing(self):
+        from singularity.analysis.apps import parse_apps_listing
+        print("Testing singularity.analysis.apps.parse_apps_listing")
+        output = ('SCIF foo labels.json\n{"MAINTAINER": "dinosaur"}\n'
+                  'SCIF foo env/90-environment.sh\nexport FOO=1\n\n'
+                  'SCIF bar runscript\n#!/bin/sh\necho bar\n\n\n'
+                  'SCIF bar runscript.help\nbar does bar things\n')
+        self.assertEqual(parse_apps_listing(output, 'SCIF'), self.expected)
+        self.assertEqual(parse_apps_listing('', 'SCIF'), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/python
+
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+from numpy.testing import (
+    assert_array_equal,
+    assert_almost_equal,
+    assert_equal
+)
+
+import unittest
+import numpy
+
+print("################################################## test_analysis_cluster")
+
+class TestAnalysisCluster(unittest.TestCase):
+
+    def setUp(self):
+        from scipy.spatial.distance import pdist
+        self.observations = numpy.random.RandomState(0).rand(30, 4)
+        self.distances = pdist(self.observations)
+
+    def test_get_linkage(self):
+        from singularity.analysis.cluster import get_linkage
+        from scipy.cluster.hierarchy import linkage
+        print("Testing singularity.analysis.cluster.get_linkage")
+        Z = get_linkage(distances=self.distances, method='average')
+        assert_almost_equal(Z, linkage(self.distances, 'average'))
+        Z = get_linkage(matrix=self.observations)
+        assert_almost_equal(Z, linkage(self.observations, 'ward'))
+        self.assertEqual(get_linkage(), None)
+
+    def test_knn_linkage(self):
+        from singularity.analysis.cluster import knn_graph, knn_linkage
+        from scipy.cluster.hierarchy import linkage, cophenet
+        from scipy.spatial.distance import squareform
+        print("Testing singularity.analysis.cluster.knn_graph")
+        similarity = 1.0 - squareform(self.distances)
+        graph = knn_graph(similarity, k=3, block_size=7)
+        assert_array_equal(graph.getnnz(axis=1), [3] * 30)
+        nearest = numpy.argsort(squareform(self.distances) + numpy.eye(30) * 10, axis=1)[:, 0]
+        for row in range(30):
+            self.assertTrue(graph[row, nearest[row]] > 0)
+
+        print("Testing singularity.analysis.cluster.knn_linkage")
+        print("Case 1: A complete graph is exactly single linkage")
+        Z = knn_linkage(knn_graph(similarity, k=29))
+        assert_almost_equal(cophenet(Z), cophenet(linkage(self.distances, 'single')))
+
+        print("Case 2: Sparse graphs give a valid linkage over all rows")
+        Z = knn_linkage(graph)
+        assert_equal(Z.shape, (29, 4))
+        assert_equal(Z[-1, 3], 30)
+        self.assertTrue(numpy.all(numpy.diff(Z[:, 2]) >= 0))
+
+        print("Case 3: Identical rows (zero distance) are still joined")
+        Z = knn_linkage(knn_graph(numpy.ones((4, 4)), k=1))
+        assert_equal(Z[:, 2], [0, 0, 0])
+        assert_equal(Z[-1, 3], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+from numpy.testing import assert_almost_equal
+
+import unittest
+import pandas
+import numpy
+
+print("################################################## test_analysis_metrics")
+
+class TestAnalysisMetrics(unittest.TestCase):
+
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.m1 = pandas.DataFrame(random.rand(12, 12))
+        self.m2 = pandas.DataFrame(random.rand(12, 12))
+        self.rows, self.cols = numpy.tril_indices(12, k=-1)
+
+    def test_RSA(self):
+        from singularity.analysis.metrics import RSA
+        from scipy.stats import pearsonr
+        print("Testing singularity.analysis.metrics.RSA")
+        expected = pearsonr(self.m1.values[self.rows, self.cols],
+                            self.m2.values[self.rows, self.cols])[0]
+        assert_almost_equal(RSA(self.m1, self.m2), expected)
+
+        print("Case 2: Undefined values are left out of the correlation")
+        m2 = self.m2.copy()
+        m2.iloc[5, 2] = numpy.nan
+        m2.iloc[2, 5] = numpy.nan  # upper triangle, not compared
+        keep = ~((self.rows == 5) & (self.cols == 2))
+        expected = pearsonr(self.m1.values[self.rows, self.cols][keep],
+                            self.m2.values[self.rows, self.cols][keep])[0]
+        assert_almost_equal(RSA(self.m1, m2), expected)
+
+    def test_RSA_batch(self):
+        from singularity.analysis.metrics import RSA, RSA_batch
+        print("Testing singularity.analysis.metrics.RSA_batch")
+        candidates = [self.m1, self.m2, self.m1 * 2 + 1]
+        scores = RSA_batch(self.m1, candidates)
+        assert_almost_equal(scores, [RSA(self.m1, c) for c in candidates])
+        assert_almost_equal(scores[2], 1.0)
+
+    def test_RSA_permutation(self):
+        from singularity.analysis.metrics import RSA, RSA_permutation
+        print("Testing singularity.analysis.metrics.RSA_permutation")
+        r, p = RSA_permutation(self.m1, self.m1 + self.m2 * 0.1,
+                               permutations=200, block_size=30, seed=1)
+        assert_almost_equal(r, RSA(self.m1, self.m1 + self.m2 * 0.1))
+        assert_almost_equal(p, 1 / 201.0)
+
+        print("Case 2: Unrelated matrices are not significant")
+        r, p = RSA_permutation(self.m1, self.m2, permutations=200, seed=1)
+        self.assertTrue(p > 0.05)
+        self.assertEqual((r, p), RSA_permutation(self.m1, self.m2,
+                                                 permutations=200, seed=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,434 @@
+#!/usr/bin/python
+
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+from singularity.tests.benchmark import generate_sandbox
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+print("################################################ test_analysis_reproduce")
+
+class TestAnalysisReproduce(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.sandbox = generate_sandbox(os.path.join(self.tmpdir, 'sandbox'),
+                                        n_files=100, mean_size=512)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_image_tar(self):
+        from singularity.analysis.reproduce.utils import (
+            create_tarfile,
+            delete_image_tar,
+            get_image_tar
+        )
+        print("Testing singularity.analysis.reproduce.get_image_tar")
+
+        print("Case 1: A sandbox is written to a temporary tar")
+        file_obj, tar = get_image_tar(self.sandbox)
+        names = set(x.name for x in tar)
+        self.assertTrue('./.singularity.d/runscript' in names)
+        self.assertTrue(delete_image_tar(file_obj, tar))
+        self.assertFalse(os.path.exists(file_obj))
+
+        print("Case 2: A tar is read in place, and kept")
+        image = create_tarfile(self.sandbox, os.path.join(self.tmpdir, 'image.tar'),
+                               arcname='.', mode='w')
+        file_obj, tar = get_image_tar(image)
+        self.assertEqual(set(x.name for x in tar), names)
+        self.assertFalse(delete_image_tar(file_obj, tar))
+        self.assertTrue(os.path.exists(image))
+
+    def test_get_image_hashes(self):
+        from singularity.analysis.reproduce import get_image_hashes, get_image_hash
+        from singularity.analysis.reproduce.utils import create_tarfile
+        print("Testing singularity.analysis.reproduce.get_image_hashes")
+        hashes = get_image_hashes(self.sandbox)
+        image = create_tarfile(self.sandbox, os.path.join(self.tmpdir, 'image.tar'),
+                               arcname='.', mode='w')
+        self.assertEqual(get_image_hash(image, level='REPLICATE'), hashes['REPLICATE'])
+
+        print("Case 2: Only files in the level change the hash")
+        with open(os.path.join(self.sandbox, 'environment'), 'a') as filey:
+            filey.write('export PANCAKES=yes')
+        changed = get_image_hashes(self.sandbox)
+        self.assertNotEqual(changed['RECIPE'], hashes['RECIPE'])
+        self.assertEqual(changed['BASE'], hashes['BASE'])
+
+    def test_stats(self):
+        from singularity.analysis.reproduce import get_image_hash
+        from singularity.analysis.reproduce.utils import extract_guts
+        from singularity.logger import Stats
+        print("Testing singularity.analysis.reproduce with stats")
+        stats = Stats()
+        get_image_hash(self.sandbox, level='REPLICATE', stats=stats)
+        self.assertEqual(set(stats.timers), set(['tar', 'hash']))
+        self.assertEqual(stats.counters['files_visited'], 100)
+        self.assertEqual(stats.counters['files_hashed'] + stats.counters['files_skipped'], 100)
+
+        stats = Stats()
+        guts = extract_guts(self.sandbox, stats=stats)
+        self.assertEqual(guts['stats']['counts']['files_hashed'], 100)
+        self.assertEqual(guts['stats']['counts']['bytes_read'], sum(guts['sizes'].values()))
+        self.assertTrue('stats' not in extract_guts(self.sandbox))
+
+        print("Case 2: Each level is compared with its own guts")
+        from singularity.analysis.reproduce.levels import get_level
+        from singularity.analysis.reproduce.metrics import assess_differences
+        other = os.path.join(self.tmpdir, 'other')
+        shutil.copytree(self.sandbox, other, symlinks=True)
+        with open(os.path.join(other, 'environment'), 'a') as filey:
+            filey.write('export PANCAKES=yes')
+        levels = dict((x, get_level(x)) for x in ['BASE', 'RECIPE'])
+        stats = Stats()
+        reports = assess_differences(self.sandbox, other, levels=levels, stats=stats)
+        self.assertEqual(reports['scores']['BASE'], 1.0)
+        self.assertTrue(reports['scores']['RECIPE'] < 1.0)
+        self.assertEqual(stats.counters.get('cache_hits', 0), 0)
+
+    def test_hash_images(self):
+        from singularity.analysis.reproduce import get_image_hashes
+        from singularity.analysis.reproduce.batch import (
+            hash_images,
+            load_checkpoint
+        )
+        from singularity.analysis.reproduce.utils import create_tarfile
+        print("Testing singularity.analysis.reproduce.batch.hash_images")
+        other = generate_sandbox(os.path.join(self.tmpdir, 'other'),
+                                 n_files=50, mean_size=512, seed=1)
+        image = create_tarfile(other, os.path.join(self.tmpdir, 'image.tar'),
+                               arcname='.', mode='w')
+        missing = os.path.join(self.tmpdir, 'missing.sif')
+        images = [self.sandbox, image, missing, self.sandbox]
+        checkpoint = os.path.join(self.tmpdir, 'hashes.jsonl')
+
+        print("Case 1: Images are hashed in processes, and errors are recorded")
+        records = dict((x['image'], x) for x in hash_images(images, checkpoint,
+                                                             workers=2))
+        self.assertEqual(set(records), set(images))
+        self.assertEqual(records[self.sandbox]['hashes'],
+                         get_image_hashes(self.sandbox))
+        self.assertEqual(records[image]['hashes'], get_image_hashes(other))
+        self.assertTrue('error' in records[missing])
+        self.assertEqual(len(load_checkpoint(checkpoint)), 3)
+
+        print("Case 2: A run continues from the checkpoint")
+        with open(checkpoint, 'a') as filey:
+            filey.write('{"image": "%s", "hash' % image)
+        self.assertEqual(list(hash_images(images, checkpoint, workers=1)), [])
+        records = list(hash_images(images, checkpoint, workers=1,
+                                   level_names=['RECIPE'], retry_errors=True))
+        self.assertEqual([x['image'] for x in records], [missing])
+        self.assertEqual(len(load_checkpoint(checkpoint)), 3)
+
+        print("Case 3: Only images exported to disk need an export slot")
+        from singularity.analysis.reproduce.batch import needs_export
+        from singularity.utils import get_runtime
+        sif = os.path.join(self.tmpdir, 'image.sif')
+        with open(sif, 'wb') as filey:
+            filey.write(b'#!/usr/bin/env run-singularity\n' * 64)
+        previous = os.environ.get('SINGULARITY_VERSION')
+        try:
+            os.environ['SINGULARITY_VERSION'] = '2.6.1'
+            self.assertFalse(needs_export(sif))
+            os.environ['SINGULARITY_VERSION'] = 'singularity version 3.5.2'
+            self.assertTrue(needs_export(sif))
+            self.assertFalse(needs_export(image) or needs_export(self.sandbox))
+        finally:
+            if previous is None:
+                del os.environ['SINGULARITY_VERSION']
+            else:
+                os.environ['SINGULARITY_VERSION'] = previous
+            get_runtime(refresh=True)
+
+    def test_scratch_space(self):
+        from singularity.analysis.reproduce.levels import get_level
+        from singularity.analysis.reproduce.metrics import assess_differences
+        from singularity.analysis.reproduce.scratch import (
+            ScratchSpace,
+            get_export_size,
+            get_scratch,
+            parse_size
+        )
+        from singularity.analysis.reproduce.utils import (
+            create_tarfile,
+            delete_image_tar,
+            exported_image,
+            get_image_tar
+        )
+        import threading
+        import time
+        print("Testing singularity.analysis.reproduce.scratch")
+        self.assertEqual(parse_size('2K'), 2048)
+        self.assertEqual(parse_size('1.5GB'), int(1.5 * 1024 ** 3))
+        self.assertEqual(parse_size('100'), 100)
+
+        print("Case 1: A reservation over the quota waits for a release")
+        root = os.path.join(self.tmpdir, 'scratch')
+        scratch = ScratchSpace(root=root, quota='1K')
+        first = scratch.reserve(800, owned=False)
+        released = []
+        def release():
+            time.sleep(0.2)
+            released.append(scratch.release(first))
+        threading.Thread(target=release).start()
+        with scratch.space(800) as second:
+            self.assertEqual(released, [True])
+            self.assertFalse(os.path.exists(first))
+            self.assertEqual(scratch.reserved, 800)
+        self.assertFalse(os.path.exists(second))
+        with self.assertRaises(TimeoutError):
+            with scratch.space(800):
+                scratch.reserve(800, timeout=0.1, wait=True)
+
+        print("Case 2: Exports are removed, also after an error")
+        self.assertEqual(os.listdir(root), [])
+        previous = os.environ.get('SINGULARITY_SCRATCH')
+        os.environ['SINGULARITY_SCRATCH'] = root
+        try:
+            scratch = get_scratch(refresh=True)
+            image = create_tarfile(self.sandbox, os.path.join(self.tmpdir, 'image.tar'),
+                                   arcname='.', mode='w')
+            with self.assertRaises(ValueError):
+                with exported_image(image) as sandbox:
+                    self.assertTrue(sandbox.startswith(root))
+                    self.assertTrue(os.path.exists(os.path.join(sandbox, 'environment')))
+                    raise ValueError('pancakes')
+            self.assertEqual(os.listdir(root), [])
+
+            print("Case 3: A tar of a sandbox is released when it's deleted")
+            file_obj, tar = get_image_tar(self.sandbox)
+            self.assertTrue(file_obj.startswith(root))
+            self.assertTrue(scratch.reserved > 0)
+            delete_image_tar(file_obj, tar)
+            self.assertEqual((os.listdir(root), scratch.reserved), ([], 0))
+
+            print("Case 4: Two exports are compared when one fits the quota and two don't")
+            other = create_tarfile(self.sandbox, os.path.join(self.tmpdir, 'other.tar'),
+                                   arcname='.', mode='w')
+            os.environ['SINGULARITY_SCRATCH_QUOTA'] = str(get_export_size(image) * 3 // 2)
+            scratch = get_scratch(refresh=True)
+            reports = []
+            thread = threading.Thread(target=lambda: reports.append(
+                assess_differences(image, other, levels={'REPLICATE': get_level('REPLICATE')})))
+            thread.daemon = True
+            thread.start()
+            thread.join(timeout=30)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(reports[0]['scores']['REPLICATE'], 1.0)
+            self.assertEqual((os.listdir(root), scratch.reserved), ([], 0))
+
+            print("Case 5: A thread holding space doesn't wait on itself")
+            with scratch.space(scratch.quota):
+                with scratch.space(scratch.quota, timeout=1):
+                    self.assertEqual(scratch.reserved, 2 * scratch.quota)
+        finally:
+            del os.environ['SINGULARITY_SCRATCH_QUOTA']
+            if previous is None:
+                del os.environ['SINGULARITY_SCRATCH']
+            else:
+                os.environ['SINGULARITY_SCRATCH'] = previous
+            get_scratch(refresh=True)
+
+        print("Case 6: A relative root is released from another folder")
+        pwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        try:
+            scratch = ScratchSpace(root='relative')
+            path = scratch.reserve(100)
+        finally:
+            os.chdir(pwd)
+        self.assertEqual(scratch.root, os.path.join(self.tmpdir, 'relative'))
+        self.assertTrue(scratch.release(path))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(scratch.reserved, 0)
+
+    def test_export_cache(self):
+        from singularity.analysis.reproduce.exports import (
+            ExportCache,
+            ExportEntry,
+            get_export_cache
+        )
+        from singularity.analysis.reproduce.levels import get_level
+        from singularity.analysis.reproduce.metrics import assess_differences
+        from singularity.analysis.reproduce.scratch import (
+            ScratchSpace,
+            get_scratch
+        )
+        from singularity.analysis.reproduce.utils import (
+            create_tarfile,
+            export_sandbox,
+            extract_guts
+        )
+        from singularity.logger import Stats
+        import threading
+        print("Testing singularity.analysis.reproduce.exports.ExportCache")
+        images = []
+        for name in ['one', 'two', 'three']:
+            images.append(create_tarfile(self.sandbox,
+                                         os.path.join(self.tmpdir, '%s.tar' % name),
+                                         arcname='.', mode='w'))
+        size = os.path.getsize(images[0]) * 3
+        scratch = ScratchSpace(root=os.path.join(self.tmpdir, 'scratch'))
+        cache = ExportCache(budget=size * 2, scratch=scratch)
+        exports = []
+        def export(image_path, folder):
+            exports.append(image_path)
+            return export_sandbox(image_path, folder)
+
+        print("Case 1: An image is exported once, and shared")
+        stats = Stats()
+        with cache.sandbox(images[0], export, stats) as first:
+            with cache.sandbox(images[0], export, stats) as second:
+                self.assertEqual(first, second)
+        self.assertEqual(exports, [images[0]])
+        self.assertEqual(stats.counters['export_cache_hits'], 1)
+        self.assertTrue(os.path.exists(os.path.join(first, 'environment')))
+
+        print("Case 2: The least recently used sandbox not in use is removed")
+        with cache.sandbox(images[1], export):
+            with cache.sandbox(images[0], export):
+                pass
+            with cache.sandbox(images[2], export) as third:
+                self.assertEqual(len(cache.entries), 2)
+        self.assertFalse(os.path.exists(first))
+        self.assertTrue(os.path.exists(third))
+        self.assertEqual(len(exports), 3)
+        self.assertTrue(cache.size <= cache.budget)
+
+        print("Case 3: A changed image is exported again")
+        with open(images[2], 'ab') as filey:
+            filey.write(b'\0' * 1024)
+        with cache.sandbox(images[2], export):
+            pass
+        self.assertEqual(exports[-1], images[2])
+        self.assertEqual(len(exports), 4)
+
+        print("Case 4: Analyses share the cache when it's enabled")
+        cache.clear()
+        self.assertEqual(os.listdir(scratch.root), [])
+        os.environ['SINGULARITY_EXPORT_CACHE_SIZE'] = '1G'
+        try:
+            stats = Stats()
+            first = extract_guts(images[0], stats=stats)
+            second = extract_guts(images[0], stats=stats)
+            self.assertEqual(first['hashes'], second['hashes'])
+            self.assertEqual(stats.counters['export_cache_hits'], 1)
+            self.assertEqual(stats.counters['export_cache_misses'], 1)
+
+            print("Case 5: Two images are compared when one export fits the quota")
+            os.environ['SINGULARITY_SCRATCH_QUOTA'] = str(size * 3 // 2)
+            get_scratch(refresh=True)
+            stats = Stats()
+            reports = []
+            thread = threading.Thread(target=lambda: reports.append(
+                assess_differences(images[0], images[1], stats=stats,
+                                   levels={'REPLICATE': get_level('REPLICATE')})))
+            thread.daemon = True
+            thread.start()
+            thread.join(timeout=30)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(reports[0]['scores']['REPLICATE'], 1.0)
+            self.assertEqual(stats.counters['export_cache_misses'], 2)
+
+            # Sandboxes kept don't count as space the thread holds
+            self.assertEqual(get_scratch().owners, {})
+        finally:
+            del os.environ['SINGULARITY_EXPORT_CACHE_SIZE']
+            os.environ.pop('SINGULARITY_SCRATCH_QUOTA', None)
+            get_scratch(refresh=True)
+            self.assertEqual(get_export_cache(), None)
+
+        print("Case 6: Only the sandboxes needed to fit the quota are removed")
+        scratch = ScratchSpace(root=os.path.join(self.tmpdir, 'quota'), quota=3500)
+        cache = ExportCache(budget='1G', scratch=scratch)
+        for key in range(3):
+            folder = scratch.reserve(1000, owned=False)
+            cache.entries[key] = ExportEntry(folder, folder, 1000)
+        cache.make_room(1000)
+        self.assertEqual(list(cache.entries), [1, 2])
+        self.assertEqual(scratch.reserved, 2000)
+
+    def test_stream_image_tar(self):
+        from singularity.analysis.reproduce import get_image_hashes
+        from singularity.analysis.reproduce.hash import hash_members
+        from singularity.analysis.reproduce.levels import get_levels
+        from singularity.analysis.reproduce.utils import (
+            create_tarfile,
+            stream_image_tar
+        )
+        import time
+        print("Testing singularity.analysis.reproduce.utils.stream_image_tar")
+        image = create_tarfile(self.sandbox, os.path.join(self.tmpdir, 'image.tar'),
+                               arcname='.', mode='w')
+
+        print("Case 1: All levels are hashed in one pass of the stream")
+        with stream_image_tar(image, command=['cat', image]) as tar:
+            hashes = hash_members(tar, get_levels())
+        self.assertEqual(hashes, get_image_hashes(self.sandbox))
+
+        print("Case 2: A stream that is stopped ends the export")
+        start = time.time()
+        command = ['sh', '-c', 'cat %s; sleep 30' % image]
+        with stream_image_tar(image, command=command) as tar:
+            for member in tar:
+                break
+        self.assertTrue(time.time() - start < 10)
+
+        print("Case 3: A failed export is an error")
+        with self.assertRaises(SystemExit):
+            with stream_image_tar(image, command=['false']) as tar:
+                list(tar)
+
+    def test_run_benchmark(self):
+        from singularity.tests.benchmark import (
+            BASELINE,
+            compare_baseline,
+            get_parser,
+            run_benchmark
+        )
+        print("Testing singularity.tests.benchmark.run_benchmark")
+        results = run_benchmark(n_files=50, repeat=1,
+                                names=['extract_guts', 'compare_lists'])
+        self.assertEqual(set(results['results']), set(['extract_guts', 'compare_lists']))
+        slower = {'results': {k: {'best': v['best'] / 10.0}
+                              for k, v in results['results'].items()}}
+        slower['results']['compare_lists']['best'] = 0
+        self.assertEqual(list(compare_baseline(results, slower, minimum=0)),
+                         ['extract_guts'])
+        self.assertEqual(compare_baseline(results, slower, minimum=60), {})
+
+        # The baseline is of the default settings
+        with open(BASELINE, 'r') as filey:
+            baseline = json.loads(filey.read())
+        args = get_parser().parse_args([])
+        self.assertEqual(baseline['settings']['files'], args.files)
+        self.assertEqual(baseline['settings']['depth'], args.depth)
+        self.assertEqual(baseline['settings']['mean_size'], args.mean_size)
+        self.assertEqual(args.baseline, BASELINE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -31,10 +31,17 @@ from singularity.utils import (
     read_file
 )
 
+from http.server import (
+    BaseHTTPRequestHandler,
+    HTTPServer
+)
+import requests
+import threading
 import unittest
 import tempfile
 import shutil
 import json
+import time
 import os
 
 print("############################################################ test_build")
@@ -65,5 +72,92 @@ class TestBuildTemplate(unittest.TestCase):
  
 
 
+class Acknowledge(BaseHTTPRequestHandler):
+    '''a stub of the response url. The server has status, the status of the
+    post, and pending, the number of polls before the build is received'''
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.posts += 1
+        if self.server.status == 202:
+            return self.send(202, {'Location': '/ack/1', 'Retry-After': '0.1'})
+        self.send(self.server.status)
+
+    def do_GET(self):
+        self.server.polls += 1
+        self.server.pending -= 1
+        self.send(202 if self.server.pending > 0 else 200,
+                  {'Location': '/ack/1', 'Retry-After': '0.1'})
+
+
+class TestSendBuildData(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = HTTPServer(('127.0.0.1', 0), Acknowledge)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%s/build" %self.server.server_port
+        self.data = {'container_id': 1, 'commit': 'abc', 'branch': 'master',
+                     'token': 'pancakes', 'tag': 'latest'}
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def send(self, status, pending=0, timeout=60, clean_up=False):
+        from singularity.build.main import send_build_data
+        self.server.status = status
+        self.server.pending = pending
+        self.server.posts = 0
+        self.server.polls = 0
+        start = time.time()
+        self.received = send_build_data(self.tmpdir, self.data, secret='pancakes',
+                                        response_url=self.url, clean_up=clean_up,
+                                        timeout=timeout)
+        return time.time() - start
+
+    def test_send_build_data(self):
+        from singularity.build.main import wait_for_ack
+        print("Testing singularity.build.main.send_build_data")
+
+        print("Case 1: A received build finishes right away")
+        self.assertTrue(self.send(200) < 1)
+        self.assertEqual((self.server.posts, self.server.polls), (1, 0))
+        self.assertTrue(self.received)
+
+        print("Case 2: An accepted build is polled until it's received")
+        self.assertTrue(self.send(202, pending=3) < 5)
+        self.assertEqual((self.server.posts, self.server.polls), (1, 3))
+
+        print("Case 3: Waiting stops at the timeout")
+        self.assertTrue(self.send(202, pending=100, timeout=0.5, clean_up=True) < 2)
+        self.assertTrue(self.server.polls < 100)
+        self.assertFalse(self.received)
+        self.assertTrue(os.path.exists(self.tmpdir))
+
+        print("Case 4: An acknowledgement is only a success")
+        self.server.status = 500
+        response = requests.post(self.url)
+        self.assertFalse(wait_for_ack(response))
+        self.server.status = 202
+        self.server.pending = 1
+        self.assertTrue(wait_for_ack(requests.post(self.url)))
+
+        print("Case 5: A build that isn't received is kept")
+        self.send(500, clean_up=True)
+        self.assertFalse(self.received)
+        self.assertTrue(os.path.exists(self.tmpdir))
+
+
 if __name__ == '__main__':
     unittest.main()
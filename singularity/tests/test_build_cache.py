@@ -0,0 +1,97 @@
+#!/usr/bin/python
+
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+from singularity.utils import write_file
+import unittest
+import tempfile
+import shutil
+import os
+
+print("####################################################### test_build_cache")
+
+class TestBuildCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.context = os.path.join(self.tmpdir, 'context')
+        self.cache = os.path.join(self.tmpdir, 'cache')
+        os.mkdir(self.context)
+        os.mkdir(os.path.join(self.context, 'data'))
+        self.spec = os.path.join(self.context, 'Singularity')
+        write_file(self.spec, "Bootstrap: docker\nFrom: busybox\n\n"
+                              "%setup\n    cp -R data ${SINGULARITY_ROOTFS}/data\n\n"
+                              "%files\n    run.sh /run.sh\n")
+        write_file(os.path.join(self.context, 'run.sh'), "echo pancakes")
+        write_file(os.path.join(self.context, 'data', 'one.txt'), "1")
+        write_file(os.path.join(self.context, 'README.md'), "Hello")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_build_key(self):
+        from singularity.build.cache import get_build_key, get_recipe_files
+        print("Testing singularity.build.cache.get_build_key")
+        files = [os.path.basename(x) for x in get_recipe_files(self.spec)]
+        self.assertEqual(files, ['data', 'run.sh'])
+        key = get_build_key(self.spec)
+
+        print("Case 1: Files not referenced by the recipe don't change the key")
+        write_file(os.path.join(self.context, 'README.md'), "Goodbye")
+        self.assertEqual(get_build_key(self.spec), key)
+
+        print("Case 2: Referenced files and folders do")
+        write_file(os.path.join(self.context, 'data', 'two.txt'), "2")
+        new_key = get_build_key(self.spec)
+        self.assertNotEqual(new_key, key)
+        write_file(os.path.join(self.context, 'run.sh'), "echo waffles")
+        self.assertNotEqual(get_build_key(self.spec), new_key)
+
+    def test_cached_build(self):
+        from singularity.build.cache import load_cached_build, save_cached_build
+        print("Testing singularity.build.cache.save_cached_build")
+        image = os.path.join(self.tmpdir, 'container.simg')
+        write_file(image, "not really an image")
+
+        print("Case 1: Nothing is cached without a cache folder")
+        self.assertEqual(save_cached_build('key', image, {}), None)
+        self.assertEqual(load_cached_build('key'), None)
+
+        print("Case 2: The image outlives the build")
+        save_cached_build('key', image, {'version': 'abc'}, cache_dir=self.cache)
+        os.remove(image)
+        entry = load_cached_build('key', self.cache)
+        self.assertTrue(os.path.exists(entry['image']))
+        self.assertEqual(entry['metadata'], {'version': 'abc'})
+
+        print("Case 3: Storage files are added to an entry")
+        save_cached_build('key', files=['gs://bucket/abc.simg'], cache_dir=self.cache)
+        entry = load_cached_build('key', self.cache)
+        self.assertEqual(entry['files'], ['gs://bucket/abc.simg'])
+        self.assertEqual(entry['metadata'], {'version': 'abc'})
+
+        print("Case 4: A missing image is a miss")
+        os.remove(entry['image'])
+        self.assertEqual(load_cached_build('key', self.cache), None)
+        self.assertEqual(load_cached_build('other', self.cache), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
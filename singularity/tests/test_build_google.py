@@ -0,0 +1,396 @@
+#!/usr/bin/python
+
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer
+)
+import threading
+import unittest
+import types
+import tempfile
+import shutil
+import json
+import os
+
+print("###################################################### test_build_google")
+
+
+class FakeStorage(BaseHTTPRequestHandler):
+    '''a (very) small Google Storage, for buckets, resumable uploads and listing. The server
+    has uploads (session id to bytes), objects, and failures (the chunk
+    requests to fail, counting from 1)
+    '''
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body=None, headers=None):
+        body = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        from urllib.parse import urlparse, parse_qs
+        path = urlparse(self.path).path
+        if not path.endswith('/o'):
+            self.server.buckets += 1
+            return self.send(200, {'id': path.split('/')[-1]})
+
+        query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter')
+        entries = set()
+        for name in self.server.objects:
+            if not name.startswith(prefix):
+                continue
+            if delimiter and delimiter in name[len(prefix):]:
+                rest = name[len(prefix):]
+                name = prefix + rest[:rest.index(delimiter) + 1]
+            entries.add(name)
+
+        start = int(query.get('pageToken', 0))
+        end = start + int(query.get('maxResults', 1000))
+        page = sorted(entries)[start:end]
+        body = {'items': [{'name': x, 'size': str(len(self.server.objects[x]))}
+                          for x in page if x in self.server.objects],
+                'prefixes': [x for x in page if x not in self.server.objects]}
+        if end < len(entries):
+            body['nextPageToken'] = str(end)
+        self.send(200, body)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+
+        # The response (and logging) url of a build
+        if not self.path.startswith('/upload'):
+            from urllib.parse import parse_qs
+            body = parse_qs(self.rfile.read(length).decode('utf-8'))
+            server.posts.append((self.path, {k: v[0] for k, v in body.items()}))
+            return self.send(200)
+
+        name = json.loads(self.rfile.read(length).decode('utf-8'))['name']
+        with server.lock:
+            session = str(len(server.uploads))
+            server.uploads[session] = {'name': name, 'data': b''}
+        location = "http://127.0.0.1:%s/session/%s" %(server.server_port, session)
+        self.send(200, headers={'Location': location})
+
+    def do_PUT(self):
+        server = self.server
+        upload = server.uploads[self.path.split('/')[-1]]
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        content_range = self.headers['Content-Range'].split(' ')[-1]
+        total = int(content_range.split('/')[-1])
+
+        if data:
+            with server.lock:
+                server.chunks += 1
+                if server.chunks in server.failures:
+                    return self.send(503)
+            server.received += len(data)
+            upload['data'] += data
+
+        if len(upload['data']) == total:
+            server.objects[upload['name']] = upload['data']
+            return self.send(200, {'name': upload['name'], 'size': str(total)})
+        headers = {}
+        if upload['data']:
+            headers['Range'] = 'bytes=0-%s' %(len(upload['data']) - 1)
+        self.send(308, headers=headers)
+
+
+class TestBuildGoogle(unittest.TestCase):
+
+    def setUp(self):
+        from googleapiclient.discovery import build_from_document
+        from googleapiclient.discovery_cache import get_static_doc
+        from googleapiclient.http import build_http
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeStorage)
+        self.server.lock = threading.Lock()
+        self.server.uploads = dict()
+        self.server.objects = dict()
+        self.server.failures = []
+        self.server.chunks = 0
+        self.server.received = 0
+        self.server.buckets = 0
+        self.server.posts = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        # The storage api, pointed at the fake server
+        document = json.loads(get_static_doc('storage', 'v1'))
+        document['rootUrl'] = "http://127.0.0.1:%s/" %self.server.server_port
+        self.discovery_file = os.path.join(self.tmpdir, 'storage.json')
+        with open(self.discovery_file, 'w') as filey:
+            filey.write(json.dumps(document))
+        self.get_service = lambda: build_from_document(document,
+                                                       http=build_http())
+        self.bucket = {'id': 'singularityhub'}
+
+        self.files = []
+        for name, size in [('one.simg', 1024 * 1024), ('two.simg', 300000)]:
+            self.files.append(os.path.join(self.tmpdir, name))
+            with open(self.files[-1], 'wb') as filey:
+                filey.write(os.urandom(size))
+
+    def tearDown(self):
+        from singularity.build.google.utils import google_cache
+        google_cache.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, file_name):
+        with open(file_name, 'rb') as filey:
+            return filey.read()
+
+    def test_get_google_service(self):
+        from singularity.build.google.utils import (
+            get_google_service,
+            google_cache,
+            TimedCache
+        )
+        from singularity.build.google.storage import get_bucket
+        from googleapiclient.http import build_http
+        print("Testing singularity.build.google.utils.get_google_service")
+        google_cache.clear()
+
+        print("Case 1: The service is built from a discovery file, once")
+        http = build_http()
+        service = get_google_service(discovery_file=self.discovery_file, http=http)
+        self.assertTrue(service is get_google_service(discovery_file=self.discovery_file,
+                                                      http=http))
+        self.assertTrue(service is not get_google_service(discovery_file=self.discovery_file,
+                                                          http=http, cache=False))
+
+        print("Case 2: The bucket is only fetched once")
+        self.assertEqual(get_bucket(service, 'singularityhub'), self.bucket)
+        self.assertEqual(get_bucket(service, 'singularityhub'), self.bucket)
+        self.assertEqual(self.server.buckets, 1)
+        get_bucket(service, 'singularityhub', cache=False)
+        self.assertEqual(self.server.buckets, 2)
+        google_cache.clear()
+
+        print("Case 3: Values expire")
+        cache = TimedCache(ttl=0)
+        cache.set('bucket', self.bucket)
+        self.assertEqual(cache.get('bucket'), None)
+        cache = TimedCache(ttl=60)
+        cache.set('bucket', self.bucket)
+        self.assertEqual(cache.get('bucket'), self.bucket)
+
+    def test_get_instance_metadata(self):
+        from singularity.build.google import instances
+        print("Testing singularity.build.google.instances.get_instance_metadata")
+        metadata_file = os.path.join(self.tmpdir, 'metadata.json')
+        with open(metadata_file, 'w') as filey:
+            filey.write(json.dumps({'dobuild': 'true', 'repo_url': 'github.com/vsoch/hello'}))
+
+        try:
+            print("Case 1: Metadata is read from a file, once")
+            os.environ['SINGULARITY_METADATA_FILE'] = metadata_file
+            self.assertEqual(instances.get_instance_metadata(refresh=True)['dobuild'], 'true')
+            os.remove(metadata_file)
+            params = instances.get_build_params([{'key': 'repo_url', 'value': None},
+                                                 {'key': 'tag', 'value': None},
+                                                 {'key': 'logfile', 'value': 'log'}])
+            self.assertEqual(params, {'repo_url': 'github.com/vsoch/hello',
+                                      'tag': None, 'logfile': 'log'})
+
+            print("Case 2: Metadata is read from the environment")
+            del os.environ['SINGULARITY_METADATA_FILE']
+            os.environ['SINGULARITY_METADATA'] = json.dumps({'debug': 'true'})
+            instances.get_instance_metadata(refresh=True)
+            self.assertEqual(instances.get_build_metadata('debug'), 'true')
+            self.assertEqual(instances.get_build_metadata('dobuild'), None)
+        finally:
+            os.environ.pop('SINGULARITY_METADATA_FILE', None)
+            os.environ.pop('SINGULARITY_METADATA', None)
+            instances.instance_metadata = None
+
+    def test_run_build(self):
+        from singularity.build.cache import get_build_key, save_cached_build
+        from singularity.build.google import instances, storage
+        from singularity.utils import run_command, write_file
+        print("Testing singularity.build.google.instances.run_build")
+
+        # A repository with a recipe, built before (in the build cache)
+        repo = os.path.join(self.tmpdir, 'repo')
+        git = ['git', '-C', repo, '-c', 'user.name=dinosaur',
+               '-c', 'user.email=dinosaur@pancakes.com']
+        run_command(['git', 'init', '-q', repo])
+        write_file(os.path.join(repo, 'Singularity'), "Bootstrap: docker\nFrom: busybox\n")
+        run_command(git + ['add', '.'])
+        run_command(git + ['commit', '-q', '-m', 'recipe'])
+        cache = os.path.join(self.tmpdir, 'cache')
+        key = get_build_key(os.path.join(repo, 'Singularity'), repo)
+        save_cached_build(key, self.files[0], {'version': 'abc'}, cache_dir=cache)
+
+        logfile = os.path.join(self.tmpdir, 'build.log')
+        write_file(logfile, 'Building...')
+        url = "http://127.0.0.1:%s" %self.server.server_port
+        metadata = {'dobuild': 'true',
+                    'repo_url': 'file://%s' %repo,
+                    'repo_id': '1',
+                    'container_id': '2',
+                    'response_url': '%s/build' %url,
+                    'logging_url': '%s/log' %url,
+                    'token': 'pancakes',
+                    'build_cache': cache,
+                    'upload_chunk_size': '256K'}
+
+        # The storage service is the fake server, without credentials
+        get_service = lambda *args, **kwargs: self.get_service()
+        functions = (instances.get_google_service, storage.get_google_service)
+        passing_params = "/tmp/params.pkl"
+        saved_params = None
+        if os.path.exists(passing_params):
+            saved_params = self.read(passing_params)
+        pwd = os.getcwd()
+        try:
+            os.environ['SINGULARITY_METADATA'] = json.dumps(metadata)
+            instances.get_instance_metadata(refresh=True)
+            instances.get_google_service = storage.get_google_service = get_service
+
+            print("Case 1: A build is uploaded, and sent to the response url")
+            instances.run_build(logfile=logfile)
+            uploaded = [x for x in self.server.objects if x.endswith('.simg')]
+            self.assertEqual(len(uploaded), 1)
+            self.assertEqual(self.server.objects[uploaded[0]], self.read(self.files[0]))
+            path, data = self.server.posts[-1]
+            self.assertEqual(path, '/build')
+            self.assertEqual(json.loads(data['files'])[0]['name'], uploaded[0])
+            self.assertEqual(json.loads(data['metadata'])['build_cache'], 'hit')
+
+            print("Case 2: The log is uploaded when the build is finished")
+            instances.finish_build()
+            path, data = self.server.posts[-1]
+            self.assertEqual(path, '/log')
+            log_file = json.loads(data['log'])
+            self.assertEqual(self.server.objects[log_file['name']], b'Building...')
+        finally:
+            os.chdir(pwd)
+            instances.get_google_service, storage.get_google_service = functions
+            os.environ.pop('SINGULARITY_METADATA', None)
+            instances.instance_metadata = None
+            if saved_params is None:
+                os.remove(passing_params)
+            else:
+                with open(passing_params, 'wb') as filey:
+                    filey.write(saved_params)
+
+    def test_upload_files(self):
+        from singularity.build.google.storage import UploadManager
+        print("Testing singularity.build.google.storage.UploadManager")
+
+        print("Case 1: Files are uploaded at once, in chunks")
+        manager = UploadManager(self.bucket,
+                                get_service=self.get_service,
+                                chunk_size=256 * 1024,
+                                workers=2)
+        files = manager.upload_files(self.files, 'github.com/vsoch/hello')
+        names = ['singularityhub/github.com/vsoch/hello/%s' %os.path.basename(x)
+                 for x in self.files]
+        self.assertEqual([x['name'] for x in files], names)
+        for name, file_name in zip(names, self.files):
+            self.assertEqual(self.server.objects[name], self.read(file_name))
+        self.assertEqual(manager.sessions, {})
+
+        print("Case 2: A chunk size is parsed, and a multiple of 256KB")
+        for chunk_size, expected in [('8M', 8 * 1024 * 1024),
+                                     ('300K', 256 * 1024),
+                                     (1000, 256 * 1024),
+                                     (None, UploadManager.chunk_size)]:
+            manager = UploadManager(self.bucket, chunk_size=chunk_size)
+            self.assertEqual(manager.chunk_size, expected)
+
+    def test_upload_resume(self):
+        from singularity.build.google.storage import UploadManager
+        print("Testing singularity.build.google.storage.UploadManager.resume")
+        state_file = os.path.join(self.tmpdir, 'uploads.json')
+        file_name = self.files[0]
+
+        print("Case 1: A failed upload keeps its session")
+        manager = UploadManager(self.bucket,
+                                get_service=self.get_service,
+                                chunk_size=256 * 1024,
+                                state_file=state_file)
+        self.server.failures = [3]
+        upload = UploadManager.upload.__wrapped__  # without retry
+        with self.assertRaises(Exception):
+            upload(manager, file_name, 'hello')
+        self.assertEqual(len(manager.sessions), 1)
+        self.assertTrue(os.path.exists(state_file))
+        self.assertEqual(self.server.received, 512 * 1024)
+
+        print("Case 2: A new manager continues from the last byte")
+        manager = UploadManager(self.bucket,
+                                get_service=self.get_service,
+                                chunk_size=256 * 1024,
+                                state_file=state_file)
+        result = manager.upload(file_name, 'hello')
+        self.assertEqual(result['name'], 'singularityhub/hello/one.simg')
+        self.assertEqual(self.server.objects[result['name']], self.read(file_name))
+        self.assertEqual(self.server.received, 1024 * 1024)
+        self.assertEqual(len(self.server.uploads), 1)
+        self.assertEqual(manager.sessions, {})
+
+    def test_list_bucket(self):
+        from singularity.build.google.storage import list_bucket
+        print("Testing singularity.build.google.storage.list_bucket")
+        names = ['README.md'] + ['%s/%s/container.simg' %(collection, i)
+                                 for collection in ['vsoch', 'dinosaur', 'pancakes']
+                                 for i in range(5)]
+        for name in names:
+            self.server.objects[name] = b'1'
+        service = self.get_service()
+
+        print("Case 1: Pages are followed to the end")
+        objects = list_bucket(self.bucket, service, page_size=4)
+        self.assertTrue(isinstance(objects, types.GeneratorType))
+        self.assertEqual([x['name'] for x in objects], sorted(names))
+
+        print("Case 2: Listing a prefix")
+        objects = list_bucket(self.bucket, service, prefix='vsoch/', page_size=2)
+        self.assertEqual([x['name'] for x in objects],
+                         [x for x in sorted(names) if x.startswith('vsoch/')])
+
+        print("Case 3: Listing folders at the same time")
+        objects = list_bucket(self.bucket, service, page_size=2, shard=True,
+                              workers=2, get_service=self.get_service)
+        self.assertEqual(sorted(x['name'] for x in objects), sorted(names))
+
+        print("Case 4: Closing the listing early")
+        objects = list_bucket(self.bucket, service, page_size=1, shard=True,
+                              workers=2, get_service=self.get_service)
+        self.assertEqual(next(objects)['name'], 'README.md')
+        next(objects)
+        objects.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -64,6 +64,35 @@ class TestBuildUtils(unittest.TestCase):
         self.assertTrue(do_retry)
 
 
+    def test_run_tasks(self):
+        '''run_tasks should run tasks at the same time, after the tasks
+        they depend on, and return results and durations
+        '''
+        from singularity.build.utils import run_tasks
+        import threading
+        import time
+
+        print("Case 1: Independent tasks overlap, dependencies get results")
+        started = threading.Barrier(2, timeout=5)
+        def wait_for(value):
+            started.wait()  # both must be running to pass
+            return value
+        tasks = {'one': (lambda: wait_for(1), []),
+                 'two': (lambda: wait_for(2), []),
+                 'sum': (lambda one, two: one + two, ['one', 'two'])}
+        results, durations = run_tasks(tasks)
+        self.assertEqual(results, {'one': 1, 'two': 2, 'sum': 3})
+        self.assertEqual(set(durations), set(['one', 'two', 'sum']))
+
+        print("Case 2: Exceptions are raised, and later tasks are skipped")
+        def fail():
+            raise ValueError('pizza')
+        tasks = {'fail': (fail, []),
+                 'after': (lambda fail: time.sleep(100), ['fail'])}
+        with self.assertRaises(ValueError):
+            run_tasks(tasks)
+
+
     def test_get_singularity_version(self):
         '''ensure that singularity --version returns a valid version string
         '''
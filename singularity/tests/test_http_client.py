@@ -0,0 +1,183 @@
+#!/usr/bin/python
+
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+from singularity.http_client import get_aiohttp
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer
+)
+
+import asyncio
+import threading
+import unittest
+import tempfile
+import shutil
+import time
+
+print("############################################################ test_http_client")
+
+
+class Flaky(BaseHTTPRequestHandler):
+    '''a stub server. /flaky fails (503) the first server.failures times,
+    /slow answers after server.delay seconds'''
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests += 1
+        status = 200
+        if self.path == '/flaky' and self.server.failures > 0:
+            self.server.failures -= 1
+            status = 503
+        elif self.path == '/slow':
+            time.sleep(self.server.delay)
+        body = self.path.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestHttpClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Flaky)
+        self.server.requests = 0
+        self.server.failures = 0
+        self.server.delay = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:%s" %self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_request(self):
+        from singularity.http_client import (
+            AsyncClient,
+            get_all,
+            request,
+            run
+        )
+        print("Testing singularity.http_client.request")
+
+        print("Case 1: Transient errors are retried with backoff")
+        self.server.failures = 2
+        async def flaky():
+            client = AsyncClient(backoff=0.05)
+            try:
+                return await client.get("%s/flaky" %self.url)
+            finally:
+                await client.close()
+        response = run(flaky())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, '/flaky')
+        self.assertEqual(self.server.requests, 3)
+
+        print("Case 2: The last response is returned when retries run out")
+        self.server.failures = 10
+        async def failing():
+            client = AsyncClient(backoff=0.01, retries=2)
+            try:
+                return await client.get("%s/flaky" %self.url)
+            finally:
+                await client.close()
+        self.assertEqual(run(failing()).status_code, 503)
+
+        print("Case 3: Each request has a timeout")
+        self.server.delay = 1
+        with self.assertRaises(Exception):
+            request('GET', "%s/slow" %self.url, timeout=0.2, retries=1)
+
+        print("Case 4: Requests are sent at once")
+        self.server.delay = 0.3
+        start = time.time()
+        responses = get_all(["%s/slow" %self.url] * 5)
+        self.assertTrue(time.time() - start < 1.2)
+        self.assertEqual([x.status_code for x in responses], [200] * 5)
+
+        print("Case 5: A sync call from the sync loop is an error")
+        async def nested():
+            return request('GET', "%s/flaky" %self.url)
+        with self.assertRaises(RuntimeError):
+            run(nested())
+
+
+@unittest.skipIf(get_aiohttp() is None, 'aiohttp is not installed')
+class TestAsyncBuild(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.data = {'container_id': 1, 'commit': 'abc', 'branch': 'master',
+                     'token': 'pancakes', 'tag': 'latest'}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_send_build_data_async(self):
+        from singularity.build.main import send_build_data_async
+        from singularity.http_client import AsyncClient
+        from aiohttp import web
+        print("Testing singularity.build.main.send_build_data_async")
+
+        polls = []
+        async def build(request):
+            await request.post()
+            return web.Response(status=202, headers={'Location': '/ack',
+                                                     'Retry-After': '0.2'})
+        async def ack(request):
+            polls.append(request.headers.get('Authorization'))
+            return web.Response(status=200)
+
+        async def main():
+            app = web.Application()
+            app.router.add_post('/build', build)
+            app.router.add_get('/ack', ack)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            port = site._server.sockets[0].getsockname()[1]
+            url = "http://127.0.0.1:%s/build" %port
+
+            client = AsyncClient()
+            try:
+                start = time.time()
+                await asyncio.gather(*[send_build_data_async(self.tmpdir, self.data,
+                                                             secret='pancakes',
+                                                             response_url=url,
+                                                             clean_up=False,
+                                                             client=client)
+                                       for _ in range(4)])
+                return time.time() - start
+            finally:
+                await client.close()
+                await runner.cleanup()
+
+        print("Case 1: Builds are acknowledged while the others wait")
+        seconds = asyncio.run(main())
+        self.assertEqual(len(polls), 4)
+        self.assertTrue(polls[0] is not None)
+        self.assertTrue(seconds < 0.6)
+
+
+if __name__ == '__main__':
+    unittest.main()
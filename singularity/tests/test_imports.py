@@ -0,0 +1,48 @@
+#!/usr/bin/python
+
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+import unittest
+
+print("########################################################### test_imports")
+
+class TestImports(unittest.TestCase):
+
+    def test_lazy_imports(self):
+        from singularity.tests.benchmark import import_time, MODULES
+        print("Testing that modules don't import heavy dependencies")
+        for module in MODULES:
+            print("...Case: %s" % module)
+            milliseconds, imported = import_time(module)
+            self.assertEqual(imported, [])
+
+    def test_lazy_attributes(self):
+        import singularity.views as views
+        from singularity.views import container_similarity_tree
+        from singularity.views.trees import container_similarity
+        print("Testing that package functions are imported when used")
+        self.assertTrue(container_similarity_tree is container_similarity)
+        self.assertTrue('make_container_tree' in dir(views))
+        with self.assertRaises(AttributeError):
+            views.make_pancakes
+
+
+if __name__ == '__main__':
+    unittest.main()
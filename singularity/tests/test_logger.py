@@ -0,0 +1,103 @@
+#!/usr/bin/python
+
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+import unittest
+import os
+
+print("############################################################ test_logger")
+
+class TestLogger(unittest.TestCase):
+
+    def test_stats(self):
+        from singularity.logger.stats import Stats, get_stats
+        import time
+        print("Testing singularity.logger.stats.Stats")
+        stats = Stats('job')
+        with stats.timer('hash'):
+            time.sleep(0.01)
+        with stats.timer('hash'):
+            pass
+        stats.count('files_hashed')
+        stats.count('bytes_read', 10)
+        result = stats.to_dict()
+        self.assertTrue(result['seconds']['hash'] >= 0.01)
+        self.assertEqual(result['counts'], {'files_hashed': 1, 'bytes_read': 10})
+
+        print("Case 2: Disabled stats do nothing, and are false")
+        stats = get_stats(None)
+        self.assertFalse(stats)
+        with stats.timer('hash'):
+            stats.count('files_hashed')
+        self.assertEqual(stats.to_dict(), {})
+
+
+    def test_history(self):
+        from singularity.logger.message import (
+            SingularityMessage,
+            DEBUG,
+            INFO,
+            QUIET
+        )
+        import io
+        print("Testing singularity.logger.message history")
+        previous = os.environ.get('SINGULARITY_LOG_HISTORY')
+        os.environ['SINGULARITY_LOG_HISTORY'] = '3'
+        try:
+            bot = SingularityMessage()
+        finally:
+            if previous is None:
+                del os.environ['SINGULARITY_LOG_HISTORY']
+            else:
+                os.environ['SINGULARITY_LOG_HISTORY'] = previous
+        bot.level = QUIET
+        bot.history_level = INFO
+        bot.colorize = True
+
+        print("Case 1: Only the most recent messages are kept, as records")
+        for i in range(5):
+            bot.info("message %s", i)
+        bot.warning("careful")
+        records = list(bot.iter_logs(records=True))
+        self.assertEqual(len(records), 3)
+        self.assertEqual(records[-1].prefix, 'WARNING')
+        self.assertEqual(records[-1].message, 'careful')
+        self.assertTrue(records[0].timestamp <= records[-1].timestamp)
+        self.assertEqual(bot.get_logs(), 'message 3\nmessage 4\nWARNING careful')
+        self.assertFalse('\033' in bot.get_logs())
+        self.assertEqual(list(bot.iter_logs(level=0)), ['WARNING careful'])
+
+        print("Case 2: Disabled messages are not formatted or kept")
+        class Format(object):
+            def __str__(self):
+                raise AssertionError('formatted a disabled message')
+        bot.debug("never %s", Format())
+        self.assertEqual(len(bot.history), 3)
+
+        print("Case 3: Printed messages are formatted and kept")
+        bot.level = DEBUG
+        bot.outputStream = bot.errorStream = io.StringIO()
+        bot.debug("%s of %s", 1, 2)
+        self.assertEqual(bot.history[-1].message, '1 of 2')
+        self.assertTrue('1 of 2' in bot.outputStream.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,7 +18,10 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
-from singularity.utils import get_installdir
+from singularity.utils import (
+    get_installdir,
+    read_file
+)
 from numpy.testing import (
     assert_array_equal, 
     assert_almost_equal, 
@@ -91,6 +94,37 @@ class TestUtils(unittest.TestCase):
         self.assertTrue(not is_not_installed)
 
 
+    def test_get_runtime(self):
+        print("Testing utils.get_runtime")
+        from singularity.utils import get_runtime, SingularityRuntime
+        previous = os.environ.get('SINGULARITY_VERSION')
+        try:
+            print("Case 1: The version is overridden, and detected once")
+            os.environ['SINGULARITY_VERSION'] = "singularity version 3.5.2"
+            runtime = get_runtime()
+            self.assertEqual(runtime.major, 3)
+            self.assertTrue(runtime.sandbox)
+            self.assertEqual(runtime.export_mode, 'sandbox')
+            self.assertTrue(get_runtime() is runtime)
+
+            print("Case 2: A new override is a new runtime")
+            os.environ['SINGULARITY_VERSION'] = "2.6.1-dist"
+            runtime = get_runtime()
+            self.assertEqual(runtime.major, 2)
+            self.assertEqual(runtime.export_mode, 'tar')
+        finally:
+            if previous is None:
+                del os.environ['SINGULARITY_VERSION']
+            else:
+                os.environ['SINGULARITY_VERSION'] = previous
+            get_runtime(refresh=True)
+
+        print("Case 3: Other runtimes")
+        self.assertTrue(SingularityRuntime('apptainer version 1.2.5').sandbox)
+        self.assertTrue(SingularityRuntime('singularity-ce version 4.1.0').sandbox)
+        self.assertFalse(SingularityRuntime('').installed)
+
+
     def test_get_installdir(self):
         '''get install directory should return the base of where singularity
         is installed
@@ -115,5 +149,93 @@ class TestUtils(unittest.TestCase):
         self.assertTrue(os.path.exists("%s/singularity" %self.tmpdir))
 
 
+    def test_fetch_repo(self):
+        print("Testing utils.fetch_repo")
+        from singularity.utils import (
+            fetch_repo,
+            run_command,
+            write_file
+        )
+
+        # A local repository with two commits on master, and a branch
+        repo = "%s/repo" %self.tmpdir
+        git = ['git', '-C', repo, '-c', 'user.name=dinosaur',
+               '-c', 'user.email=dinosaur@pancakes.com']
+        os.mkdir(repo)
+        run_command(['git', 'init', '-q', repo])
+        run_command(git + ['checkout', '-q', '-b', 'master'])
+        commits = []
+        for version in ['1', '2']:
+            write_file("%s/Singularity" %repo, "Bootstrap: docker\nFrom: busybox:%s\n" %version)
+            write_file("%s/README.md" %repo, "Version %s" %version)
+            run_command(git + ['add', '.'])
+            run_command(git + ['commit', '-q', '-m', version])
+            commit = run_command(git + ['rev-parse', 'HEAD'])['message']
+            commits.append(commit.decode('utf-8').strip())
+        run_command(git + ['branch', 'develop', commits[0]])
+        url = "file://%s" %repo
+
+        def read(filename):
+            return read_file(filename, readlines=False)
+
+        def count_commits(path):
+            count = run_command(['git', '-C', path, 'rev-list', '--count', 'HEAD'])
+            return int(count['message'])
+
+        print("Case 1: Fetch a single commit, without history")
+        dest = "%s/commit" %self.tmpdir
+        self.assertEqual(fetch_repo(url, dest, commit=commits[0]), commits[0])
+        self.assertTrue('busybox:1' in read("%s/Singularity" %dest))
+        self.assertEqual(count_commits(dest), 1)
+
+        print("Case 2: Fetch the head of a branch, or the default")
+        dest = "%s/branch" %self.tmpdir
+        self.assertEqual(fetch_repo(url, dest, branch='develop'), commits[0])
+        dest = "%s/default" %self.tmpdir
+        self.assertEqual(fetch_repo(url, dest), commits[1])
+
+        print("Case 3: Sparse checkout of only the recipe")
+        dest = "%s/sparse" %self.tmpdir
+        fetch_repo(url, dest, commit=commits[1], sparse_paths=['Singularity'])
+        self.assertTrue(os.path.exists("%s/Singularity" %dest))
+        self.assertTrue(not os.path.exists("%s/README.md" %dest))
+
+        print("Case 4: Commits are reused from the repository cache")
+        cache = "%s/cache" %self.tmpdir
+        dest = "%s/cached" %self.tmpdir
+        self.assertEqual(fetch_repo(url, dest, branch='master', cache_dir=cache), commits[1])
+        shutil.rmtree(repo)
+        dest = "%s/cached-again" %self.tmpdir
+        self.assertEqual(fetch_repo(url, dest, commit=commits[1], cache_dir=cache), commits[1])
+        self.assertTrue('busybox:2' in read("%s/Singularity" %dest))
+        self.assertEqual(len(os.listdir(cache)), 1)
+
+        print("Case 5: A commit that can't be fetched alone is found in the branches")
+        repo = "%s/other" %self.tmpdir
+        git[2] = repo
+        os.mkdir(repo)
+        run_command(['git', 'init', '-q', repo])
+        run_command(git + ['checkout', '-q', '-b', 'master'])
+        run_command(git + ['commit', '-q', '--allow-empty', '-m', 'base'])
+        run_command(git + ['checkout', '-q', '-b', 'feature'])
+        for version in ['3', '4']:
+            write_file("%s/Singularity" %repo, "Bootstrap: docker\nFrom: busybox:%s\n" %version)
+            run_command(git + ['add', '.'])
+            run_command(git + ['commit', '-q', '-m', version])
+        feature = run_command(git + ['rev-parse', 'HEAD~1'])['message'].decode('utf-8').strip()
+        run_command(git + ['checkout', '-q', 'master'])
+        run_command(git + ['config', 'uploadpack.allowReachableSHA1InWant', 'false'])
+        os.environ['GIT_CONFIG_PARAMETERS'] = "'protocol.version=0'"
+        try:
+            dest = "%s/feature" %self.tmpdir
+            self.assertEqual(fetch_repo("file://%s" %repo, dest, commit=feature), feature)
+            self.assertTrue('busybox:3' in read("%s/Singularity" %dest))
+        finally:
+            del os.environ['GIT_CONFIG_PARAMETERS']
+
+        print("Case 6: Missing repository returns None")
+        self.assertEqual(fetch_repo(url, "%s/missing" %self.tmpdir), None)
+
+
 if __name__ == '__main__':
     unittest.main()
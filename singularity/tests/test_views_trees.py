@@ -0,0 +1,215 @@
+#!/usr/bin/python
+
+'''
+
+Copyright (C) 2017-2019 Vanessa Sochat.
+
+This program is free software: you can redistribute it and/or modify it
+under the terms of the GNU Affero General Public License as published by
+the Free Software Foundation, either version 3 of the License, or (at your
+option) any later version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT
+ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Affero General Public
+License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+
+import unittest
+import tempfile
+import shutil
+import json
+import os
+
+print("###################################################### test_views_trees")
+
+class TestViewsTrees(unittest.TestCase):
+
+    def setUp(self):
+        self.folders = ['.', './usr/bin', './usr', './etc', './usr/lib/python3']
+        self.files = ['./usr/bin/python', './etc/hosts', './README',
+                      './usr/lib/python3/os.py', './missing/file']
+
+    def test_make_container_tree(self):
+        from singularity.views.trees import make_container_tree
+        print("Testing singularity.views.trees.make_container_tree")
+        tree = make_container_tree(folders=self.folders, files=self.files)
+        for key in ['graph', 'lookup', 'depth', 'files']:
+            self.assertTrue(key in tree)
+
+        print("Case 1: Parents are created before children, with ids in order")
+        self.assertEqual(tree['lookup'], {'usr': 1, 'usr/bin': 2, 'etc': 3,
+                                          'usr/lib': 4, 'usr/lib/python3': 5})
+        self.assertEqual(tree['depth'], 3)
+
+        print("Case 2: Children are linked to their parents")
+        graph = tree['graph']
+        self.assertEqual(graph['name'], 'base')
+        self.assertEqual([x['name'] for x in graph['children']], ['usr', 'etc'])
+        usr = graph['children'][0]
+        self.assertEqual(usr['parent'], 0)
+        self.assertEqual([x['path'] for x in usr['children']], ['usr/bin', 'usr/lib'])
+        python3 = usr['children'][1]['children'][0]
+        self.assertEqual(python3['level'], 2)
+        self.assertEqual(python3['parent'], 4)
+
+        print("Case 3: Files are associated with the id of their folder")
+        self.assertEqual(tree['files'], {2: ['python'], 3: ['hosts'],
+                                         0: ['README'], 5: ['os.py']})
+
+        print("Case 4: parse_files=False does not return files")
+        tree = make_container_tree(folders=self.folders, files=self.files,
+                                   parse_files=False)
+        self.assertTrue('files' not in tree)
+
+    def test_comparison_trees(self):
+        from singularity.analysis.compare import compare_lists
+        from singularity.views.trees import (
+            container_difference,
+            container_similarity,
+            container_tree,
+            make_container_tree
+        )
+        print("Testing singularity.views.trees.make_container_tree without folders")
+        tree = make_container_tree(files=self.files)
+        self.assertEqual(tree['lookup'], {'usr/bin': 2, 'usr': 1, 'etc': 3,
+                                          'usr/lib': 4, 'usr/lib/python3': 5,
+                                          'missing': 6})
+        self.assertEqual(tree['files'][6], ['file'])
+
+        print("Case 1: Absolute paths make the same tree as relative ones")
+        absolute = make_container_tree(files=[x[1:] for x in self.files])
+        self.assertEqual(absolute, tree)
+        self.assertTrue('' not in absolute['lookup'])
+
+        print("Testing singularity.views.trees.container_difference")
+        others = ['/usr/bin/python', '/etc/passwd', '/README']
+        comparison = compare_lists(self.files, ['./%s' % x[1:] for x in others])
+        tree = container_difference(comparison=comparison)
+        self.assertEqual(set(tree['lookup']), set(['etc', 'usr', 'usr/lib',
+                                                   'usr/lib/python3', 'missing']))
+
+        print("Testing singularity.views.trees.container_similarity")
+        tree = container_similarity(comparison=comparison)
+        self.assertEqual(set(tree['lookup']), set(['usr', 'usr/bin']))
+        self.assertEqual(tree['files'][0], ['README'])
+
+        print("Testing singularity.views.trees.container_tree with a sandbox")
+        tmpdir = tempfile.mkdtemp()
+        for filename in others:
+            filename = os.path.join(tmpdir, filename.strip('/'))
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            with open(filename, 'w') as filey:
+                filey.writelines('hello')
+        tree = container_tree(tmpdir)
+        self.assertEqual(set(tree['lookup']), set(['usr', 'usr/bin', 'etc']))
+        self.assertEqual(tree['files'][0], ['README'])
+
+        print("Case 1: Folders come from the files, empty folders aren't shown")
+        os.mkdir(os.path.join(tmpdir, 'opt'))
+        empty = tempfile.mkdtemp()
+        tree = container_difference(tmpdir, empty)
+        self.assertEqual(set(tree['lookup']), set(['usr', 'usr/bin', 'etc']))
+        shutil.rmtree(empty)
+        shutil.rmtree(tmpdir)
+
+    def test_get_tree_level(self):
+        from singularity.views.trees import (
+            make_container_index,
+            get_tree_level
+        )
+        print("Testing singularity.views.trees.make_container_index")
+        sizes = {'./usr/bin/python': 100, './etc/hosts': 10, './README': 1,
+                 './usr/lib/python3/os.py': 20, './missing/file': 5}
+        index = make_container_index(files=self.files, sizes=sizes,
+                                     folders=self.folders)
+        self.assertEqual(index['']['count'], 5)
+        self.assertEqual(index['']['size'], 136)
+        self.assertEqual(index['usr']['count'], 2)
+        self.assertEqual(index['usr']['size'], 120)
+        self.assertEqual(index['usr/lib']['folders'], ['usr/lib/python3'])
+
+        print("Testing singularity.views.trees.get_tree_level")
+        print("Case 1: Base level lists folders, then files")
+        level = get_tree_level(index)
+        self.assertEqual(level['total'], 4)
+        self.assertEqual([x['name'] for x in level['children']],
+                         ['usr', 'etc', 'missing', 'README'])
+        usr = level['children'][0]
+        self.assertEqual(usr['type'], 'folder')
+        self.assertEqual(usr['children'], 2)
+        self.assertEqual(usr['size'], 120)
+
+        print("Case 2: Children of a folder, paginated across folders and files")
+        level = get_tree_level(index, path='./usr/bin')
+        self.assertEqual(level['children'], [{'name': 'python', 'path': 'usr/bin/python',
+                                              'type': 'file', 'size': 100}])
+        level = get_tree_level(index, offset=2, limit=1)
+        self.assertEqual([x['name'] for x in level['children']], ['missing'])
+        level = get_tree_level(index, offset=3, limit=10)
+        self.assertEqual([x['name'] for x in level['children']], ['README'])
+
+        print("Case 3: Unknown folder returns None")
+        self.assertEqual(get_tree_level(index, path='pizza'), None)
+
+        print("Case 4: Paths with another delimiter")
+        index = make_container_index(files=['usr:bin:python'], path_delim=':')
+        level = get_tree_level(index, path='usr:bin:', path_delim=':')
+        self.assertEqual(level['children'][0]['path'], 'usr:bin:python')
+
+    def test_make_interactive_tree(self):
+        from singularity.views.trees import make_interactive_tree
+        import pandas
+        print("Testing singularity.views.trees.make_interactive_tree")
+        names = ['a', 'b', 'c', 'd']
+        matrix = pandas.DataFrame([[1.0, 0.9, 0.1, 0.2],
+                                   [0.9, 1.0, 0.2, 0.1],
+                                   [0.1, 0.2, 1.0, 0.8],
+                                   [0.2, 0.1, 0.8, 1.0]],
+                                  index=names, columns=names)
+        d3 = make_interactive_tree(matrix)
+        self.assertEqual(d3['name'], 'root')
+        self.assertEqual(sorted(d3['leaves']), names)
+        top = d3['children'][0]
+        self.assertEqual(top['count'], 4)
+        self.assertEqual(top['leaves'], [0, 4])
+        self.assertEqual(top['name'], 'a|||b|||c|||d')
+        for cluster in top['children']:
+            start, end = cluster['leaves']
+            self.assertEqual(cluster['count'], 2)
+            self.assertEqual(cluster['name'], '|||'.join(sorted(d3['leaves'][start:end])))
+
+        print("Case 2: Cluster names are capped with max_label_leaves")
+        d3 = make_interactive_tree(matrix, max_label_leaves=1)
+        self.assertTrue(d3['children'][0]['name'].endswith('... (3 more)'))
+
+        print("Case 3: A flat tree has the parent of each node")
+        flat = make_interactive_tree(matrix, flat=True)
+        self.assertEqual(flat['nodes'][0]['parentId'], None)
+        self.assertEqual(flat['nodes'][1]['name'], top['name'])
+        self.assertEqual([x['parentId'] for x in flat['nodes'][1:]], [0, 1, 2, 2, 1, 5, 5])
+
+    def test_linkage_to_tree(self):
+        from singularity.views.trees import flatten_tree, linkage_to_tree
+        print("Testing singularity.views.trees.linkage_to_tree")
+
+        print("Case 1: A deep tree has short names, and is saved to json flat")
+        n = 10000
+        Z = [[0, 1, 1.0, 2]] + [[n + i - 1, i + 1, 1.0 + i, i + 2] for i in range(1, n - 1)]
+        tree = linkage_to_tree(Z, ['leaf%s' %i for i in range(n)])
+        top = tree['children'][0]
+        self.assertEqual(top['count'], n)
+        self.assertTrue(top['name'].endswith('... (%s more)' %(n - 20)))
+        records = json.loads(json.dumps(flatten_tree(tree)))
+        self.assertEqual(len(records['nodes']), 2 * n)
+        self.assertEqual(records['nodes'][-1]['parentId'], 1)
+        self.assertEqual(len(records['leaves']), n)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -20,7 +20,6 @@ import collections
 import errno
 import os
 import re
-import requests
 
 import shutil
 import json
@@ -83,6 +82,102 @@ def run_command(cmd, sudo=False):
     return output
 
 
+def lazy_attributes(module_name, imports):
+    '''lazy_attributes returns the module functions __getattr__ and __dir__
+    (PEP 562) for a package to import its functions from submodules only
+    when they are first used, so importing the package stays fast.
+    :param module_name: the name of the package (__name__)
+    :param imports: a lookup of names to (relative submodule, name)
+    '''
+    import importlib
+
+    def __getattr__(name):
+        if name not in imports:
+            raise AttributeError("module %r has no attribute %r" %(module_name, name))
+        submodule, attribute = imports[name]
+        value = getattr(importlib.import_module(submodule, module_name), attribute)
+        setattr(sys.modules[module_name], name, value)
+        return value
+
+    def __dir__():
+        return sorted(set(vars(sys.modules[module_name])) | set(imports))
+
+    return __getattr__, __dir__
+
+
+##########################################################################
+# Singularity runtime
+##########################################################################
+
+
+class SingularityRuntime(object):
+    '''SingularityRuntime describes the capabilities of the installed
+    singularity, from one call to singularity --version (or the version
+    given, from SINGULARITY_VERSION).
+
+    Parameters
+    ==========
+    version: the version string (e.g., "singularity version 3.5.2")
+    '''
+    def __init__(self, version=None):
+        if version is None:
+            version = os.environ.get('SINGULARITY_VERSION')
+        if version is None:
+            try:
+                output = run_command(['singularity', '--version'])
+                if output['return_code'] == 0:
+                    version = output['message'].decode('utf-8').strip('\n')
+            except: # FileNotFoundError
+                pass
+        self.version = version
+
+        # Apptainer (1.x) continues from Singularity 3
+        self.major = None
+        match = re.search(r'([0-9]+)[.]([0-9]+)', version or '')
+        if match:
+            self.major = int(match.group(1))
+            if 'apptainer' in version:
+                self.major += 2
+
+    def __str__(self):
+        return "SingularityRuntime:%s" %self.version
+
+    @property
+    def installed(self):
+        return bool(self.version)
+
+    @property
+    def sandbox(self):
+        '''version 3 exports sandboxes (image.export is removed)'''
+        return self.major is not None and self.major >= 3
+
+    @property
+    def export_mode(self):
+        '''how an image is exported, to a "sandbox" folder, or a "tar"'''
+        return 'sandbox' if self.sandbox else 'tar'
+
+
+# The runtime is detected once, shared by all modules
+singularity_runtime = None
+
+
+def get_runtime(refresh=False):
+    '''get_runtime returns the SingularityRuntime, detected the first time
+    it's asked for (or again if SINGULARITY_VERSION changes, or refresh is
+    True). A detected version is also given to spython (as
+    SPYTHON_SINGULARITY_VERSION) so it doesn't run singularity --version
+    for each command either.
+    '''
+    global singularity_runtime
+    override = os.environ.get('SINGULARITY_VERSION')
+    if (refresh or singularity_runtime is None or
+       (override is not None and override != singularity_runtime.version)):
+        singularity_runtime = SingularityRuntime(override)
+        if override is None and singularity_runtime.installed:
+            os.environ['SPYTHON_SINGULARITY_VERSION'] = singularity_runtime.version
+    return singularity_runtime
+
+
 ############################################################################
 ## FOLDER OPERATIONS #########################################################
 ############################################################################
@@ -102,6 +197,20 @@ def mkdir_p(path):
             sys.exit(1)
 
 
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(size):
+    '''parse_size returns bytes of a size, a number or a string with a
+    unit (e.g., 500M, 20G), or None if size is None'''
+    if size is None or isinstance(size, (int, float)):
+        return size
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
 ############################################################################
 ## FILE OPERATIONS #########################################################
 ############################################################################
@@ -193,3 +302,132 @@ def download_repo(repo_url, destination, commit=None):
     command = "git clone %s %s" % (repo_url, destination)
     os.system(command)
     return destination
+
+
+def fetch_repo(repo_url, destination, commit=None, branch=None,
+               sparse_paths=None, cache_dir=None):
+    '''fetch_repo will fetch only one commit (or the head of a branch) of a
+    repository, without history (depth 1), and check it out into destination.
+    If the server doesn't allow fetching a commit directly, the history is
+    fetched instead.
+    :param repo_url: the url of the repo to fetch from
+    :param destination: the full path to the destination for the repo
+    :param commit: the commit to check out (takes preference over branch)
+    :param branch: the branch to check out, if commit is not defined.
+    The default branch of the remote is used if neither is defined.
+    :param sparse_paths: if defined, a list of paths (patterns) to check out
+    :param cache_dir: if defined, a folder for bare mirrors of repositories,
+    reused across fetches, so commits already fetched are not downloaded again
+    :returns: the commit checked out, or None if the fetch failed
+    '''
+    ref = commit or branch or 'HEAD'
+    source = repo_url
+    if cache_dir is not None:
+        mirror, ref = update_repo_cache(repo_url, ref, cache_dir)
+        if mirror is not None:
+            source = "file://%s" % mirror
+
+    mkdir_p(destination)
+    git = ['git', '-C', destination]
+    run_command(git + ['init', '-q'])
+    run_command(git + ['remote', 'add', 'origin', repo_url])
+
+    # Only check out some paths
+    if sparse_paths:
+        run_command(git + ['config', 'core.sparseCheckout', 'true'])
+        sparse_file = os.path.join(destination, '.git', 'info', 'sparse-checkout')
+        mkdir_p(os.path.dirname(sparse_file))
+        write_file(sparse_file, '\n'.join(sparse_paths) + '\n')
+
+    bot.info('Fetching %s of %s' %(ref, repo_url))
+    result = run_command(git + ['fetch', '-q', '--depth', '1', source, ref])
+    if result['return_code'] != 0:
+        bot.warning('Cannot fetch %s alone, fetching history.' % ref)
+        if commit is not None:
+            result = fetch_commit_history(git, source, commit, branch)
+            ref = commit
+        else:
+            result = run_command(git + ['fetch', '-q', source, ref])
+            ref = 'FETCH_HEAD'
+        if result['return_code'] != 0:
+            bot.error('Error fetching %s' % repo_url)
+            return None
+    else:
+        ref = 'FETCH_HEAD'
+
+    # Check out a branch, if we have one, or a detached commit
+    checkout = ['checkout', '-q', ref]
+    if branch is not None:
+        checkout = ['checkout', '-q', '-B', branch, ref]
+    result = run_command(git + checkout)
+    if result['return_code'] != 0:
+        bot.error('Error checking out %s' % ref)
+        return None
+
+    commit = run_command(git + ['rev-parse', 'HEAD'])['message']
+    if isinstance(commit, bytes):
+        commit = commit.decode('utf-8')
+    return commit.strip()
+
+
+def fetch_commit_history(git, source, commit, branch=None):
+    '''fetch_commit_history fetches the history of a branch, or else of all
+    branches and tags, until it has a commit (for servers that don't allow
+    fetching a commit directly). Returns the result of the last fetch.
+    :param git: the git command for the repository to fetch into
+    '''
+    refspecs = [['+refs/heads/*:refs/remotes/origin/*', '+refs/tags/*:refs/tags/*']]
+    if branch is not None:
+        refspecs.insert(0, ['+refs/heads/%s:refs/remotes/origin/%s' %(branch, branch)])
+
+    for refspec in refspecs:
+        result = run_command(git + ['fetch', '-q', source] + refspec)
+        exists = run_command(git + ['cat-file', '-e', '%s^{commit}' % commit])
+        if exists['return_code'] == 0:
+            break
+    return result
+
+
+def update_repo_cache(repo_url, ref, cache_dir):
+    '''update_repo_cache will fetch a ref (depth 1) into a bare mirror of a
+    repository in cache_dir, unless it's a commit that is already there.
+    :returns: the path to the mirror and the commit for the ref, or None and
+    the ref as given if the fetch failed.
+    '''
+    import hashlib
+    import tempfile
+    name = hashlib.sha1(repo_url.encode('utf-8')).hexdigest()
+    mirror = os.path.join(os.path.abspath(cache_dir), "%s.git" % name)
+    git = ['git', '--git-dir', mirror]
+
+    # The mirror is made in a temporary folder, and moved into place, so
+    # another build never sees (or makes) a partial one
+    if not os.path.exists(mirror):
+        mkdir_p(cache_dir)
+        tmpdir = tempfile.mkdtemp(prefix=".%s." % name, dir=cache_dir)
+        run_command(['git', '--git-dir', tmpdir, 'init', '-q', '--bare'])
+        run_command(['git', '--git-dir', tmpdir, 'config',
+                     'uploadpack.allowAnySHA1InWant', 'true'])
+        try:
+            os.rename(tmpdir, mirror)
+        except OSError:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    # A commit we have already fetched
+    exists = run_command(git + ['cat-file', '-e', '%s^{commit}' % ref])
+    if exists['return_code'] == 0 and re.match('^[0-9a-f]{40}$', ref):
+        bot.info('Found %s in repository cache.' % ref)
+        return mirror, ref
+
+    result = run_command(git + ['fetch', '-q', '--depth', '1', repo_url, ref])
+    if result['return_code'] != 0:
+        bot.warning('Cannot update repository cache for %s' % repo_url)
+        return None, ref
+
+    # Keep a reference, so the commit isn't removed by garbage collection
+    commit = run_command(git + ['rev-parse', 'FETCH_HEAD'])['message']
+    if isinstance(commit, bytes):
+        commit = commit.decode('utf-8')
+    commit = commit.strip()
+    run_command(git + ['update-ref', 'refs/cache/%s' % commit, commit])
+    return mirror, commit
@@ -50,6 +50,13 @@ INSTALL_BUILD_GOOGLE = (
     ('oauth2client', {'exact_version': '3.0'})
 )
 
+# Asynchronous http (without it, requests are sent with requests in threads)
+
+INSTALL_ASYNC = (
+    ('aiohttp', {'min_version': '3.8.0'}),
+)
+
 INSTALL_ALL = (INSTALL_REQUIRES +
                INSTALL_METRICS +
-               INSTALL_BUILD_GOOGLE)
+               INSTALL_BUILD_GOOGLE +
+               INSTALL_ASYNC)
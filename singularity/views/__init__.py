@@ -1,8 +1,18 @@
-from .trees import (
-    container_difference as container_difference_tree,
-    container_similarity as container_similarity_tree,
-    container_tree,
-    make_container_tree,
-    make_package_tree,
-    make_interactive_tree
-)
+from singularity.utils import lazy_attributes
+
+# Functions are imported from their modules when first used
+imports = {
+    'container_difference_tree': ('.trees', 'container_difference'),
+    'container_similarity_tree': ('.trees', 'container_similarity'),
+    'container_tree': ('.trees', 'container_tree'),
+    'container_tree_index': ('.trees', 'container_tree_index'),
+    'flatten_tree': ('.trees', 'flatten_tree'),
+    'get_tree_level': ('.trees', 'get_tree_level'),
+    'make_container_index': ('.trees', 'make_container_index'),
+    'make_container_tree': ('.trees', 'make_container_tree'),
+    'make_package_tree': ('.trees', 'make_package_tree'),
+    'make_interactive_tree': ('.trees', 'make_interactive_tree')
+}
+
+__all__ = list(imports)
+__getattr__, __dir__ = lazy_attributes(__name__, imports)
@@ -17,28 +17,21 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 '''
 
-from functools import reduce
+from itertools import islice
 import json
 
 from singularity.logger import bot
 
 from singularity.analysis.compare import (
     calculate_similarity,
-    compare_containers,
-    compare_packages
+    compare_containers
 )
 
 
-from singularity.package import (
-    get_container_contents,
-    load_package,
-    package
-)
+from singularity.package import get_container_contents
 
 import os
-import pandas
 import re
-import requests
 import shutil
 import sys
 import tempfile
@@ -50,186 +43,324 @@ import zipfile
 ###################################################################################
 
 
-def container_difference(container=None,container_subtract=None,image_package=None,
-                         image_package_subtract=None,comparison=None):
+def container_difference(container=None,container_subtract=None,comparison=None):
     '''container_difference will return a data structure to render an html 
-    tree (graph) of the differences between two images or packages. The second
+    tree (graph) of the differences between two images. The second
     container is subtracted from the first
-    :param container: the primary container object (to subtract from)
-    :param container_subtract: the second container object to remove
-    :param image_package: a zipped package for image 1, created with package
-    :param image_package_subtract: a zipped package for subtraction image, created with package
-    :param comparison: the comparison result object for the tree. If provided,
-    will skip over function to obtain it.
+    :param container: the primary container (to subtract from)
+    :param container_subtract: the second container to remove
+    :param comparison: the comparison result object (from compare_containers
+    or compare_lists). If provided, will skip over function to obtain it.
+    Folders are derived from the files compared, so empty folders are not
+    in the tree.
     '''
     if comparison == None:
         comparison = compare_containers(container1=container,
-                                        container2=container_subtract,
-                                        image_package1=image_package,
-                                        image_package2=image_package_subtract,
-                                        by=['files.txt','folders.txt'])
+                                        container2=container_subtract)
 
-    files = comparison["files.txt"]['unique1']
-    folders = comparison['folders.txt']['unique1']
-    tree = make_container_tree(folders=folders,
-                               files=files)
-    return tree
+    # Folders are derived from the file paths as the tree is built
+    return make_container_tree(files=comparison['unique1'])
 
 
 
-def container_similarity(container1=None,container2=None,image_package1=None,
-                         image_package2=None,comparison=None):
+def container_similarity(container1=None,container2=None,comparison=None):
     '''container_sim will return a data structure to render an html tree 
-    (graph) of the intersection (commonalities) between two images or packages
-    :param container1: the first container object
-    :param container2: the second container object if either not defined, need
-    :param image_package1: a packaged container1 (produced by package)
-    :param image_package2: a packaged container2 (produced by package)
-    :param comparison: the comparison result object for the tree. If provided,
-    will skip over function to obtain it.
+    (graph) of the intersection (commonalities) between two images
+    :param container1: the first container
+    :param container2: the second container
+    :param comparison: the comparison result object (from compare_containers
+    or compare_lists). If provided, will skip over function to obtain it.
+    As for container_difference, empty folders are not in the tree.
     '''
     if comparison == None:
         comparison = compare_containers(container1=container1,
-                                        container2=container2,
-                                        image_package1=image_package1,
-                                        image_package2=image_package2,
-                                        by=['files.txt','folders.txt'])
-    files = comparison["files.txt"]['intersect']
-    folders = comparison['folders.txt']['intersect']
-    tree = make_container_tree(folders=folders,
-                               files=files)
-    return tree
-
-
-def container_tree(container=None,image_package=None):
+                                        container2=container2)
+    return make_container_tree(files=comparison['intersect'])
+
+
+def container_tree(container=None):
     '''tree will render an html tree (graph) of a container
     '''
-
-    guts = get_container_contents(container=container,
-                                  image_package=image_package,
-                                  split_delim="\n")
+    guts = get_container_contents(container=container)
 
     # Make the tree and return it
-    tree = make_container_tree(folders = guts["folders.txt"],
-                               files = guts['files.txt'])
-    return tree
+    return make_container_tree(files=guts['all'])
 
 
-def make_container_tree(folders,files,path_delim="/",parse_files=True):
+def make_container_tree(folders=None,files=None,path_delim="/",parse_files=True):
     '''make_container_tree will convert a list of folders and files into a json structure that represents a graph.
-    :param folders: a list of folders in the image
+    Each node is linked to its parent as it is created, so the tree is built in a
+    single pass over the folder paths.
+    :param folders: a list of folders in the image. If not provided, folders
+    are derived from the file paths in the same pass that parses them.
     :param files: a list of files in the folder
     :param parse_files: return 'files' lookup in result, to associate ID of node with files (default True)
     :param path_delim: the path delimiter, default is '/'
     '''
-    nodes = {}  # first we will make a list of nodes
-    lookup = {}
-    count = 1   # count will hold an id for nodes
-    max_depth = 0
-    for folder in folders:
-        if folder != ".":
-            folder = re.sub("^[.]/","",folder)
-            path_components = folder.split(path_delim)
-            for p in range(len(path_components)):
-                path_component = path_components[p]
-                fullpath = path_delim.join(path_components[0:p+1])
-                # Have we created the node yet?
-                if fullpath not in lookup:
-                    lookup[fullpath] = count
-                    node = {"id":count,"name":path_component,"path":fullpath,"level":p,"children":[]}
-                    count +=1
-                    # Did we find a deeper level?
-                    if p > max_depth:
-                        max_depth = p
-                    # Does the node have a parent?
-                    if p==0: # base node, no parent
-                        parent_id = 0
-                    else: # look up the parent id
-                        parent_path = path_delim.join(path_components[0:p])
-                        parent_id = lookup[parent_path]                   
-                    node["parent"] = parent_id
-                    nodes[node['id']] = node   
-           
-    # Now make the graph, we simply append children to their parents
-    seen = []
-    graph = []
-    iters = list(range(max_depth+1)) # 0,1,2,3...
-    iters.reverse()            # ...3,2,1,0
-    iters.pop()                # remove 0
-    for level in iters:
-        children = {x:y for x,y in nodes.items() if y['level'] == level}
-        seen = seen + [y['id'] for x,y in children.items()]
-        nodes = {x:y for x,y in nodes.items() if y['id'] not in seen}
-        for node_id,child_node in children.items():
-            if node_id == 0: #base node
-                graph[node_id] = child_node
+    graph = []    # top level nodes, children of base
+    lookup = {}   # fullpath --> node id
+    nodes = {}    # fullpath --> node
+    state = {"count": 1,       # count will hold an id for nodes
+             "max_depth": 0}
+
+    def add_folder(folder):
+        '''add a folder and any missing parents, returning the folder node'''
+        # Walk up to the closest ancestor we have already created
+        missing = []
+        path = folder
+        parent = None
+        while path not in nodes:
+            missing.append(path)
+            if path_delim not in path:
+                break
+            path = path.rsplit(path_delim, 1)[0]
+        else:
+            parent = nodes[path]
+
+        # Create missing nodes top down, linking each to its parent
+        for fullpath in reversed(missing):
+            if parent is None:
+                parent_id, level = 0, 0
+            else:
+                parent_id, level = parent['id'], parent['level'] + 1
+            node = {"id":state["count"],"name":fullpath.rsplit(path_delim, 1)[-1],
+                    "path":fullpath,"level":level,"children":[],
+                    "parent":parent_id}
+            lookup[fullpath] = state["count"]
+            nodes[fullpath] = node
+            state["count"] += 1
+
+            # Did we find a deeper level?
+            if level > state["max_depth"]:
+                state["max_depth"] = level
+
+            # Base nodes are added to the graph, others to their parent
+            if parent is None:
+                graph.append(node)
             else:
-                parent_id = child_node['parent']
-                nodes[parent_id]["children"].append(child_node)
+                parent['children'].append(node)
+            parent = node
+        return parent
 
-    # Now add the parents to graph, with name as main lookup
-    for parent,parent_info in nodes.items():
-        graph.append(parent_info)
-    graph = {"name":"base","children":graph}
-    result = {"graph":graph,"lookup":lookup,"depth":max_depth+1}
+    derive_folders = folders is None
+    for folder in folders or []:
+        if folder != ".":
+            add_folder(strip_relative(folder))
 
-    # Parse files to include in tree
-    if parse_files == True:
-        file_lookup = {}
-        for filey in files:
-            filey = re.sub("^[.]/","",filey)
+    # Parse files to include in tree, creating their folders if needed
+    file_lookup = {}
+    if parse_files == True or derive_folders:
+        for filey in files or []:
+            filey = strip_relative(filey)
             filepath,filename = os.path.split(filey)
-            if filepath in lookup:
+            if filepath == '': # base folder
+                folder_id = 0
+            elif derive_folders:
+                folder_id = add_folder(filepath)['id']
+            elif filepath in lookup:
                 folder_id = lookup[filepath]
-                if folder_id in file_lookup:
-                    file_lookup[folder_id].append(filename)
-                else:
-                    file_lookup[folder_id] = [filename]
-            elif filepath == '': # base folder
-                if 0 in file_lookup:
-                    file_lookup[0].append(filename)
-                else:
-                    file_lookup[0] = [filename]
-        result['files'] = file_lookup
+            else:
+                continue
+            if folder_id in file_lookup:
+                file_lookup[folder_id].append(filename)
+            else:
+                file_lookup[folder_id] = [filename]
 
+    graph = {"name":"base","children":graph}
+    result = {"graph":graph,"lookup":lookup,"depth":state["max_depth"]+1}
+    if parse_files == True:
+        result['files'] = file_lookup
     return result
 
 
+def strip_relative(path):
+    '''strip_relative removes a leading ./ (as found in a tar or find listing)
+    or / (as found in extract_guts) from a path, so absolute and relative
+    paths are the same folder in a tree (an absolute path used to add a
+    base folder with an empty name)
+    '''
+    if path.startswith('./'):
+        return path[2:]
+    return path.lstrip('/')
+
+
+###################################################################################
+# LAZY TREES
+###################################################################################
+
+
+def container_tree_index(container):
+    '''container_tree_index will return an index (see make_container_index)
+    for a container, to serve one level of the tree at a time
+    '''
+    guts = get_container_contents(container=container)
+    return make_container_index(files=guts['all'],
+                                sizes=guts.get('sizes'))
+
+
+def make_container_index(files,sizes=None,folders=None,path_delim="/"):
+    '''make_container_index will build a flat lookup of folders (by path, with
+    the base folder as '') that can be serialized once and then served one
+    level at a time with get_tree_level. Each folder has its direct subfolders,
+    its files (name: size), and the count and size of all files under it.
+    :param files: a list of files in the image
+    :param sizes: a lookup of file sizes (by file path), if known
+    :param folders: a list of folders, including empty ones. Folders are
+    otherwise derived from the file paths.
+    :param path_delim: the path delimiter, default is '/'
+    '''
+    if sizes is None:
+        sizes = {}
+
+    index = {'': {"name": "base", "path": "", "level": -1, "parent": None,
+                  "folders": [], "files": {}, "count": 0, "size": 0}}
+
+    def add_folder(path):
+        '''add a folder and any missing parents, returning the folder'''
+        missing = []
+        while path not in index:
+            missing.append(path)
+            path = path.rsplit(path_delim, 1)[0] if path_delim in path else ''
+        parent = index[path]
+        for fullpath in reversed(missing):
+            node = {"name": fullpath.rsplit(path_delim, 1)[-1],
+                    "path": fullpath,
+                    "level": parent['level'] + 1,
+                    "parent": parent['path'],
+                    "folders": [],
+                    "files": {},
+                    "count": 0,
+                    "size": 0}
+            index[fullpath] = node
+            parent['folders'].append(fullpath)
+            parent = node
+        return parent
+
+    for folder in folders or []:
+        folder = strip_relative(folder).rstrip(path_delim)
+        if folder not in ['', '.']:
+            add_folder(folder)
+
+    for filey in files:
+        size = sizes.get(filey, 0) or 0
+        filey = strip_relative(filey)
+        if path_delim in filey:
+            path, filename = filey.rsplit(path_delim, 1)
+        else:
+            path, filename = '', filey
+        folder = add_folder(path)
+        folder['files'][filename] = size
+        folder['count'] += 1
+        folder['size'] += size
+
+    # Aggregate counts and sizes up the tree, deepest folders first
+    for folder in sorted(index.values(), key=lambda x: x['level'], reverse=True):
+        if folder['parent'] is not None:
+            parent = index[folder['parent']]
+            parent['count'] += folder['count']
+            parent['size'] += folder['size']
+
+    return index
+
+
+def get_tree_level(index,path='',offset=0,limit=None,path_delim="/"):
+    '''get_tree_level returns one level of a tree index (from make_container_index),
+    meaning the direct children of a folder, optionally paginated. Folders are
+    listed before files, and each folder includes its number of children, and
+    the count and size of all files under it, so it can be expanded on demand.
+    :param index: the index from make_container_index
+    :param path: the path of the folder to list, default is the base ('')
+    :param offset: the index of the first child to return
+    :param limit: the maximum number of children to return (default is all)
+    :param path_delim: the path delimiter of the index, default is '/'
+    '''
+    path = strip_relative(path).strip(path_delim)
+    if path == '.':
+        path = ''
+
+    if path not in index:
+        bot.warning("%s is not a folder in the tree." % path)
+        return None
+
+    folder = index[path]
+    total = len(folder['folders']) + len(folder['files'])
+    end = total if limit is None else min(offset + limit, total)
+
+    children = []
+    for i in range(offset, min(end, len(folder['folders']))):
+        child = index[folder['folders'][i]]
+        children.append({"name": child['name'],
+                         "path": child['path'],
+                         "type": "folder",
+                         "children": len(child['folders']) + len(child['files']),
+                         "count": child['count'],
+                         "size": child['size']})
+
+    if end > len(folder['folders']):
+        start = max(offset - len(folder['folders']), 0)
+        for filename in islice(folder['files'], start, end - len(folder['folders'])):
+            children.append({"name": filename,
+                             "path": filename if path == '' else path_delim.join([path, filename]),
+                             "type": "file",
+                             "size": folder['files'][filename]})
+
+    return {"name": folder['name'],
+            "path": folder['path'],
+            "count": folder['count'],
+            "size": folder['size'],
+            "total": total,
+            "offset": offset,
+            "children": children}
+
+
 ###################################################################################
 # DENDROGRAM
 ###################################################################################
 
 
-def make_package_tree(matrix=None,labels=None,width=25,height=10,title=None,font_size=None):
-    '''make package tree will make a dendrogram comparing a matrix of packages
+def make_package_tree(matrix=None,labels=None,width=25,height=10,title=None,font_size=None,
+                      distances=None,neighbors=None,approximate=False,k=10,method='ward'):
+    '''make package tree will make a dendrogram comparing a matrix of packages.
+    For large numbers of packages, provide a condensed distance vector
+    (distances) or sparse nearest neighbors graph (neighbors), or set
+    approximate to cluster the k nearest neighbors of each row of the
+    (similarity) matrix with single linkage (see singularity.analysis.cluster)
     :param matrix: a pandas df of packages, with names in index and columns
     :param labels: a list of labels corresponding to row names, will be
     pulled from rows if not defined
     :param title: a title for the plot, if not defined, will be left out.
+    :param distances: a condensed distance vector (as from pdist) to cluster
+    :param neighbors: a sparse graph of nearest neighbor distances to cluster
+    :param approximate: cluster the k nearest neighbors of the matrix (default False)
+    :param k: the number of nearest neighbors for approximate (default 10)
+    :param method: the linkage method for a matrix or distances (default ward)
     :returns a plot that can be saved with savefig
     '''
-    from matplotlib import pyplot as plt
-    from scipy.cluster.hierarchy import (
-        dendrogram, 
-        linkage
+    from singularity.analysis.cluster import (
+        get_linkage,
+        knn_graph
     )
+    from matplotlib import pyplot as plt
+    from scipy.cluster.hierarchy import dendrogram
+    import pandas
 
     if font_size is None:
         font_size = 8.
 
-    from scipy.cluster.hierarchy import cophenet
-    from scipy.spatial.distance import pdist
-
-    if not isinstance(matrix,pandas.DataFrame):
-        bot.info("No pandas DataFrame (matrix) of similarities defined, will use default.")
-        matrix = compare_packages()['files.txt']
-        title = 'Docker Library Similarity to Base OS'
+    if isinstance(matrix,pandas.DataFrame):
+        if labels is None:
+            labels = matrix.index.tolist()
+        if approximate and neighbors is None and distances is None:
+            neighbors = knn_graph(matrix, k=k)
 
-    Z = linkage(matrix, 'ward')
-    c, coph_dists = cophenet(Z, pdist(matrix))
+    elif distances is None and neighbors is None:
+        bot.warning("Please provide a pandas DataFrame (matrix), distances, or neighbors.")
+        return None
 
-    if labels == None:
-        labels = matrix.index.tolist()
+    Z = get_linkage(matrix=matrix,
+                    distances=distances,
+                    neighbors=neighbors,
+                    method=method)
 
     plt.figure(figsize=(width, height))
 
@@ -245,61 +376,107 @@ def make_package_tree(matrix=None,labels=None,width=25,height=10,title=None,font
     return plt
 
 
-def make_interactive_tree(matrix=None,labels=None):
-    '''make interactive tree will return complete html for an interactive tree
-    :param title: a title for the plot, if not defined, will be left out.
+# Cluster names join at most this many leaf names by default
+MAX_LABEL_LEAVES = 20
+
+
+def make_interactive_tree(matrix=None,labels=None,max_label_leaves=MAX_LABEL_LEAVES,
+                          flat=False):
+    '''make interactive tree will return a d3 hierarchy for an interactive tree
+    :param matrix: a pandas df of packages, with names in index and columns
+    :param labels: a list of labels corresponding to row names, will be
+    pulled from rows if not defined
+    :param max_label_leaves: the maximum number of leaf names to join into the
+    name of a cluster (default 20, None joins all). Each cluster also has the
+    count and range of its leaves (in the root "leaves" list).
+    :param flat: return the nodes as a list with parent ids (see flatten_tree),
+    which a tree of any depth can be saved to json as
     '''
-    from scipy.cluster.hierarchy import (
-        dendrogram, 
-        linkage,
-        to_tree
-    )
+    from scipy.cluster.hierarchy import linkage
+    import pandas
 
     d3 = None
-    from scipy.cluster.hierarchy import cophenet
-    from scipy.spatial.distance import pdist
-
     if isinstance(matrix,pandas.DataFrame):
         Z = linkage(matrix, 'ward') # clusters
-        T = to_tree(Z, rd=False)
 
-        if labels == None:
+        if labels is None:
             labels = matrix.index.tolist()
-        lookup = dict(zip(range(len(labels)), labels))
-
-        # Create a dendrogram object without plotting
-        dend = dendrogram(Z,no_plot=True,
-                      orientation="right",
-                      leaf_rotation=90.,  # rotates the x axis labels
-                      leaf_font_size=8.,  # font size for the x axis labels
-                      labels=labels)
-
-        d3 = dict(children=[], name="root")
-        add_node(T, d3)
-        label_tree(d3["children"][0],lookup)
+
+        d3 = linkage_to_tree(Z, labels, max_label_leaves=max_label_leaves)
+        if flat:
+            d3 = flatten_tree(d3)
     else:
         bot.warning('Please provide data as pandas Data Frame.')
     return d3
 
 
-def add_node(node, parent):
-    '''add_node will add a node to it's parent
+def linkage_to_tree(Z,labels,max_label_leaves=MAX_LABEL_LEAVES):
+    '''linkage_to_tree converts a linkage matrix into a d3 hierarchy without
+    recursion. Each node has a name, children, the count of its leaves, and
+    the [start, end) range of its leaves in the (left to right) "leaves" list
+    returned with the root. A deep hierarchy is too nested for json, see
+    flatten_tree.
+    :param Z: a linkage matrix, as returned by scipy linkage
+    :param labels: a list of labels for the leaves (rows of the original matrix)
+    :param max_label_leaves: the maximum number of leaf names to join into the
+    name of a cluster (default 20). If None, all leaf names are joined.
     '''
-    newNode = dict(node_id=node.id, children=[])
-    parent["children"].append(newNode)
-    if node.left: add_node(node.left, newNode)
-    if node.right: add_node(node.right, newNode)
-
-
-def label_tree(n,lookup):
-    '''label tree will again recursively label the tree
-    :param n: the root node, usually d3['children'][0]
-    :param lookup: the node/id lookup
+    n = len(Z) + 1
+    counts = [1] * n + [int(row[3]) for row in Z]
+
+    # Top down, assign each node the start of its range of leaves
+    starts = [0] * (2 * n - 1)
+    for i in range(len(Z) - 1, -1, -1):
+        left, right = int(Z[i][0]), int(Z[i][1])
+        starts[left] = starts[n + i]
+        starts[right] = starts[n + i] + counts[left]
+
+    leaves = [None] * n
+    nodes = {}
+    for i in range(n):
+        leaves[starts[i]] = labels[i]
+        nodes[i] = {"name": str(labels[i]),
+                    "children": [],
+                    "count": 1,
+                    "leaves": [starts[i], starts[i] + 1]}
+
+    # Bottom up, each row of the linkage joins two existing nodes
+    for i, row in enumerate(Z):
+        start = starts[n + i]
+        count = counts[n + i]
+        names = leaves[start:start + count] if max_label_leaves is None \
+                else leaves[start:start + min(count, max_label_leaves)]
+        name = "|||".join(sorted(map(str, names)))
+        if len(names) < count:
+            name = "%s|||... (%s more)" %(name, count - len(names))
+        nodes[n + i] = {"name": name,
+                        "children": [nodes.pop(int(row[0])),
+                                     nodes.pop(int(row[1]))],
+                        "count": count,
+                        "leaves": [start, start + count]}
+
+    return {"name": "root",
+            "children": list(nodes.values()),
+            "leaves": leaves}
+
+
+def flatten_tree(tree):
+    '''flatten_tree converts a hierarchy from linkage_to_tree into a list of
+    nodes, each with an id and the id of its parent (parentId, None for the
+    root), without recursion. The result is saved to json at any depth, and
+    d3.stratify() builds the hierarchy again.
+    :param tree: the hierarchy returned by linkage_to_tree
     '''
-    if len(n["children"]) == 0:
-        leaves = [lookup[n["node_id"]]]
-    else:
-        leaves = reduce(lambda ls, c: ls + label_tree(c,lookup), n["children"], [])
-    del n["node_id"]
-    n["name"] = name = "|||".join(sorted(map(str, leaves)))
-    return leaves
+    nodes = []
+    stack = [(tree, None)]
+    while stack:
+        node, parent = stack.pop()
+        record = {"id": len(nodes), "parentId": parent, "name": node["name"]}
+        if "count" in node:
+            record["count"] = node["count"]
+            record["leaves"] = node["leaves"]
+        nodes.append(record)
+        for child in reversed(node["children"]):
+            stack.append((child, record["id"]))
+
+    return {"nodes": nodes, "leaves": tree["leaves"]}